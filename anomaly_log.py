@@ -1,26 +1,77 @@
 import os
+import re
+import gzip
 import json
-from datetime import datetime
+import hashlib
+from collections import deque
+from datetime import datetime, timedelta
 import shutil
-from config import CRITICAL_ARCHIVE_FOLDER  # Importa a pasta de arquivamento configurada
+from file_lock import file_lock
+from config import (CRITICAL_ARCHIVE_FOLDER, USE_ANOMALY_STORE,  # Importa a pasta de arquivamento configurada
+                    CRITICAL_ROTATE_MAX_BYTES, CRITICAL_ARCHIVE_RETENTION_DAYS, CRITICAL_ARCHIVE_MAX_BYTES)
 
-LOG_FILE = "anomaly_history.json"
-CRITICAL_LOG_FILE = "critical_anomaly_history.json"
+# Os logs são ficheiros JSON Lines (uma anomalia por linha) só de acréscimo: registar uma anomalia
+# não obriga a ler nem a reescrever o ficheiro. O limite de entradas é aplicado por compactação periódica,
+# quando o log ultrapassa o máximo em COMPACTION_SLACK entradas.
+LOG_FILE = "anomaly_history.jsonl"
+CRITICAL_LOG_FILE = "critical_anomaly_history.jsonl"
 ARCHIVE_FOLDER = "archived_logs"
 MAX_ENTRIES = 2000
 CRITICAL_MAX_ENTRIES = 2000
+COMPACTION_SLACK = 500
+
+# Logs no formato antigo (um único objeto JSON), convertidos automaticamente na primeira utilização
+LEGACY_LOG_FILES = {
+    LOG_FILE: ("anomaly_history.json", "anomalies"),
+    CRITICAL_LOG_FILE: ("critical_anomaly_history.json", "critical_anomalies"),
+}
+
+# Índices persistentes (fingerprint -> first_seen, last_seen, count) das anomalias já registadas em cada log.
+# Uma anomalia já conhecida não é escrita de novo: o last_seen e o contador (número de dias em que foi vista)
+# só são atualizados na primeira vez que é vista em cada dia, e o índice só é regravado quando muda.
+# O índice sobrevive ao arquivo diário do log crítico e guarda as anomalias vistas nos últimos INDEX_RETENTION_DAYS dias.
+INDEX_FILES = {
+    LOG_FILE: "anomaly_history_index.json",
+    CRITICAL_LOG_FILE: "critical_anomaly_history_index.json",
+}
+INDEX_RETENTION_DAYS = 30
+FINGERPRINT_FIELDS = ("instance", "database", "type", "device")
+
+# As anomalias cujo timestamp é o momento da deteção (ex.: "nenhum backup nas últimas 24 horas") indicam em
+# 'reference' o dado estável que as identifica (ex.: data do último backup): o fingerprint usa-o em vez do
+# timestamp, para que a mesma anomalia detetada em verificações seguidas não seja registada de novo.
+# As anomalias de estado (ex.: base OFFLINE) são criadas com 'reference' None, que check_state substitui pelo
+# início do incidente: se a anomalia desaparecer e voltar, é registada (e alertada) de novo. Uma 'reference'
+# None que não tenha sido atribuída usa o timestamp (a anomalia é registada em cada verificação).
+
+# Arquivos do log crítico: "critical_anomaly_history_YYYY_MM_DD[_N].jsonl.gz" (data da anomalia mais antiga).
+# O log crítico é rodado quando contém anomalias de um dia anterior, quando ultrapassa CRITICAL_ROTATE_MAX_BYTES
+# ou o número máximo de entradas (em vez de ser compactado, para não perder anomalias críticas).
+# O ficheiro rodado é comprimido (gzip, em streaming) fora do lock do log; os arquivos com mais de
+# CRITICAL_ARCHIVE_RETENTION_DAYS dias, ou que excedam CRITICAL_ARCHIVE_MAX_BYTES no total, são apagados.
+ARCHIVE_PREFIX = "critical_anomaly_history_"
+_DATE = re.compile(r"\d{4}-\d{2}-\d{2}$")
+_ARCHIVE_NAME = re.compile(re.escape(ARCHIVE_PREFIX) + r"\d{4}_\d{2}_\d{2}(_\d+)?\.jsonl?(\.gz)?$")
+
+# Cada log é protegido por um lock de ficheiro (file_lock), que serializa as threads deste processo
+# e os outros processos (main.py e os *_app.py) que escrevem na mesma pasta.
+# Número de linhas de cada log e tamanho (bytes) do ficheiro quando foram contadas: se outro processo
+# acrescentar linhas, só os bytes novos são contados; se o ficheiro encolher (compactação), é recontado.
+_line_counts = {}
 
 def init_log_file():
-    """Cria ou reinicializa o log geral em formato JSON."""
-    data = {"anomalies": []}
-    with open(LOG_FILE, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+    """Cria ou reinicializa o log geral (JSON Lines vazio)."""
+    with file_lock(LOG_FILE):
+        _reset_log(LOG_FILE)
 
 def init_critical_log_file():
-    """Cria ou reinicializa o log crítico em formato JSON."""
-    data = {"critical_anomalies": []}
-    with open(CRITICAL_LOG_FILE, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+    """Cria ou reinicializa o log crítico (JSON Lines vazio)."""
+    with file_lock(CRITICAL_LOG_FILE):
+        _reset_log(CRITICAL_LOG_FILE)
+
+def _reset_log(log_file):
+    open(log_file, "w", encoding="utf-8").close()
+    _line_counts[log_file] = (0, 0)
 
 def serialize_anomaly(anomaly):
     """Converte a anomalia para um formato serializável (ex.: datas em string)."""
@@ -30,65 +81,423 @@ def serialize_anomaly(anomaly):
         new_anom["timestamp"] = ts.isoformat()
     else:
         new_anom["timestamp"] = str(ts)
+    if isinstance(new_anom.get("reference"), datetime):
+        new_anom["reference"] = new_anom["reference"].isoformat()
     return new_anom
 
-def add_anomaly_to_log(anomaly):
-    """Adiciona uma única anomalia ao log geral JSON."""
+def anomaly_fingerprint(anomaly):
+    """
+    Identificador estável de uma anomalia: hash da instância, base de dados, tipo, dispositivo,
+    timestamp (ou 'reference', se existir) e problemas detetados (funciona com anomalias serializadas ou não).
+    """
+    ts = anomaly["reference"] if anomaly.get("reference") is not None else anomaly.get("timestamp")
+    key = [str(anomaly.get(field) or "") for field in FINGERPRINT_FIELDS]
+    key.append(ts.isoformat() if isinstance(ts, datetime) else str(ts))
+    key.append(sorted({str(issue) for issue in anomaly.get("issues", [])}))
+    return hashlib.sha1(json.dumps(key, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+# Índice de cada log já lido: (identificação do ficheiro, índice). Só é relido se outro processo o regravar.
+_index_cache = {}
+
+def _index_stat(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+def load_anomaly_index(log_file):
+    """
+    Lê o índice de fingerprints do log indicado (dicionário vazio se não existir ou estiver corrompido).
+    O índice fica em memória e só é relido se o ficheiro mudar; deve ser usado com o lock do log obtido
+    e, se for alterado, gravado com save_anomaly_index (ou descartado com discard_anomaly_index).
+    """
+    path = INDEX_FILES[log_file]
+    stat = _index_stat(path)
+    cached = _index_cache.get(log_file)
+    if cached is not None and stat is not None and cached[0] == stat:
+        return cached[1]
     try:
-        with open(LOG_FILE, "r", encoding="utf-8") as f:
-            data = json.load(f)
+        with open(path, "r", encoding="utf-8") as f:
+            index = json.load(f)
     except Exception:
-        init_log_file()
-        with open(LOG_FILE, "r", encoding="utf-8") as f:
-            data = json.load(f)
-    anomalies = data.get("anomalies", [])
-    while len(anomalies) >= MAX_ENTRIES:
-        anomalies.pop(0)
-    anomalies.append(serialize_anomaly(anomaly))
-    data["anomalies"] = anomalies
-    with open(LOG_FILE, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+        index = {}
+    _index_cache[log_file] = (stat, index)
+    return index
 
-def log_anomalies(anomalies):
-    """Registra cada anomalia no log geral JSON."""
-    for anomaly in anomalies:
-        add_anomaly_to_log(anomaly)
+def discard_anomaly_index(log_file):
+    """Esquece o índice em memória (ex.: alterado mas não gravado por causa de um erro)."""
+    _index_cache.pop(log_file, None)
 
-def add_critical_anomaly_to_log(anomaly):
-    """Adiciona uma única anomalia crítica ao log crítico JSON."""
+def save_anomaly_index(log_file, index):
+    """Grava o índice (ficheiro temporário + substituição), sem as entradas não vistas há INDEX_RETENTION_DAYS dias."""
+    oldest = (datetime.now() - timedelta(days=INDEX_RETENTION_DAYS)).isoformat()
+    index = {fp: seen for fp, seen in index.items() if seen.get("last_seen", "") >= oldest}
+    path = INDEX_FILES[log_file]
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(index, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+    _index_cache[log_file] = (_index_stat(path), index)
+
+def _open_text(path):
+    # Os arquivos comprimidos são lidos diretamente (descompressão em streaming)
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt", encoding="utf-8")
+    return open(path, "r", encoding="utf-8")
+
+def iter_log(log_file):
+    """
+    Lê o log em streaming: devolve as anomalias (dicionários) pela ordem em que foram registadas.
+    Aceita também os arquivos comprimidos (.jsonl.gz).
+    """
+    try:
+        with _open_text(log_file) as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    # Linha incompleta (ex.: escrita interrompida): é ignorada
+                    continue
+    except FileNotFoundError:
+        return
+
+def read_log(log_file):
+    """Devolve a lista com todas as anomalias do log."""
+    return list(iter_log(log_file))
+
+def tail_log(log_file, n):
+    """Devolve as últimas 'n' anomalias do log, lendo o ficheiro a partir do fim em blocos."""
+    if n <= 0:
+        return []
+    if log_file.endswith(".gz"):
+        # Num ficheiro comprimido não é possível ler a partir do fim
+        return list(deque(iter_log(log_file), maxlen=n))
+    try:
+        f = open(log_file, "rb")
+    except FileNotFoundError:
+        return []
+    with f:
+        f.seek(0, os.SEEK_END)
+        position = f.tell()
+        data = b""
+        while position > 0 and data.count(b"\n") <= n:
+            size = min(64 * 1024, position)
+            position -= size
+            f.seek(position)
+            data = f.read(size) + data
+    entries = deque(maxlen=n)
+    for line in data.splitlines()[-(n + 1):]:
+        try:
+            entries.append(json.loads(line.decode("utf-8")))
+        except ValueError:
+            continue
+    return list(entries)
+
+def _count_lines(log_file):
+    """
+    Devolve o número de linhas do log (chamar com o lock obtido). Garante também que o ficheiro
+    termina numa quebra de linha, para que uma escrita interrompida não corrompa a linha acrescentada a seguir.
+    """
+    count, counted_size = _line_counts.get(log_file, (0, 0))
+    try:
+        f = open(log_file, "rb+")
+    except FileNotFoundError:
+        _line_counts[log_file] = (0, 0)
+        return 0
+    with f:
+        size = f.seek(0, os.SEEK_END)
+        if size < counted_size or log_file not in _line_counts:
+            count, counted_size = 0, 0
+        if size != counted_size:
+            f.seek(counted_size)
+            count += sum(1 for line in f if line.strip())
+            f.seek(size - 1)
+            if f.read(1) != b"\n":
+                f.seek(0, os.SEEK_END)
+                f.write(b"\n")
+                size += 1
+    _line_counts[log_file] = (count, size)
+    return count
+
+def compact_log(log_file, max_entries):
+    """Reescreve o log só com as últimas 'max_entries' anomalias (ficheiro temporário + substituição)."""
+    entries = deque(iter_log(log_file), maxlen=max_entries)
+    tmp_path = log_file + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        for entry in entries:
+            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+    os.replace(tmp_path, log_file)
+    _line_counts[log_file] = (len(entries), os.path.getsize(log_file))
+
+def _legacy_first_seen(entry, now):
+    # As entradas do formato antigo não têm first_seen: usa o timestamp da anomalia (se for uma data)
+    try:
+        return datetime.fromisoformat(str(entry.get("timestamp"))).isoformat(timespec="seconds")
+    except ValueError:
+        return now
+
+def _migrate_legacy_log(log_file, index, now):
+    """
+    Converte (uma única vez) o log no formato antigo para JSON Lines e regista as suas anomalias no índice,
+    para que não voltem a ser escritas. As entradas sem first_seen recebem o seu timestamp (a rotação diária
+    do log crítico depende dele). O ficheiro antigo é mantido com a extensão '.migrated'.
+    Devolve True se o log foi migrado (e o índice alterado).
+    """
+    legacy_file, key = LEGACY_LOG_FILES[log_file]
+    if os.path.exists(log_file) or not os.path.exists(legacy_file):
+        return False
     try:
-        with open(CRITICAL_LOG_FILE, "r", encoding="utf-8") as f:
-            data = json.load(f)
+        with open(legacy_file, "r", encoding="utf-8") as f:
+            entries = json.load(f).get(key, [])
     except Exception:
-        init_critical_log_file()
-        with open(CRITICAL_LOG_FILE, "r", encoding="utf-8") as f:
-            data = json.load(f)
-    crit_anomalies = data.get("critical_anomalies", [])
-    while len(crit_anomalies) >= CRITICAL_MAX_ENTRIES:
-        crit_anomalies.pop(0)
-    crit_anomalies.append(serialize_anomaly(anomaly))
-    data["critical_anomalies"] = crit_anomalies
-    with open(CRITICAL_LOG_FILE, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+        entries = []
+    with open(log_file, "w", encoding="utf-8") as f:
+        for entry in entries:
+            fingerprint = entry.get("fingerprint") or anomaly_fingerprint(entry)
+            entry.setdefault("first_seen", _legacy_first_seen(entry, now))
+            index.setdefault(fingerprint, {"first_seen": entry["first_seen"], "last_seen": now, "count": 1})
+            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+    os.replace(legacy_file, legacy_file + ".migrated")
+    _line_counts.pop(log_file, None)
+    return True
+
+def list_critical_archives():
+    """Devolve os arquivos do log crítico (comprimidos ou não), do mais antigo para o mais recente."""
+    if not os.path.isdir(CRITICAL_ARCHIVE_FOLDER):
+        return []
+    names = [name for name in os.listdir(CRITICAL_ARCHIVE_FOLDER) if _ARCHIVE_NAME.match(name)]
+    return [os.path.join(CRITICAL_ARCHIVE_FOLDER, name) for name in sorted(names)]
+
+def iter_archive(path):
+    """Lê as anomalias de um log ou arquivo: JSON Lines (comprimido ou não) ou o formato JSON antigo."""
+    if not re.search(r"\.json(\.gz)?$", path):
+        yield from iter_log(path)
+        return
+    with _open_text(path) as f:
+        data = json.load(f)
+    for key in ("anomalies", "critical_anomalies"):
+        yield from data.get(key, [])
+
+def iter_critical_history(since=None):
+    """
+    Lê todo o histórico crítico (arquivos e log atual) em streaming, descomprimindo os arquivos.
+    Com 'since' (datetime), só devolve as anomalias registadas a partir dessa data e não lê os arquivos
+    de dias anteriores (com um dia de margem para os arquivos antigos, que têm a data do arquivo).
+    """
+    since_iso = since.isoformat() if since else ""
+    oldest_name = ARCHIVE_PREFIX + (since - timedelta(days=1)).strftime("%Y_%m_%d") if since else ""
+    archives = [path for path in list_critical_archives() if os.path.basename(path)[:len(oldest_name)] >= oldest_name]
+    for path in archives + [CRITICAL_LOG_FILE]:
+        for entry in iter_archive(path):
+            if (entry.get("first_seen") or entry.get("timestamp") or "") >= since_iso:
+                yield entry
+
+def _oldest_entry_date(log_file):
+    """
+    Data (YYYY-MM-DD) em que foi registada a primeira anomalia do log, ou None se estiver vazio.
+    Sem first_seen (entradas antigas), usa o timestamp da anomalia, tal como iter_critical_history.
+    """
+    try:
+        with open(log_file, "r", encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        return None
+                    date = str(entry.get("first_seen") or entry.get("timestamp") or "")[:10]
+                    return date if _DATE.match(date) else None
+    except FileNotFoundError:
+        pass
+    return None
+
+def _detach_critical_log():
+    """
+    Move o log crítico (com o lock obtido) para a pasta de arquivo, ainda sem compressão, e reinicializa-o.
+    Devolve o caminho do ficheiro movido, ou None se o log estiver vazio.
+    """
+    if not os.path.exists(CRITICAL_LOG_FILE) or os.path.getsize(CRITICAL_LOG_FILE) == 0:
+        _reset_log(CRITICAL_LOG_FILE)
+        return None
+    date_str = (_oldest_entry_date(CRITICAL_LOG_FILE) or datetime.now().date().isoformat()).replace("-", "_")
+    os.makedirs(CRITICAL_ARCHIVE_FOLDER, exist_ok=True)
+    base = os.path.join(CRITICAL_ARCHIVE_FOLDER, ARCHIVE_PREFIX + date_str)
+    path, n = base + ".jsonl", 1
+    while os.path.exists(path) or os.path.exists(path + ".gz"):
+        n += 1
+        path = f"{base}_{n}.jsonl"
+    shutil.move(CRITICAL_LOG_FILE, path)
+    _reset_log(CRITICAL_LOG_FILE)
+    return path
+
+def compress_archive(path):
+    """Comprime um arquivo (gzip em streaming, ficheiro temporário + substituição) e apaga o original."""
+    tmp_path = f"{path}.gz.{os.getpid()}.tmp"
+    try:
+        with open(path, "rb") as src, gzip.open(tmp_path, "wb") as dest:
+            shutil.copyfileobj(src, dest, 1024 * 1024)
+        os.replace(tmp_path, path + ".gz")
+        os.remove(path)
+    except FileNotFoundError:
+        # Outro processo já comprimiu este arquivo
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    except Exception as e:
+        print(f"Erro ao comprimir o arquivo {path}: {type(e).__name__} - {e}")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def apply_archive_retention():
+    """
+    Comprime os arquivos que ficaram por comprimir e apaga os arquivos com mais de CRITICAL_ARCHIVE_RETENTION_DAYS
+    dias; se o total continuar acima de CRITICAL_ARCHIVE_MAX_BYTES, apaga os mais antigos.
+    """
+    for path in list_critical_archives():
+        if path.endswith(".jsonl"):
+            compress_archive(path)
+    oldest = (datetime.now() - timedelta(days=CRITICAL_ARCHIVE_RETENTION_DAYS)).strftime("%Y_%m_%d")
+    archives = []
+    for path in list_critical_archives():
+        try:
+            size = os.path.getsize(path)
+        except FileNotFoundError:
+            continue
+        if os.path.basename(path)[len(ARCHIVE_PREFIX):][:10] < oldest:
+            _remove_archive(path)
+        else:
+            archives.append((path, size))
+    total = sum(size for _, size in archives)
+    for path, size in archives:
+        if total <= CRITICAL_ARCHIVE_MAX_BYTES:
+            break
+        _remove_archive(path)
+        total -= size
+
+def _remove_archive(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+def _finish_rotation(paths):
+    for path in paths:
+        compress_archive(path)
+    if paths:
+        apply_archive_retention()
+
+def record_anomalies(log_file, anomalies, max_entries, rotate=False):
+    """
+    Regista um lote de anomalias num log JSON Lines, acrescentando apenas as linhas novas:
+    - as anomalias novas (fingerprint desconhecido) são acrescentadas com fingerprint e first_seen;
+    - as já registadas não são repetidas: o last_seen e o contador são atualizados no índice
+      (uma vez por dia); o índice só é regravado se mudou;
+    - quando o log ultrapassa 'max_entries' em COMPACTION_SLACK entradas, é compactado;
+    - com 'rotate' (log crítico), o log é arquivado em vez de compactado: antes da escrita, se tiver
+      anomalias de um dia anterior, e depois, se exceder CRITICAL_ROTATE_MAX_BYTES ou o número de entradas;
+    - com USE_ANOMALY_STORE, as anomalias novas são também gravadas na base SQLite (anomaly_store).
+    O lote é escrito com o lock do log obtido (threads e processos), numa única escrita.
+    Devolve o número de anomalias novas.
+    """
+    if not anomalies:
+        return 0
+    now = datetime.now().isoformat(timespec="seconds")
+    with file_lock(log_file):
+        index = load_anomaly_index(log_file)
+        try:
+            index_changed = _migrate_legacy_log(log_file, index, now)
+            lines, new_entries, rotated = _record_batch(log_file, index, anomalies, max_entries, rotate, now,
+                                                        index_changed)
+        except BaseException:
+            discard_anomaly_index(log_file)
+            raise
+
+    # A compressão e a retenção dos arquivos são feitas sem bloquear os outros escritores
+    _finish_rotation([path for path in rotated if path])
+
+    if new_entries and USE_ANOMALY_STORE:
+        # O histórico SQLite tem o seu próprio controlo de concorrência (WAL); uma falha não afeta os logs
+        from anomaly_store import LOG_NAMES, store_anomalies
+        try:
+            store_anomalies(new_entries, LOG_NAMES[log_file])
+        except Exception as e:
+            print(f"Erro ao gravar as anomalias no histórico SQLite: {type(e).__name__} - {e}")
+    return len(lines)
+
+def _record_batch(log_file, index, anomalies, max_entries, rotate, now, index_changed):
+    """Parte de record_anomalies feita com o lock do log obtido. Devolve (linhas, entradas novas, rodados)."""
+    rotated = []
+    if rotate and (_oldest_entry_date(log_file) or now[:10]) < now[:10]:
+        rotated.append(_detach_critical_log())
+
+    lines, new_entries = [], []
+    for anomaly in anomalies:
+        fingerprint = anomaly_fingerprint(anomaly)
+        seen = index.get(fingerprint)
+        if seen is not None:
+            if seen.get("last_seen", "")[:10] != now[:10]:
+                seen["last_seen"] = now
+                seen["count"] = seen.get("count", 1) + 1
+                index_changed = True
+            continue
+        entry = serialize_anomaly(anomaly)
+        entry["fingerprint"] = fingerprint
+        entry["first_seen"] = now
+        new_entries.append(entry)
+        lines.append(json.dumps(entry, ensure_ascii=False) + "\n")
+        index[fingerprint] = {"first_seen": now, "last_seen": now, "count": 1}
+        index_changed = True
+
+    if lines:
+        count = _count_lines(log_file) + len(lines)
+        with open(log_file, "a", encoding="utf-8") as f:
+            f.write("".join(lines))
+            f.flush()
+            os.fsync(f.fileno())
+            size = os.fstat(f.fileno()).st_size
+            _line_counts[log_file] = (count, size)
+        if rotate and (size > CRITICAL_ROTATE_MAX_BYTES or count > max_entries + COMPACTION_SLACK):
+            rotated.append(_detach_critical_log())
+        elif count > max_entries + COMPACTION_SLACK:
+            compact_log(log_file, max_entries)
+    # Só é regravado se houver fingerprints novos ou um last_seen de um novo dia (não em cada lote)
+    if index_changed:
+        save_anomaly_index(log_file, index)
+    return lines, new_entries, rotated
+
+def add_anomaly_to_log(anomaly):
+    """Adiciona uma única anomalia ao log geral (se ainda não estiver registada)."""
+    log_anomalies([anomaly])
+
+def log_anomalies(anomalies):
+    """Registra as anomalias ainda não conhecidas no log geral (ver record_anomalies)."""
+    return record_anomalies(LOG_FILE, anomalies, MAX_ENTRIES)
+
+def add_critical_anomaly_to_log(anomaly):
+    """Adiciona uma única anomalia crítica ao log crítico (se ainda não estiver registada)."""
+    record_anomalies(CRITICAL_LOG_FILE, [anomaly], CRITICAL_MAX_ENTRIES, rotate=True)
 
 def log_critical_anomalies(anomalies):
-    """Registra as anomalias críticas (level==0) no log crítico JSON."""
+    """Registra as anomalias críticas (level==0) ainda não conhecidas no log crítico."""
     crit = [anom for anom in anomalies if int(anom.get("level", 1)) == 0]
-    for anomaly in crit:
-        add_critical_anomaly_to_log(anomaly)
+    return record_anomalies(CRITICAL_LOG_FILE, crit, CRITICAL_MAX_ENTRIES, rotate=True)
 
 def archive_critical_log():
     """
-    Move o log crítico JSON atual para a pasta definida em CRITICAL_ARCHIVE_FOLDER 
-    com o nome contendo a data no formato YYYY_MM_DD e reinicializa-o.
+    Arquiva o log crítico atual na pasta definida em CRITICAL_ARCHIVE_FOLDER, comprimido e com o nome
+    contendo a data (YYYY_MM_DD) da anomalia mais antiga, reinicializa-o e aplica a retenção dos arquivos.
     """
-    if not os.path.exists(CRITICAL_LOG_FILE):
-        init_critical_log_file()
-        return
-    archive_folder = CRITICAL_ARCHIVE_FOLDER
-    if not os.path.exists(archive_folder):
-        os.makedirs(archive_folder)
-    date_str = datetime.now().strftime("%Y_%m_%d")
-    archive_file = os.path.join(archive_folder, f"critical_anomaly_history_{date_str}.json")
-    shutil.move(CRITICAL_LOG_FILE, archive_file)
-    init_critical_log_file()
+    with file_lock(CRITICAL_LOG_FILE):
+        # As anomalias do log antigo (se ainda não foi migrado) entram no índice, para não voltarem a ser escritas
+        index = load_anomaly_index(CRITICAL_LOG_FILE)
+        try:
+            if _migrate_legacy_log(CRITICAL_LOG_FILE, index, datetime.now().isoformat(timespec="seconds")):
+                save_anomaly_index(CRITICAL_LOG_FILE, index)
+        except BaseException:
+            discard_anomaly_index(CRITICAL_LOG_FILE)
+            raise
+        path = _detach_critical_log()
+    _finish_rotation([path] if path else [])
@@ -0,0 +1,245 @@
+import os
+import json
+import sqlite3
+import argparse
+from datetime import datetime, timedelta
+from anomaly_log import (LOG_FILE, CRITICAL_LOG_FILE, LEGACY_LOG_FILES, anomaly_fingerprint, serialize_anomaly,
+                         iter_archive, list_critical_archives)
+from config import ANOMALY_DB_FILE, ANOMALY_DB_TIMEOUT_SECONDS
+
+# Histórico de anomalias numa base SQLite (modo WAL: várias leituras em simultâneo com a escrita).
+# Cada anomalia nova registada em anomaly_log é também gravada aqui, sem limite de entradas nem arquivo
+# diário, com índices por instância, base de dados, tipo, nível e timestamp para as consultas de auditoria.
+# Uso na linha de comandos:
+#   python anomaly_store.py query --instance SRV01 --level 0 --days 90
+#   python anomaly_store.py stats --by instance type --days 30
+#   python anomaly_store.py import [ficheiros ...]
+
+LOG_GENERAL = "general"
+LOG_CRITICAL = "critical"
+LOG_NAMES = {LOG_FILE: LOG_GENERAL, CRITICAL_LOG_FILE: LOG_CRITICAL}
+
+# Colunas pelas quais se pode agrupar ("day" é a data do timestamp)
+GROUP_COLUMNS = ("log", "instance", "database", "type", "level", "user", "day")
+
+# As colunas de texto usadas nos filtros comparam sem distinguir maiúsculas (tal como os nomes no SQL Server)
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS anomalies (
+    id          INTEGER PRIMARY KEY,
+    log         TEXT NOT NULL,
+    fingerprint TEXT NOT NULL,
+    instance    TEXT COLLATE NOCASE,
+    database    TEXT COLLATE NOCASE,
+    type        TEXT COLLATE NOCASE,
+    device      TEXT,
+    user        TEXT COLLATE NOCASE,
+    level       INTEGER,
+    timestamp   TEXT,
+    issues      TEXT,
+    first_seen  TEXT,
+    UNIQUE (log, fingerprint)
+);
+CREATE INDEX IF NOT EXISTS ix_anomalies_instance ON anomalies (instance, timestamp);
+CREATE INDEX IF NOT EXISTS ix_anomalies_database ON anomalies (database, timestamp);
+CREATE INDEX IF NOT EXISTS ix_anomalies_type ON anomalies (type);
+CREATE INDEX IF NOT EXISTS ix_anomalies_level ON anomalies (level, timestamp);
+CREATE INDEX IF NOT EXISTS ix_anomalies_timestamp ON anomalies (timestamp);
+"""
+
+_INSERT = """
+INSERT OR IGNORE INTO anomalies
+    (log, fingerprint, instance, database, type, device, user, level, timestamp, issues, first_seen)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+def connect(db_file=ANOMALY_DB_FILE):
+    """Abre a base de dados do histórico (criando as tabelas e os índices se necessário)."""
+    conn = sqlite3.connect(db_file, timeout=ANOMALY_DB_TIMEOUT_SECONDS)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.executescript(_SCHEMA)
+    return conn
+
+def _to_row(log, anomaly):
+    entry = serialize_anomaly(anomaly)
+    try:
+        level = int(entry.get("level", 1))
+    except (TypeError, ValueError):
+        level = None
+    return (
+        log,
+        entry.get("fingerprint") or anomaly_fingerprint(anomaly),
+        entry.get("instance"),
+        entry.get("database"),
+        entry.get("type"),
+        entry.get("device"),
+        entry.get("user"),
+        level,
+        entry.get("timestamp"),
+        json.dumps(entry.get("issues", []), ensure_ascii=False),
+        entry.get("first_seen"),
+    )
+
+def store_anomalies(anomalies, log=LOG_GENERAL, db_file=ANOMALY_DB_FILE):
+    """
+    Grava um lote de anomalias numa única transação. As anomalias já existentes (mesmo log e fingerprint)
+    são ignoradas. Devolve o número de anomalias novas.
+    """
+    if not anomalies:
+        return 0
+    conn = connect(db_file)
+    try:
+        with conn:
+            before = conn.total_changes
+            conn.executemany(_INSERT, [_to_row(log, anomaly) for anomaly in anomalies])
+            return conn.total_changes - before
+    finally:
+        conn.close()
+
+def _where(filters):
+    """Constrói a cláusula WHERE (com parâmetros) a partir dos filtros indicados."""
+    clauses, params = [], []
+    for column in ("log", "instance", "database", "type", "user"):
+        value = filters.get(column)
+        if value is not None:
+            clauses.append(f"{column} = ?")
+            params.append(value)
+    if filters.get("level") is not None:
+        clauses.append("level = ?")
+        params.append(int(filters["level"]))
+    for key, op in (("since", ">="), ("until", "<")):
+        value = filters.get(key)
+        if value is not None:
+            clauses.append(f"timestamp {op} ?")
+            params.append(value.isoformat() if isinstance(value, datetime) else str(value))
+    return (" WHERE " + " AND ".join(clauses) if clauses else ""), params
+
+def query_anomalies(limit=None, db_file=ANOMALY_DB_FILE, **filters):
+    """
+    Devolve as anomalias (dicionários, das mais recentes para as mais antigas) que cumprem os filtros:
+    log, instance, database, type, user, level, since e until (datetime ou texto ISO).
+    """
+    where, params = _where(filters)
+    sql = f"SELECT * FROM anomalies{where} ORDER BY timestamp DESC"
+    if limit:
+        sql += " LIMIT ?"
+        params.append(int(limit))
+    conn = connect(db_file)
+    try:
+        result = []
+        for row in conn.execute(sql, params):
+            anomaly = dict(row)
+            anomaly["issues"] = json.loads(anomaly["issues"] or "[]")
+            result.append(anomaly)
+        return result
+    finally:
+        conn.close()
+
+def count_anomalies(group_by=("instance",), db_file=ANOMALY_DB_FILE, **filters):
+    """
+    Conta as anomalias que cumprem os filtros (ver query_anomalies), agrupadas pelas colunas indicadas
+    (GROUP_COLUMNS; "day" agrupa pela data do timestamp). Devolve uma lista de dicionários com "count",
+    ordenada pela contagem.
+    """
+    for column in group_by:
+        if column not in GROUP_COLUMNS:
+            raise ValueError(f"Coluna de agrupamento inválida: {column}")
+    columns = ["substr(timestamp, 1, 10) AS day" if column == "day" else column for column in group_by]
+    where, params = _where(filters)
+    select = ", ".join(columns + ["COUNT(*) AS count", "MAX(timestamp) AS last_timestamp"])
+    sql = f"SELECT {select} FROM anomalies{where}"
+    if group_by:
+        sql += f" GROUP BY {', '.join(group_by)}"
+    sql += " ORDER BY count DESC"
+    conn = connect(db_file)
+    try:
+        return [dict(row) for row in conn.execute(sql, params)]
+    finally:
+        conn.close()
+
+def _log_name(path):
+    name = os.path.basename(path)
+    return LOG_CRITICAL if name.startswith("critical_") else LOG_GENERAL
+
+def default_import_files():
+    """Logs atuais, logs no formato antigo (ainda não migrados) e arquivos diários do log crítico."""
+    candidates = [LOG_FILE, CRITICAL_LOG_FILE]
+    candidates += [legacy for legacy, _ in LEGACY_LOG_FILES.values()]
+    candidates += [legacy + ".migrated" for legacy, _ in LEGACY_LOG_FILES.values()]
+    candidates += list_critical_archives()
+    return [path for path in candidates if os.path.isfile(path)]
+
+def import_json_archives(paths=None, db_file=ANOMALY_DB_FILE):
+    """
+    Importa para a base SQLite os logs e arquivos JSON existentes, comprimidos ou não (por omissão,
+    default_import_files).
+    O log de cada ficheiro é deduzido do nome ("critical_..." -> crítico). Pode ser repetido sem duplicar
+    anomalias. Devolve {ficheiro: anomalias novas}.
+    """
+    result = {}
+    for path in paths if paths is not None else default_import_files():
+        try:
+            result[path] = store_anomalies(list(iter_archive(path)), _log_name(path.replace(".migrated", "")), db_file)
+        except Exception as e:
+            print(f"Erro ao importar {path}: {type(e).__name__} - {e}")
+    return result
+
+def _filters_from_args(args):
+    since = datetime.now() - timedelta(days=args.days) if args.days else args.since
+    return {"log": args.log, "instance": args.instance, "database": args.database, "type": args.type,
+            "user": args.user, "level": args.level, "since": since, "until": args.until}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Consulta do histórico de anomalias (SQLite)")
+    parser.add_argument("--db", default=ANOMALY_DB_FILE, help="ficheiro da base de dados")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    def add_filters(command):
+        command.add_argument("--log", choices=(LOG_GENERAL, LOG_CRITICAL))
+        command.add_argument("--instance")
+        command.add_argument("--database")
+        command.add_argument("--type")
+        command.add_argument("--user")
+        command.add_argument("--level", type=int)
+        command.add_argument("--days", type=int, help="só as anomalias dos últimos N dias")
+        command.add_argument("--since", help="data/hora ISO inicial (inclusive)")
+        command.add_argument("--until", help="data/hora ISO final (exclusive)")
+
+    query = commands.add_parser("query", help="lista as anomalias")
+    add_filters(query)
+    query.add_argument("--limit", type=int, default=100)
+    query.add_argument("--json", action="store_true", help="escreve o resultado em JSON")
+
+    stats = commands.add_parser("stats", help="contagens agrupadas")
+    add_filters(stats)
+    stats.add_argument("--by", nargs="+", default=["instance"], choices=GROUP_COLUMNS)
+
+    importer = commands.add_parser("import", help="importa logs e arquivos JSON")
+    importer.add_argument("paths", nargs="*", help="ficheiros a importar (por omissão, logs e arquivos)")
+
+    args = parser.parse_args(argv)
+
+    if args.command == "import":
+        result = import_json_archives(args.paths or None, args.db)
+        for path, added in result.items():
+            print(f"{path}: {added} anomalias novas")
+        print(f"Total importado: {sum(result.values())}")
+    elif args.command == "query":
+        anomalies = query_anomalies(args.limit, args.db, **_filters_from_args(args))
+        if args.json:
+            print(json.dumps(anomalies, indent=2, ensure_ascii=False))
+            return
+        for anomaly in anomalies:
+            print(f"{anomaly['timestamp']}  [{anomaly['log']}/{anomaly['level']}]  {anomaly['instance']}  "
+                  f"{anomaly['database']}  {anomaly['type']}  - {'; '.join(anomaly['issues'])}")
+        print(f"\n{len(anomalies)} anomalias")
+    else:
+        rows = count_anomalies(args.by, args.db, **_filters_from_args(args))
+        for row in rows:
+            group = "  ".join(f"{column}={row[column]}" for column in args.by)
+            print(f"{row['count']:>8}  {group}  (última: {row['last_timestamp']})")
+        print(f"\n{sum(row['count'] for row in rows)} anomalias")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,188 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait as wait_futures
+from db_utils import acquire_connection, release_connection, get_user_databases
+from check_registry import (CHECK_REGISTRY, SCOPE_DATABASE, DATASET_BACKUPS, CheckContext, resolve_checks,
+                            load_datasets, load_changed_datasets, evaluate_check)
+from check_state import CheckState
+from anomaly_log import log_anomalies, log_critical_anomalies
+from server_manager import read_server_list
+from config import ASYNC_MAX_CONCURRENT_SERVERS, ASYNC_SERVER_DEADLINE_SECONDS, ASYNC_EXECUTOR_WORKERS
+
+PRINT_LOCK = threading.Lock()
+
+def load_instance_data(cursor, server, specs):
+    """
+    Lê (numa thread do executor) o nome da instância, as bases de dados e os conjuntos de dados
+    de que as verificações precisam (cada um uma única vez). Os conjuntos derivados só são calculados
+    para as bases cujo resultado não é reutilizado (check_state). Devolve (instance, databases, data, state).
+    """
+    instance = server
+    try:
+        cursor.execute("SELECT @@SERVERNAME")
+        result = cursor.fetchone()
+        if result and result[0]:
+            instance = result[0]
+    except Exception as e:
+        with PRINT_LOCK:
+            print(f"Não foi possível obter o nome da instância no servidor {server}: {e}")
+    databases = get_user_databases(cursor)
+    state = CheckState(instance)
+    # O histórico é distribuído por várias threads: não pode ser consumido em streaming
+    data = load_datasets(specs, cursor, instance, allow_streaming=False, derived=False)
+    load_changed_datasets(specs, CheckContext(cursor, instance, data), databases, state)
+    return instance, databases, data, state
+
+def run_database_check(spec, ctx, db, backups, cursor_lock, cancelled, state=None):
+    """Executa (numa thread do executor) a verificação escolhida para uma base de dados."""
+    if cancelled.is_set():
+        return []
+    # As verificações que fazem queries não podem usar o cursor de uma conexão em duas threads ao mesmo tempo
+    if spec.uses_cursor:
+        with cursor_lock:
+            if cancelled.is_set():
+                return []
+            anomalias = evaluate_check(spec, ctx, db, backups, state)
+    else:
+        anomalias = evaluate_check(spec, ctx, db, backups, state)
+    for anomalia in anomalias:
+        anomalia["instance"] = ctx.instance
+    return anomalias
+
+def release_if_acquired(future):
+    """Callback: descarta a conexão de um servidor cujo processamento já foi cancelado."""
+    if not future.cancelled() and future.exception() is None:
+        release_connection(future.result(), discard=True)
+
+def release_when_done(conn, futures):
+    """Devolve a conexão ao pool só depois de terminarem as tarefas que ainda a usam (após cancelamento)."""
+    wait_futures(futures)
+    release_connection(conn, discard=True)
+
+async def check_server(srv, opcao, executor):
+    """
+    Processa um servidor: liga-se (pool), lê os dados da instância e agenda uma tarefa por base de dados.
+    Devolve (instance, anomalias). Se for cancelada (deadline), as tarefas pendentes são abandonadas
+    e a conexão é descartada assim que as threads em curso terminarem.
+    """
+    server = srv["server"]
+    spec, = resolve_checks([opcao])
+    cancelled = threading.Event()
+    acquire_future = executor.submit(acquire_connection, server, srv["username"], srv["password"])
+    try:
+        conn = await asyncio.wrap_future(acquire_future)
+    except asyncio.CancelledError:
+        # A ligação pode ainda estar a ser estabelecida: devolve-a ao pool quando terminar
+        acquire_future.add_done_callback(release_if_acquired)
+        raise
+
+    pending = []
+    try:
+        cursor = conn.cursor()
+        load_future = executor.submit(load_instance_data, cursor, server, [spec])
+        pending.append(load_future)
+        instance, databases, data, state = await asyncio.wrap_future(load_future)
+        with PRINT_LOCK:
+            print(f"Instância {instance}: {len(databases)} bases de dados encontradas. A executar funcionalidades...")
+
+        ctx = CheckContext(cursor, instance, data)
+        backups_by_db = data.get(DATASET_BACKUPS) or {}
+        cursor_lock = threading.Lock()
+        check_futures = [executor.submit(run_database_check, spec, ctx, db, backups_by_db.get(db), cursor_lock,
+                                         cancelled, state)
+                         for db in databases]
+        pending.extend(check_futures)
+        results = await asyncio.gather(*(asyncio.wrap_future(f) for f in check_futures))
+        await asyncio.wrap_future(executor.submit(state.save))
+        return instance, [anomalia for anomalias in results for anomalia in anomalias]
+    except asyncio.CancelledError:
+        cancelled.set()
+        executor.submit(release_when_done, conn, pending)
+        conn = None
+        raise
+    finally:
+        if conn is not None:
+            release_connection(conn)
+
+async def check_server_with_deadline(srv, opcao, executor, semaphore):
+    """
+    Limita o número de servidores em curso e aplica o deadline por servidor.
+    Devolve (instance, anomalias), ou (server, None) se o servidor falhou ou foi cancelado.
+    """
+    server = srv["server"]
+    async with semaphore:
+        with PRINT_LOCK:
+            print(f"\n=== A ligar ao servidor: {server} ===")
+        try:
+            return await asyncio.wait_for(check_server(srv, opcao, executor), ASYNC_SERVER_DEADLINE_SECONDS)
+        except asyncio.TimeoutError:
+            with PRINT_LOCK:
+                print(f"Servidor {server} cancelado: excedeu o limite de {ASYNC_SERVER_DEADLINE_SECONDS} segundos.")
+        except Exception as e:
+            with PRINT_LOCK:
+                print(f"Erro ao ligar ao servidor {server}: {type(e).__name__} - {e}")
+        return server, None
+
+def print_instance_report(instance, anomalias):
+    with PRINT_LOCK:
+        if anomalias:
+            print(f"\n{'=' * 40}\nRelatório de Anomalias para a instância {instance}\n{'=' * 40}")
+            for idx, anomalia in enumerate(anomalias, 1):
+                print(f"\n{idx}. Base de Dados: {anomalia.get('database', 'N/A')}")
+                print(f"   Tipo de Backup: {anomalia.get('type', 'N/A')}")
+                print(f"   Dispositivo: {anomalia.get('device', 'N/A')}")
+                print(f"   Utilizador: {anomalia.get('user', 'N/A')}")
+                print(f"   Instância: {anomalia.get('instance', 'N/A')}")
+                print(f"   Timestamp: {anomalia.get('timestamp', 'N/A')}")
+                print("   Problemas detectados:")
+                for issue in set(anomalia.get('issues', [])):
+                    print(f"    - {issue}")
+            print(f"\nTotal de anomalias: {len(anomalias)}")
+        else:
+            print(f"\nNenhuma anomalia encontrada na instância {instance}.")
+
+async def run_fleet(opcao, servers):
+    """
+    Executa a verificação escolhida em todos os servidores com asyncio:
+    - no máximo ASYNC_MAX_CONCURRENT_SERVERS servidores em simultâneo;
+    - cada servidor tem ASYNC_SERVER_DEADLINE_SECONDS segundos para terminar (depois é cancelado);
+    - as chamadas bloqueantes do pyodbc correm num executor dedicado de ASYNC_EXECUTOR_WORKERS threads;
+    - o relatório de cada instância é mostrado assim que esta termina.
+    Devolve a lista com todas as anomalias encontradas.
+    """
+    semaphore = asyncio.Semaphore(ASYNC_MAX_CONCURRENT_SERVERS)
+    executor = ThreadPoolExecutor(max_workers=ASYNC_EXECUTOR_WORKERS, thread_name_prefix="fleet")
+    all_anomalias = []
+    try:
+        tasks = [asyncio.ensure_future(check_server_with_deadline(srv, opcao, executor, semaphore))
+                 for srv in servers]
+        for finished in asyncio.as_completed(tasks):
+            instance, anomalias = await finished
+            if anomalias is None:
+                continue
+            print_instance_report(instance, anomalias)
+            all_anomalias.extend(anomalias)
+    finally:
+        # Não espera pelas threads de servidores cancelados (ex.: ligações presas no timeout)
+        executor.shutdown(wait=False)
+    return all_anomalias
+
+def run_multiserver_functionality_async(opcao):
+    """
+    Alternativa assíncrona a main.run_multiserver_functionality (ativada com USE_ASYNC_RUNNER em config.py).
+    Os logs são escritos uma única vez no fim, com as anomalias de todos os servidores.
+    """
+    if opcao not in CHECK_REGISTRY or CHECK_REGISTRY[opcao].scope != SCOPE_DATABASE:
+        print("Opção inválida!")
+        return
+    servers = read_server_list()
+    if not servers:
+        print("Nenhum servidor definido no ficheiro 'servers.txt'.")
+        return
+
+    all_anomalias = asyncio.run(run_fleet(opcao, servers))
+    print(f"\nTotal geral de anomalias: {len(all_anomalias)}")
+
+    log_anomalies(all_anomalias)
+    critical_anomalias = [anomalia for anomalia in all_anomalias if int(anomalia.get("level", 1)) == 0]
+    log_critical_anomalies(critical_anomalias)
@@ -0,0 +1,159 @@
+from collections import namedtuple
+from datetime import datetime, timedelta
+from user_whitelist import get_whitelist_matcher
+from config import BACKUP_DATE_THRESHOLD_WEEKS, BACKUP_LAST_HOURS, BACKUP_INTERVAL_HOURS
+
+# Análise vetorizada (NumPy) do histórico de backups de uma instância inteira.
+# Produz as mesmas anomalias que check_backup_frequency (funcionalidade 2) e check_file_size
+# (funcionalidade 4), mas calcula-as para todas as bases de uma só vez, por segmentos de base de dados.
+# O NumPy é opcional: sem ele, as verificações continuam a ser feitas base a base.
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Histórico em colunas: uma posição por backup, agrupado por base de dados
+BackupArrays = namedtuple("BackupArrays", [
+    "databases",    # nomes das bases (o código de cada base é o índice nesta lista)
+    "instances",    # instance_name do primeiro backup de cada base (ou "Desconhecido")
+    "db_codes",     # int32: código da base de cada backup
+    "finish",       # datetime64[us]: backup_finish_date
+    "copy_only",    # bool: is_copy_only
+    "users",        # nomes distintos dos utilizadores (o código de cada utilizador é o índice)
+    "user_codes",   # int32: código do utilizador de cada backup
+    "size",         # float64: backup_size (NaN se desconhecido)
+    "backups",      # object: o Backup original (para construir as anomalias)
+])
+
+_EPOCH = datetime(1970, 1, 1)
+_MICROSECOND = timedelta(microseconds=1)
+_NAT = -2 ** 63   # valor int64 de NaT
+
+def is_available():
+    return np is not None
+
+def build_backup_arrays(backups_by_db, databases=None):
+    """
+    Converte o histórico {base: [Backup]} em arrays NumPy (uma única passagem pelos backups).
+    Se 'databases' for indicado, só essas bases são incluídas. As bases sem backups são ignoradas.
+    """
+    wanted = set(databases) if databases is not None else None
+    names, instances, counts, rows = [], [], [], []
+    for db, backups in backups_by_db.items():
+        if not backups or (wanted is not None and db not in wanted):
+            continue
+        names.append(db)
+        instances.append(getattr(backups[0], "instance_name", None) or "Desconhecido")
+        counts.append(len(backups))
+        rows.extend(backups)
+
+    n = len(rows)
+    user_index = {}
+    backups = np.empty(n, dtype=object)
+    backups[:] = rows
+    return BackupArrays(
+        databases=names,
+        instances=instances,
+        db_codes=np.repeat(np.arange(len(names), dtype=np.int32), counts),
+        # Microssegundos desde 1970 (bastante mais rápido do que converter cada datetime para datetime64)
+        finish=np.fromiter((_NAT if b.backup_finish_date is None else (b.backup_finish_date - _EPOCH) // _MICROSECOND
+                            for b in rows), dtype=np.int64, count=n).view("datetime64[us]"),
+        copy_only=np.fromiter((bool(b.is_copy_only) for b in rows), dtype=bool, count=n),
+        user_codes=np.fromiter((user_index.setdefault(b.user_name or "", len(user_index)) for b in rows),
+                               dtype=np.int32, count=n),
+        users=list(user_index),
+        size=np.fromiter((np.nan if b.backup_size is None else float(b.backup_size) for b in rows),
+                         dtype=np.float64, count=n),
+        backups=backups,
+    )
+
+def authorized_user_mask(arrays):
+    """
+    Aplica a whitelist uma vez por utilizador distinto (e não por backup) e devolve,
+    para cada backup, se foi feito por um utilizador autorizado (case insensitive).
+    """
+    is_authorized = get_whitelist_matcher()
+    by_user = np.fromiter((is_authorized(user) for user in arrays.users), dtype=bool, count=len(arrays.users))
+    return by_user[arrays.user_codes]
+
+def check_backup_frequency_vectorized(arrays, now=None):
+    """
+    Funcionalidade 2 (vetorizada) para todas as bases de uma vez. Devolve {base: [anomalias]}
+    com as mesmas anomalias (e pela mesma ordem) que check_backup_frequency:
+    - nenhum backup autorizado;
+    - último backup autorizado há mais de BACKUP_LAST_HOURS horas;
+    - intervalos entre backups autorizados consecutivos superiores a BACKUP_INTERVAL_HOURS.
+    """
+    now = now or datetime.now()
+    result = {db: [] for db in arrays.databases}
+
+    # Backups autorizados, ordenados por base e por data de fim (ordenação estável)
+    rows = np.flatnonzero(~arrays.copy_only & authorized_user_mask(arrays))
+    rows = rows[np.lexsort((arrays.finish[rows], arrays.db_codes[rows]))]
+    codes = arrays.db_codes[rows]
+    finish = arrays.finish[rows]
+
+    # Último backup autorizado de cada base: fim de cada segmento
+    segment_ends = np.flatnonzero(np.append(codes[1:] != codes[:-1], True)) if len(rows) else rows
+    last_finish = np.full(len(arrays.databases), np.datetime64("NaT"), dtype="datetime64[us]")
+    last_finish[codes[segment_ends]] = finish[segment_ends]
+    has_authorized = np.zeros(len(arrays.databases), dtype=bool)
+    has_authorized[codes] = True
+    stale = last_finish < np.datetime64(now - timedelta(hours=BACKUP_LAST_HOURS), "us")
+
+    for code, db in enumerate(arrays.databases):
+        if not has_authorized[code]:
+            issue = f"Nenhum backup autorizado feito nas últimas {BACKUP_DATE_THRESHOLD_WEEKS} semana(s)"
+        elif stale[code]:
+            issue = f"Nenhum backup autorizado feito nas últimas {BACKUP_LAST_HOURS} horas"
+        else:
+            continue
+        result[db].append({
+            'database': db,
+            'device': '',
+            'user': '',
+            'instance': arrays.instances[code],
+            'type': 'General',
+            'issues': [issue],
+            'timestamp': now,
+            'reference': last_finish[code].item() if has_authorized[code] else None
+        })
+
+    # Intervalos entre backups consecutivos da mesma base
+    gaps = np.diff(finish)
+    long_gaps = np.flatnonzero((codes[1:] == codes[:-1]) & (gaps > np.timedelta64(BACKUP_INTERVAL_HOURS, "h")))
+    for i in long_gaps:
+        code = codes[i + 1]
+        curr = arrays.backups[rows[i + 1]]
+        result[arrays.databases[code]].append({
+            'database': arrays.databases[code],
+            'device': curr.physical_device_name,
+            'user': '',
+            'instance': arrays.instances[code],
+            'type': curr.backup_type,
+            'issues': [f'Intervalo demasiado longo: {str(gaps[i].item())}'],
+            'timestamp': curr.backup_finish_date
+        })
+    return result
+
+def check_file_size_vectorized(arrays, now=None):
+    """
+    Funcionalidade 4 (vetorizada) para todas as bases de uma vez. Devolve {base: [anomalias]}
+    com os backups não copy_only, das últimas BACKUP_DATE_THRESHOLD_WEEKS semanas, com tamanho 0.
+    """
+    now = now or datetime.now()
+    threshold_date = np.datetime64(now - timedelta(weeks=BACKUP_DATE_THRESHOLD_WEEKS), "us")
+    result = {db: [] for db in arrays.databases}
+    for row in np.flatnonzero(~arrays.copy_only & (arrays.finish >= threshold_date) & (arrays.size == 0)):
+        backup = arrays.backups[row]
+        db = arrays.databases[arrays.db_codes[row]]
+        result[db].append({
+            'database': db,
+            'device': backup.physical_device_name,
+            "user": backup.user_name,
+            "instance": backup.instance_name,
+            'type': backup.backup_type,
+            'issues': ["Tamanho do ficheiro é 0"],
+            'timestamp': backup.backup_finish_date
+        })
+    return result
@@ -1,6 +1,6 @@
 from datetime import datetime
-from user_whitelist import load_whitelist
-from revoke_backup_permissions import load_sysadmin_whitelist, remove_from_sysadmin_whitelist
+from user_whitelist import get_whitelist_matcher, get_sysadmin_whitelist_matcher
+from revoke_backup_permissions import remove_from_sysadmin_whitelist
 
 def check_authorized_users(database, backups):
     """
@@ -13,24 +13,23 @@ def check_authorized_users(database, backups):
     Nota: A filtragem por data agora é feita na query SQL.
     """
     anomalies = []
-    # Pré-processa as listas para evitar conversões repetitivas
-    allowed_prefixes = [prefix.lower() for prefix in load_whitelist()]
-    sysadmin_whitelist = [user.lower() for user in load_sysadmin_whitelist()]
+    # Whitelists compiladas e em cache (só são relidas quando os ficheiros mudam)
+    is_authorized = get_whitelist_matcher()
+    is_sysadmin_whitelisted = get_sysadmin_whitelist_matcher()
 
     for backup in backups:
         if backup.is_copy_only:
             continue
 
-        user_lower = backup.user_name.lower()
         # Verifica se o nome do utilizador começa com algum prefixo autorizado
-        if any(user_lower.startswith(prefix) for prefix in allowed_prefixes):
+        if is_authorized(backup.user_name):
             anomaly_level = 1
             issues = []
         else:
             anomaly_level = 0
             issues = ["Utilizador não autorizado"]
             # Se o utilizador estiver na sysadmin_whitelist, remove-o automaticamente.
-            if user_lower in sysadmin_whitelist:
+            if is_sysadmin_whitelisted(backup.user_name):
                 remove_from_sysadmin_whitelist(backup.user_name)
 
         if issues:
@@ -1,7 +1,8 @@
 from datetime import datetime, timedelta
-from user_whitelist import load_whitelist
+from user_whitelist import load_whitelist, get_whitelist_matcher
 import pyodbc
 from config import BACKUP_DATE_THRESHOLD_WEEKS, BACKUP_LAST_HOURS, BACKUP_INTERVAL_HOURS
+from db_utils import build_database_filters, MAX_QUERY_PARAMETERS, MAX_DATABASES_PER_QUERY
 
 def check_backup_frequency(database, backups):
     """
@@ -12,7 +13,7 @@ def check_backup_frequency(database, backups):
     """
     anomalies = []
     now = datetime.now()
-    allowed_prefixes = load_whitelist()
+    is_authorized = get_whitelist_matcher()
 
     # Uso o instance_name dos backups
     current_instance = (backups[0].instance_name
@@ -23,7 +24,7 @@ def check_backup_frequency(database, backups):
     filtered = [
         b for b in backups
         if (not b.is_copy_only)
-           and any(b.user_name.lower().startswith(prefix.lower()) for prefix in allowed_prefixes)
+           and is_authorized(b.user_name)
     ]
 
     if not filtered:
@@ -35,7 +36,8 @@ def check_backup_frequency(database, backups):
             'type': 'General',
             # Usa o BACKUP_DATE_THRESHOLD_WEEKS vindo do config (para exibição de semanas, se aplicável)
             'issues': [f"Nenhum backup autorizado feito nas últimas {BACKUP_DATE_THRESHOLD_WEEKS} semana(s)"],
-            'timestamp': now
+            'timestamp': now,
+            'reference': None
         })
         return anomalies
 
@@ -48,7 +50,9 @@ def check_backup_frequency(database, backups):
             'instance': current_instance,
             'type': 'General',
             'issues': [f"Nenhum backup autorizado feito nas últimas {BACKUP_LAST_HOURS} horas"],
-            'timestamp': now
+            'timestamp': now,
+            # Data do último backup autorizado: a anomalia só muda quando é feito um backup novo
+            'reference': max(b.backup_finish_date for b in filtered)
         })
 
     # Ordena os backups por backup_finish_date ascendente
@@ -71,3 +75,133 @@ def check_backup_frequency(database, backups):
             })
 
     return anomalies
+
+def check_backup_frequency_pushdown(cursor, databases=None):
+    """
+    Funcionalidade 2 (modo pushdown):
+    - Faz as mesmas verificações que check_backup_frequency, mas calcula-as no servidor:
+      o filtro da whitelist, o último backup autorizado (MAX) e os intervalos entre backups
+      consecutivos (LAG) são obtidos em T-SQL para todas as bases da instância de uma só vez.
+    - Só as violações são transferidas; devolve um dicionário {database: [anomalias]} com
+      anomalias iguais às geradas por check_backup_frequency.
+    """
+    now = datetime.now()
+    last_hours_limit = now - timedelta(hours=BACKUP_LAST_HOURS)
+    min_date = now - timedelta(weeks=BACKUP_DATE_THRESHOLD_WEEKS)
+    allowed_prefixes = [prefix.lower() for prefix in load_whitelist()]
+
+    # Cada query leva os prefixos, os nomes das bases do lote e 3 parâmetros fixos: o lote de bases
+    # é reduzido para não ultrapassar o limite de parâmetros do SQL Server
+    chunk_size = min(MAX_DATABASES_PER_QUERY, MAX_QUERY_PARAMETERS - len(allowed_prefixes) - 3)
+    if chunk_size < 1:
+        raise ValueError(f"A whitelist tem demasiados prefixos ({len(allowed_prefixes)}) para o cálculo no servidor; "
+                         f"desative BACKUP_FREQUENCY_PUSHDOWN.")
+
+    # Prefixos da whitelist como tabela derivada
+    if allowed_prefixes:
+        whitelist_sql = "SELECT prefix FROM (VALUES " + ", ".join("(?)" for _ in allowed_prefixes) + ") AS v(prefix)"
+    else:
+        whitelist_sql = "SELECT CAST(NULL AS nvarchar(256)) AS prefix WHERE 1 = 0"
+
+    query = """
+    WITH whitelist (prefix) AS (
+        {whitelist_sql}
+    ),
+    history AS (
+        SELECT
+            bs.database_name,
+            CASE bs.type
+                WHEN 'D' THEN 'Full backup'
+                WHEN 'I' THEN 'Differential'
+                WHEN 'L' THEN 'TLog'
+            END AS backup_type,
+            bs.backup_finish_date,
+            bmf.physical_device_name,
+            -- Igual a is_authorized (user_whitelist): o nome em minúsculas começa pelo prefixo (já em minúsculas).
+            -- A comparação é case insensitive (LOWER no nome, prefixos em minúsculas) e binária, independente da collation
+            -- do servidor; DATALENGTH / 2 conta os carateres do prefixo incluindo espaços finais (LEN ignora-os)
+            CASE WHEN bs.is_copy_only = 0 AND EXISTS (
+                    SELECT 1 FROM whitelist wl
+                    WHERE LEFT(LOWER(bs.user_name COLLATE Latin1_General_100_BIN2), DATALENGTH(wl.prefix) / 2)
+                          = wl.prefix COLLATE Latin1_General_100_BIN2
+                 ) THEN 1 ELSE 0 END AS is_authorized
+        FROM msdb.dbo.backupset bs
+        INNER JOIN msdb.dbo.backupmediafamily bmf
+            ON bs.media_set_id = bmf.media_set_id
+        WHERE {database_filter}
+          AND bs.backup_finish_date >= ?
+    ),
+    authorized AS (
+        SELECT
+            database_name,
+            backup_type,
+            backup_finish_date,
+            physical_device_name,
+            LAG(backup_finish_date) OVER (PARTITION BY database_name ORDER BY backup_finish_date) AS previous_finish_date
+        FROM history
+        WHERE is_authorized = 1
+    )
+    SELECT
+        database_name,
+        'SUMMARY' AS row_kind,
+        MAX(CASE WHEN is_authorized = 1 THEN backup_finish_date END) AS backup_finish_date,
+        NULL AS previous_finish_date,
+        NULL AS backup_type,
+        NULL AS physical_device_name,
+        @@SERVERNAME AS instance_name
+    FROM history
+    GROUP BY database_name
+    HAVING MAX(CASE WHEN is_authorized = 1 THEN backup_finish_date END) IS NULL
+        OR MAX(CASE WHEN is_authorized = 1 THEN backup_finish_date END) < ?
+    UNION ALL
+    SELECT
+        database_name,
+        'GAP',
+        backup_finish_date,
+        previous_finish_date,
+        backup_type,
+        physical_device_name,
+        @@SERVERNAME
+    FROM authorized
+    WHERE backup_finish_date > DATEADD(HOUR, ?, previous_finish_date)
+    ORDER BY database_name, row_kind DESC, backup_finish_date
+    """
+
+    anomalies_by_db = {}
+    for database_filter, params in build_database_filters(databases, chunk_size=chunk_size):
+        cursor.execute(
+            query.format(whitelist_sql=whitelist_sql, database_filter=database_filter),
+            (*allowed_prefixes, *params, min_date, last_hours_limit, BACKUP_INTERVAL_HOURS)
+        )
+        for row in cursor.fetchall():
+            database = row.database_name
+            current_instance = row.instance_name or "Desconhecido"
+            anomalies = anomalies_by_db.setdefault(database, [])
+            if row.row_kind == 'SUMMARY':
+                # Sem backup autorizado na janela inteira ou sem backup autorizado recente
+                if row.backup_finish_date is None:
+                    issue = f"Nenhum backup autorizado feito nas últimas {BACKUP_DATE_THRESHOLD_WEEKS} semana(s)"
+                else:
+                    issue = f"Nenhum backup autorizado feito nas últimas {BACKUP_LAST_HOURS} horas"
+                anomalies.append({
+                    'database': database,
+                    'device': '',
+                    'user': '',
+                    'instance': current_instance,
+                    'type': 'General',
+                    'issues': [issue],
+                    'timestamp': now,
+                    'reference': row.backup_finish_date
+                })
+            else:
+                gap = row.backup_finish_date - row.previous_finish_date
+                anomalies.append({
+                    'database': database,
+                    'device': row.physical_device_name,
+                    'user': '',
+                    'instance': current_instance,
+                    'type': row.backup_type,
+                    'issues': [f'Intervalo demasiado longo: {str(gap)}'],
+                    'timestamp': row.backup_finish_date
+                })
+    return anomalies_by_db
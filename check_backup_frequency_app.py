@@ -1,6 +1,8 @@
 import datetime
-from db_utils import connect_to_db_server, get_user_databases, get_backups
-from check_backup_frequency import check_backup_frequency
+from db_utils import connect_to_db_server, get_user_databases, get_backup_history
+from check_backup_frequency import check_backup_frequency, check_backup_frequency_pushdown
+from check_state import CheckState
+from config import BACKUP_FREQUENCY_PUSHDOWN
 from server_manager import read_server_list
 from user_whitelist import create_whitelist_file_if_not_exists
 from anomaly_log import log_anomalies
@@ -26,16 +28,29 @@ def process_server(srv):
         with PRINT_LOCK:
             print(f"Servidor {server}: {len(databases)} bases de dados encontradas. A executar funcionalidades...")
         # Para cada base de dados, avalia a frequência de backups e agrega as anomalias
+        if BACKUP_FREQUENCY_PUSHDOWN:
+            # Os intervalos são calculados no servidor; só as violações são transferidas
+            pushdown_by_db = check_backup_frequency_pushdown(cursor)
+        else:
+            # Histórico de backups de toda a instância (cache local sincronizada incrementalmente)
+            backups_by_db = get_backup_history(cursor)
+        # O estado acompanha os incidentes ("nenhum backup autorizado" que volta a acontecer é registado de novo)
+        state = CheckState(server)
         for db in databases:
-            backups = get_backups(cursor, db)
-            if not backups:
-                continue
-            anomalies = check_backup_frequency(db, backups)
+            if BACKUP_FREQUENCY_PUSHDOWN:
+                anomalies = pushdown_by_db.get(db, [])
+            else:
+                backups = backups_by_db.get(db)
+                if not backups:
+                    continue
+                anomalies = check_backup_frequency(db, backups)
+            state.track('2', db, anomalies)
             # Atualiza o campo "instance" com o nome do servidor em caixa alta se não estiver definido
             for anomaly in anomalies:
                 if not anomaly.get("instance"):
                     anomaly["instance"] = server.upper()
             local_anomalias.extend(anomalies)
+        state.save()
     except Exception as e:
         with PRINT_LOCK:
             print(f"Erro ao conectar no servidor {server}: {e}")
@@ -1,11 +1,13 @@
 import pyodbc
 from datetime import datetime
+from db_utils import get_databases_snapshot
 
 def check_db_status(database, cursor, instance=None):
     """
     Verifica se a base de dados está offline ou em modo emergência/recuperação.
     Se o estado (state_desc) não for 'ONLINE', cria uma anomalia, indicando a instância.
     O parâmetro 'instance' pode ser passado para evitar nova conexão.
+    O estado é lido do snapshot de sys.databases partilhado (uma query por conexão, não por base).
     """
     anomalies = []
     now = datetime.now()
@@ -16,10 +18,9 @@ def check_db_status(database, cursor, instance=None):
         instance = cursor.fetchone()[0]
         
     # Obtém o estado e o recovery model da base
-    cursor.execute("SELECT state_desc, recovery_model_desc FROM sys.databases WHERE name = ?", database)
-    row = cursor.fetchone()
+    row = get_databases_snapshot(cursor).get(database)
     if row:
-        state, recovery_model = row[0], row[1]
+        state, recovery_model = row.state_desc, row.recovery_model_desc
         if state.upper() != "ONLINE":
             issues = [f"A base está em estado: '{state}'",
                       f"Recovery model: '{recovery_model}'"]
@@ -30,7 +31,8 @@ def check_db_status(database, cursor, instance=None):
                 'type': 'DB Status',
                 'instance': instance,
                 'issues': issues,
-                'timestamp': now
+                'timestamp': now,
+                'reference': None
             })
     else:
         issues = [f"Base de dados '{database}' não encontrada em sys.databases"]
@@ -41,6 +43,7 @@ def check_db_status(database, cursor, instance=None):
             'type': 'DB Status',
             'instance': instance,
             'issues': issues,
-            'timestamp': now
+            'timestamp': now,
+            'reference': None
         })
     return anomalies
\ No newline at end of file
@@ -1,6 +1,7 @@
 import datetime
 from db_utils import connect_to_db_server, get_user_databases
 from check_db_status import check_db_status
+from check_state import CheckState
 from server_manager import read_server_list
 from user_whitelist import create_whitelist_file_if_not_exists
 from anomaly_log import log_anomalies
@@ -27,9 +28,11 @@ def process_server(srv):
         else:
             with PRINT_LOCK:
                 print(f"Servidor {server}: {len(databases)} bases de dados encontradas.")
-            # Para cada base, verifica o status (offline ou em modo de emergência/recuperação)
+            # Para cada base, verifica o status (offline ou em modo de emergência/recuperação);
+            # o estado acompanha os incidentes (uma base que volta a ficar offline é um incidente novo)
+            state = CheckState(server)
             for db in databases:
-                anomalies = check_db_status(db, cursor, server)
+                anomalies = state.track('5', db, check_db_status(db, cursor, server))
                 if anomalies:
                     # Atualiza o campo 'instance' para os itens sem valor definido
                     for anomaly in anomalies:
@@ -39,6 +42,7 @@ def process_server(srv):
                 else:
                     with PRINT_LOCK:
                         print(f"Base de Dados: {db} está ONLINE e operacional.")
+            state.save()
     except Exception as e:
         with PRINT_LOCK:
             print(f"Erro ao conectar ao servidor {server}: {e}")
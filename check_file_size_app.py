@@ -1,5 +1,5 @@
 import datetime
-from db_utils import connect_to_db_server, get_user_databases, get_backups
+from db_utils import connect_to_db_server, get_user_databases, get_backup_history
 from check_file_size import check_file_size
 from server_manager import read_server_list
 from user_whitelist import create_whitelist_file_if_not_exists
@@ -39,8 +39,10 @@ def process_server(srv):
             with PRINT_LOCK:
                 print(f"Servidor {instance}: {len(databases)} bases de dados encontradas. A executar funcionalidades...")
             # Para cada base, verifica as anomalias de tamanho de backup e agrupa os resultados
+            # Histórico de backups de toda a instância (cache local sincronizada incrementalmente)
+            backups_by_db = get_backup_history(cursor, instance)
             for db in databases:
-                backups = get_backups(cursor, db)
+                backups = backups_by_db.get(db)
                 if not backups:
                     continue
                 anomalies = check_file_size(db, backups)
@@ -0,0 +1,347 @@
+from collections import namedtuple
+from datetime import datetime, timedelta
+from db_utils import (get_backup_history, get_all_backups, iter_backups_by_database, get_databases_snapshot,
+                      BackupType)
+from check_authorized_users import check_authorized_users
+from check_backup_frequency import check_backup_frequency, check_backup_frequency_pushdown
+from check_tlog_after_full_diff import check_tlog_after_full_diff, get_last_tlog_dates, HISTORY_COVERS_TLOG_WINDOW
+from check_file_size import check_file_size
+from check_db_status import check_db_status
+from check_volumes import (iter_all_file_records, classify_volumes, check_file_volume_anomalies,
+                           transform_volume_anomalies)
+import backup_analysis
+from check_state import CheckState, INSTANCE_ENTRY, compute_digest, history_signature
+from user_whitelist import WHITELIST, SYSADMIN_WHITELIST, get_whitelist_matcher
+from config import (BACKUP_FREQUENCY_PUSHDOWN, USE_BACKUP_HISTORY_CACHE, USE_VECTORIZED_ANALYSIS,
+                    USE_INCREMENTAL_CHECKS, BACKUP_DATE_THRESHOLD_WEEKS, BACKUP_LAST_HOURS, BACKUP_INTERVAL_HOURS,
+                    TLOG_HOURS_THRESHOLD)
+
+# Registo das verificações: cada verificação declara os conjuntos de dados de que precisa
+# e o planeador (load_datasets) lê cada conjunto no máximo uma vez por instância,
+# e só se alguma das verificações escolhidas o pedir.
+
+# Conjuntos de dados disponíveis
+DATASET_BACKUPS = "backups"                       # histórico de backups (msdb), por base de dados
+DATASET_DATABASES = "databases"                   # snapshot de sys.databases
+DATASET_FILE_RECORDS = "file_records"             # ficheiros de sys.master_files, classificados por tipo
+DATASET_BACKUP_FREQUENCY = "backup_frequency"     # anomalias de frequência calculadas no servidor (pushdown)
+DATASET_LAST_TLOGS = "last_tlogs"                 # último TLOG recente por base (só se o histórico não o cobrir)
+DATASET_BACKUP_ARRAYS = "backup_arrays"           # histórico em arrays NumPy (backup_analysis)
+DATASET_FREQUENCY_ANOMALIES = "frequency_anomalies"   # funcionalidade 2 vetorizada, por base
+DATASET_ZERO_SIZE_ANOMALIES = "zero_size_anomalies"   # funcionalidade 4 vetorizada, por base
+
+# Conjuntos derivados de outros conjuntos (carregados primeiro pelo planeador)
+DATASET_DEPENDENCIES = {
+    DATASET_BACKUP_ARRAYS: (DATASET_BACKUPS,),
+    DATASET_FREQUENCY_ANOMALIES: (DATASET_BACKUP_ARRAYS,),
+    DATASET_ZERO_SIZE_ANOMALIES: (DATASET_BACKUP_ARRAYS,),
+}
+
+# Âmbito das verificações
+SCOPE_DATABASE = "database"   # func(ctx, database, backups) -> lista de anomalias
+SCOPE_INSTANCE = "instance"   # func(ctx) -> lista de anomalias
+
+CheckSpec = namedtuple("CheckSpec", ["key", "datasets", "scope", "uses_cursor", "single_pass", "incremental", "func"])
+CheckContext = namedtuple("CheckContext", ["cursor", "instance", "data"])
+
+CHECK_REGISTRY = {}
+
+def register_check(key, datasets=(), scope=SCOPE_DATABASE, uses_cursor=False, single_pass=False,
+                   incremental=None, registry=CHECK_REGISTRY):
+    """
+    Decorador que regista uma verificação com a chave do menu ('1', '2', ...).
+    - 'datasets': conjuntos de dados de que a verificação precisa (ver DATASET_*).
+    - 'uses_cursor': a verificação faz as suas próprias queries (não pode correr durante o streaming
+      do histórico nem em paralelo no mesmo cursor).
+    - 'single_pass': a verificação percorre os backups de cada base uma única vez, por ordem
+      (aceita o histórico em streaming).
+    - 'incremental': função (ctx, database, backups, now) -> (dados de entrada, válido até) que permite
+      reutilizar o resultado anterior (check_state) enquanto os dados de entrada forem os mesmos
+      e 'válido até' (datetime ou None) não tiver passado.
+    """
+    def decorator(func):
+        registry[key] = CheckSpec(key, tuple(datasets), scope, uses_cursor, single_pass, incremental, func)
+        return func
+    return decorator
+
+# Dados de entrada de cada verificação (para a reavaliação incremental) e momento em que uma regra
+# dependente do tempo pode mudar o resultado sem que os dados mudem
+
+def authorized_users_inputs(ctx, database, backups, now):
+    return (history_signature(backups), WHITELIST.signature(), SYSADMIN_WHITELIST.signature()), None
+
+def backup_frequency_inputs(ctx, database, backups, now):
+    # "Nenhum backup autorizado nas últimas BACKUP_LAST_HOURS horas" passa a ser verdade
+    # BACKUP_LAST_HOURS horas depois do último backup autorizado
+    is_authorized = get_whitelist_matcher()
+    last_authorized = max((b.backup_finish_date for b in backups or ()
+                           if not b.is_copy_only and is_authorized(b.user_name)), default=None)
+    valid_until = last_authorized + timedelta(hours=BACKUP_LAST_HOURS) if last_authorized else None
+    inputs = (history_signature(backups), WHITELIST.signature(), BACKUP_LAST_HOURS, BACKUP_INTERVAL_HOURS)
+    return inputs, valid_until if valid_until and valid_until > now else None
+
+def tlog_after_full_diff_inputs(ctx, database, backups, now):
+    # "Nenhum TLOG nas últimas TLOG_HOURS_THRESHOLD horas" passa a ser verdade após o último TLOG
+    row = ctx.data[DATASET_DATABASES].get(database)
+    last_tlog_dates = ctx.data.get(DATASET_LAST_TLOGS)
+    if last_tlog_dates is not None:
+        last_tlog = last_tlog_dates.get(database)
+    else:
+        last_tlog = max((b.backup_finish_date for b in backups or ()
+                         if not b.is_copy_only and b.type_code == BackupType.TLOG), default=None)
+    valid_until = last_tlog + timedelta(hours=TLOG_HOURS_THRESHOLD) if last_tlog else None
+    inputs = (history_signature(backups), WHITELIST.signature(), row.recovery_model_desc if row else None,
+              last_tlog, TLOG_HOURS_THRESHOLD)
+    return inputs, valid_until if valid_until and valid_until > now else None
+
+def file_size_inputs(ctx, database, backups, now):
+    # Um backup com tamanho 0 deixa de ser reportado quando sai da janela de BACKUP_DATE_THRESHOLD_WEEKS
+    threshold_date = now - timedelta(weeks=BACKUP_DATE_THRESHOLD_WEEKS)
+    oldest_zero_size = min((b.backup_finish_date for b in backups or ()
+                            if not b.is_copy_only and b.backup_size == 0 and b.backup_finish_date >= threshold_date),
+                           default=None)
+    valid_until = oldest_zero_size + timedelta(weeks=BACKUP_DATE_THRESHOLD_WEEKS) if oldest_zero_size else None
+    return (history_signature(backups), BACKUP_DATE_THRESHOLD_WEEKS), valid_until
+
+def db_status_inputs(ctx, database, backups, now):
+    row = ctx.data[DATASET_DATABASES].get(database)
+    return ((row.state_desc, row.recovery_model_desc) if row else None,), None
+
+@register_check('1', datasets=(DATASET_BACKUPS,), single_pass=True, incremental=authorized_users_inputs)
+def run_authorized_users(ctx, database, backups):
+    return check_authorized_users(database, backups) if backups else []
+
+@register_check('2', datasets=(DATASET_BACKUPS,), incremental=backup_frequency_inputs)
+def run_backup_frequency(ctx, database, backups):
+    return check_backup_frequency(database, backups) if backups else []
+
+# Os TLOGs vêm do histórico; só se a janela deste for curta é lida a data do último TLOG de cada base
+@register_check('3', datasets=(DATASET_BACKUPS, DATASET_DATABASES)
+                + (() if HISTORY_COVERS_TLOG_WINDOW else (DATASET_LAST_TLOGS,)),
+                incremental=tlog_after_full_diff_inputs)
+def run_tlog_after_full_diff(ctx, database, backups):
+    if not backups:
+        return []
+    return check_tlog_after_full_diff(database, backups, ctx.cursor, ctx.data.get(DATASET_LAST_TLOGS),
+                                      ctx.data[DATASET_DATABASES])
+
+@register_check('4', datasets=(DATASET_BACKUPS,), single_pass=True, incremental=file_size_inputs)
+def run_file_size(ctx, database, backups):
+    return check_file_size(database, backups) if backups else []
+
+@register_check('5', datasets=(DATASET_DATABASES,), uses_cursor=True, incremental=db_status_inputs)
+def run_db_status(ctx, database, backups):
+    # Não depende do histórico: as bases sem backups também são verificadas
+    return check_db_status(database, ctx.cursor, ctx.instance)
+
+@register_check('6', datasets=(DATASET_FILE_RECORDS,), scope=SCOPE_INSTANCE)
+def run_volume_integrity(ctx):
+    anomalies = check_file_volume_anomalies(ctx.data[DATASET_FILE_RECORDS])
+    return transform_volume_anomalies(anomalies, ctx.instance)
+
+# Variante da opção 2 com o cálculo feito no servidor (BACKUP_FREQUENCY_PUSHDOWN)
+PUSHDOWN_CHECKS = {}
+
+@register_check('2', datasets=(DATASET_BACKUP_FREQUENCY,), registry=PUSHDOWN_CHECKS)
+def run_backup_frequency_pushdown(ctx, database, backups):
+    return ctx.data[DATASET_BACKUP_FREQUENCY].get(database, [])
+
+# Variantes vetorizadas (NumPy) das opções 2 e 4 (USE_VECTORIZED_ANALYSIS e NumPy instalado).
+# Com a reavaliação incremental, os arrays só são calculados para as bases cujo resultado não pode
+# ser reutilizado (load_changed_datasets).
+VECTORIZED_CHECKS = {}
+
+@register_check('2', datasets=(DATASET_BACKUPS, DATASET_FREQUENCY_ANOMALIES), incremental=backup_frequency_inputs,
+                registry=VECTORIZED_CHECKS)
+def run_backup_frequency_vectorized(ctx, database, backups):
+    return ctx.data[DATASET_FREQUENCY_ANOMALIES].get(database, [])
+
+@register_check('4', datasets=(DATASET_BACKUPS, DATASET_ZERO_SIZE_ANOMALIES), incremental=file_size_inputs,
+                registry=VECTORIZED_CHECKS)
+def run_file_size_vectorized(ctx, database, backups):
+    return ctx.data[DATASET_ZERO_SIZE_ANOMALIES].get(database, [])
+
+def load_backups(cursor, instance, query_databases, data):
+    # Cache local sincronizada incrementalmente ou, sem cache, o histórico lido de uma só vez
+    if USE_BACKUP_HISTORY_CACHE:
+        return get_backup_history(cursor, instance)
+    return get_all_backups(cursor, query_databases)
+
+# Cada função recebe (cursor, instance, query_databases, data), em que 'data' tem os conjuntos já carregados
+DATASET_LOADERS = {
+    DATASET_BACKUPS: load_backups,
+    DATASET_DATABASES: lambda cursor, instance, query_databases, data: get_databases_snapshot(cursor),
+    DATASET_FILE_RECORDS: lambda cursor, instance, query_databases, data: classify_volumes(iter_all_file_records(cursor)),
+    DATASET_BACKUP_FREQUENCY: lambda cursor, instance, query_databases, data: check_backup_frequency_pushdown(cursor, query_databases),
+    DATASET_LAST_TLOGS: lambda cursor, instance, query_databases, data: get_last_tlog_dates(cursor),
+    DATASET_BACKUP_ARRAYS: lambda cursor, instance, query_databases, data: backup_analysis.build_backup_arrays(data[DATASET_BACKUPS], query_databases),
+    DATASET_FREQUENCY_ANOMALIES: lambda cursor, instance, query_databases, data: backup_analysis.check_backup_frequency_vectorized(data[DATASET_BACKUP_ARRAYS]),
+    DATASET_ZERO_SIZE_ANOMALIES: lambda cursor, instance, query_databases, data: backup_analysis.check_file_size_vectorized(data[DATASET_BACKUP_ARRAYS]),
+}
+
+def resolve_checks(keys):
+    """
+    Devolve as especificações das verificações escolhidas (lança KeyError se a chave não existir).
+    Com BACKUP_FREQUENCY_PUSHDOWN, a opção 2 é calculada no servidor, exceto se outra verificação
+    escolhida já precisar do histórico completo (nesse caso é reutilizado).
+    Com USE_VECTORIZED_ANALYSIS e o NumPy instalado, as opções 2 e 4 são calculadas em arrays
+    para todas as bases de uma vez.
+    """
+    specs = [CHECK_REGISTRY[key] for key in keys]
+    if BACKUP_FREQUENCY_PUSHDOWN and not any(DATASET_BACKUPS in spec.datasets for spec in specs if spec.key != '2'):
+        specs = [PUSHDOWN_CHECKS.get(spec.key, spec) for spec in specs]
+    if USE_VECTORIZED_ANALYSIS and backup_analysis.is_available():
+        specs = [VECTORIZED_CHECKS.get(spec.key, spec) if DATASET_BACKUPS in spec.datasets else spec
+                 for spec in specs]
+    return specs
+
+def plan_datasets(specs):
+    """
+    Devolve, sem repetições, os conjuntos de dados de que as verificações precisam, pela ordem
+    de carregamento (cada conjunto derivado aparece depois dos conjuntos de que depende).
+    """
+    needed = []
+
+    def add(dataset):
+        if dataset in needed:
+            return
+        for dependency in DATASET_DEPENDENCIES.get(dataset, ()):
+            add(dependency)
+        needed.append(dataset)
+
+    for spec in specs:
+        for dataset in spec.datasets:
+            add(dataset)
+    return needed
+
+def load_datasets(specs, cursor, instance, query_databases=None, preloaded=None, allow_streaming=True,
+                  derived=True):
+    """
+    Lê (uma única vez) os conjuntos de dados de que as verificações precisam.
+    - 'preloaded': conjuntos já carregados (ex.: histórico partilhado entre conexões), que não são relidos.
+    - 'query_databases': se indicado, as queries de histórico são restringidas a estas bases.
+    - 'allow_streaming': sem cache local, se o histórico for usado por uma única verificação de uma só
+      passagem (e nenhuma usar o cursor), é consumido em streaming (fetchmany), base a base,
+      sem materializar o histórico inteiro da instância.
+    - 'derived=False': os conjuntos derivados (DATASET_DEPENDENCIES) não são calculados; ficam para
+      load_changed_datasets, que os calcula só para as bases que mudaram.
+    """
+    data = dict(preloaded or {})
+    plan = plan_datasets(specs)
+    history_specs = [spec for spec in specs if DATASET_BACKUPS in spec.datasets]
+    # O streaming só é possível se nenhum conjunto derivado precisar do histórico completo
+    streaming = (allow_streaming and not USE_BACKUP_HISTORY_CACHE and not any(spec.uses_cursor for spec in specs)
+                 and len(history_specs) == 1 and history_specs[0].single_pass
+                 and not any(DATASET_BACKUPS in DATASET_DEPENDENCIES.get(dataset, ()) for dataset in plan))
+    for dataset in plan:
+        if dataset in data or (not derived and dataset in DATASET_DEPENDENCIES):
+            continue
+        if dataset == DATASET_BACKUPS and streaming:
+            # O gerador só executa a query quando começar a ser consumido (depois dos outros conjuntos)
+            data[dataset] = iter_backups_by_database(cursor, query_databases)
+        else:
+            data[dataset] = DATASET_LOADERS[dataset](cursor, instance, query_databases, data)
+    return data
+
+def iter_database_inputs(backups_by_db, databases):
+    """
+    Devolve (database, backups) para cada base, a partir do histórico em dicionário ou em streaming.
+    As bases sem histórico são devolvidas com backups=None.
+    """
+    if backups_by_db is None or isinstance(backups_by_db, dict):
+        for db in databases:
+            yield db, backups_by_db.get(db) if backups_by_db else None
+        return
+    pending = dict.fromkeys(databases)
+    for db, backups in backups_by_db:
+        if db in pending:
+            del pending[db]
+            yield db, backups
+    for db in pending:
+        yield db, None
+
+def _lookup_check(spec, ctx, database, backups, state, now):
+    """
+    Devolve (digest, válido até, anomalias guardadas ou None) de uma verificação incremental,
+    ou None se o resultado não puder ser reutilizado (sem estado, sem USE_INCREMENTAL_CHECKS, sem 'incremental'
+    ou histórico em streaming).
+    """
+    if (state is None or not USE_INCREMENTAL_CHECKS or spec.incremental is None
+            or not (backups is None or isinstance(backups, list))):
+        return None
+    inputs, valid_until = spec.incremental(ctx, database, backups, now)
+    digest = compute_digest((spec.key, inputs))
+    return digest, valid_until, state.lookup(spec.key, database, digest, now)
+
+def load_changed_datasets(specs, ctx, databases, state, now=None):
+    """
+    Calcula os conjuntos derivados que load_datasets(derived=False) deixou por carregar, restringidos às
+    bases em que alguma verificação que os usa não pode reutilizar o resultado anterior (check_state).
+    Se nenhuma base mudou, os conjuntos ficam vazios e não é feito nenhum cálculo.
+    """
+    now = now or datetime.now()
+    backups_by_db = ctx.data.get(DATASET_BACKUPS) or {}
+    pending = plan_datasets(specs)
+    changed = set()
+    for spec in specs:
+        if not any(dataset in DATASET_DEPENDENCIES for dataset in spec.datasets):
+            continue
+        for db in databases:
+            lookup = _lookup_check(spec, ctx, db, backups_by_db.get(db), state, now)
+            if lookup is None or lookup[2] is None:
+                changed.add(db)
+    for dataset in pending:
+        if dataset not in ctx.data:
+            ctx.data[dataset] = DATASET_LOADERS[dataset](ctx.cursor, ctx.instance, sorted(changed), ctx.data)
+
+def evaluate_check(spec, ctx, database, backups, state=None, now=None):
+    """
+    Executa uma verificação de base de dados. Com um CheckState, reutiliza o resultado anterior
+    se os dados de entrada não mudaram e nenhuma regra dependente do tempo o pode ter alterado.
+    O histórico em streaming (iterador) não é comparável e é sempre avaliado.
+    O resultado é sempre registado no CheckState, para acompanhar os incidentes (check_state.assign_incidents).
+    """
+    now = now or datetime.now()
+    lookup = _lookup_check(spec, ctx, database, backups, state, now)
+    if lookup is None:
+        anomalias = spec.func(ctx, database, backups)
+        return state.track(spec.key, database, anomalias, now) if state is not None else anomalias
+    digest, valid_until, cached = lookup
+    if cached is not None:
+        return cached
+    anomalias = spec.func(ctx, database, backups)
+    state.store(spec.key, database, digest, valid_until, anomalias, now)
+    return anomalias
+
+def run_checks(keys, cursor, databases, instance, query_databases=None, preloaded=None, instance_checks=True):
+    """
+    Executa as verificações indicadas (chaves do registo) numa instância e devolve a lista de anomalias.
+    Os dados são lidos pelo planeador (load_datasets) e partilhados por todas as verificações.
+    'instance_checks=False' omite as verificações ao nível da instância (ex.: lotes paralelos de bases).
+    """
+    specs = resolve_checks(keys)
+    if not instance_checks:
+        specs = [spec for spec in specs if spec.scope == SCOPE_DATABASE]
+    # O estado guarda o resultado de cada verificação (incidentes) e, com USE_INCREMENTAL_CHECKS, permite reutilizá-lo
+    state = CheckState(instance)
+    now = datetime.now()
+    # Os conjuntos derivados (ex.: arrays NumPy) só são calculados para as bases cujo resultado não é reutilizado
+    ctx = CheckContext(cursor, instance, load_datasets(specs, cursor, instance, query_databases, preloaded,
+                                                       derived=False))
+    load_changed_datasets(specs, ctx, databases, state, now)
+
+    all_anomalias = []
+    database_specs = [spec for spec in specs if spec.scope == SCOPE_DATABASE]
+    if database_specs:
+        for db, backups in iter_database_inputs(ctx.data.get(DATASET_BACKUPS), databases):
+            for spec in database_specs:
+                all_anomalias.extend(evaluate_check(spec, ctx, db, backups, state, now))
+    for spec in specs:
+        if spec.scope == SCOPE_INSTANCE:
+            all_anomalias.extend(state.track(spec.key, INSTANCE_ENTRY, spec.func(ctx), now))
+    state.save()
+
+    # Atualiza o campo 'instance' para ser o nome da instância obtido via query
+    for anomalia in all_anomalias:
+        anomalia["instance"] = instance
+    return all_anomalias
@@ -0,0 +1,163 @@
+import os
+import re
+import json
+import hashlib
+import threading
+from datetime import datetime, timedelta
+from anomaly_log import serialize_anomaly
+from file_lock import file_lock
+from config import CHECK_STATE_FOLDER, CHECK_STATE_RETENTION_DAYS
+
+# Estado persistente das verificações por base de dados (um ficheiro por instância):
+# para cada verificação e base guarda o "digest" dos dados de entrada, a data até à qual o resultado
+# é válido (regras dependentes do tempo, ex.: "nenhum backup nas últimas 24 horas") e as anomalias
+# produzidas. Se o digest não mudou e o prazo não passou, as anomalias guardadas são reutilizadas.
+# O resultado anterior de cada verificação e base serve também para acompanhar os incidentes: uma anomalia
+# de estado ('reference' None, ver anomaly_log) recebe como 'reference' o início do incidente, mantido
+# enquanto a anomalia continuar presente; se desaparecer e voltar, é um incidente novo (fingerprint novo).
+
+# Versão 3: as anomalias de estado guardadas têm em 'reference' o início do incidente (ver anomaly_log)
+CHECK_STATE_VERSION = 3
+
+# Entrada usada pelas verificações ao nível da instância (ex.: opção 6), que não são feitas base a base
+INSTANCE_ENTRY = "*"
+
+def get_check_state_file(instance):
+    """Devolve o caminho do ficheiro de estado das verificações da instância."""
+    safe_name = re.sub(r"[^A-Za-z0-9_.-]", "_", instance)
+    return os.path.join(CHECK_STATE_FOLDER, f"{safe_name}.json")
+
+def compute_digest(parts):
+    """Resume os dados de entrada de uma verificação (tuplo de valores simples) num hash."""
+    return hashlib.sha1(repr(parts).encode("utf-8")).hexdigest()
+
+def history_signature(backups):
+    """
+    Assinatura do histórico de uma base: muda quando entra um backup novo (backup_set_id máximo)
+    ou quando um backup antigo sai da janela do histórico (número de backups e backup_set_id mínimo).
+    """
+    if not backups:
+        return (0, None, None)
+    ids = [b.backup_set_id for b in backups]
+    return (len(ids), min(ids), max(ids))
+
+def _load_entries(instance):
+    try:
+        with open(get_check_state_file(instance), "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except Exception:
+        return {}
+    if data.get("version") != CHECK_STATE_VERSION:
+        return {}
+    return data.get("checks", {})
+
+def _incident_key(anomaly):
+    return (anomaly.get("database"), anomaly.get("type"), anomaly.get("device"),
+            tuple(sorted(str(issue) for issue in anomaly.get("issues", []))))
+
+def _deserialize_anomaly(anomaly):
+    anomaly = dict(anomaly)
+    try:
+        anomaly["timestamp"] = datetime.fromisoformat(anomaly["timestamp"])
+    except (KeyError, TypeError, ValueError):
+        pass
+    return anomaly
+
+class CheckState:
+    """
+    Estado das verificações de uma instância, lido uma vez e gravado no fim (save).
+    Pode ser usado por várias threads; vários objetos da mesma instância (ex.: lotes paralelos)
+    juntam as suas alterações ao gravar.
+    """
+
+    def __init__(self, instance):
+        self.instance = instance
+        self._lock = threading.Lock()
+        self._entries = _load_entries(instance)
+        self._changes = {}
+
+    def lookup(self, key, database, digest, now):
+        """
+        Devolve as anomalias guardadas se ainda forem válidas, ou None se a verificação tiver de correr.
+        Um resultado avaliado há mais de metade de CHECK_STATE_RETENTION_DAYS é sempre reavaliado,
+        para que a entrada seja renovada antes de ser descartada (e os incidentes em curso não recomecem).
+        """
+        entry = self._entries.get(key, {}).get(database)
+        if not entry or entry.get("digest") != digest:
+            return None
+        valid_until = entry.get("valid_until")
+        if valid_until and now >= datetime.fromisoformat(valid_until):
+            return None
+        if entry.get("checked_at", "") < (now - timedelta(days=CHECK_STATE_RETENTION_DAYS / 2)).isoformat():
+            return None
+        return [_deserialize_anomaly(anomaly) for anomaly in entry.get("anomalies", [])]
+
+    def _previous(self, key, database):
+        with self._lock:
+            entry = self._changes.get(key, {}).get(database)
+        return entry or self._entries.get(key, {}).get(database) or {}
+
+    def assign_incidents(self, key, database, anomalies, now):
+        """
+        Preenche a 'reference' das anomalias de estado ('reference' None) com o início do incidente:
+        o do resultado anterior da mesma verificação e base, se a anomalia já lá estava, ou 'now'.
+        Devolve a própria lista de anomalias.
+        """
+        started = {_incident_key(anomaly): anomaly.get("reference")
+                   for anomaly in self._previous(key, database).get("anomalies", [])}
+        for anomaly in anomalies:
+            if "reference" in anomaly and anomaly["reference"] is None:
+                anomaly["reference"] = started.get(_incident_key(anomaly)) or now.isoformat(timespec="seconds")
+        return anomalies
+
+    def track(self, key, database, anomalies, now=None):
+        """
+        Regista o resultado de uma verificação sem reavaliação incremental (sem digest), só para acompanhar
+        os incidentes (ver assign_incidents). Devolve a própria lista de anomalias.
+        """
+        self.store(key, database, None, None, anomalies, now or datetime.now())
+        return anomalies
+
+    def store(self, key, database, digest, valid_until, anomalies, now):
+        """
+        Guarda o resultado de uma verificação (só é gravado no ficheiro em save()), depois de atribuir
+        o início do incidente às anomalias de estado (assign_incidents).
+        """
+        self.assign_incidents(key, database, anomalies, now)
+        entry = {
+            "digest": digest,
+            "valid_until": valid_until.isoformat() if valid_until else None,
+            "checked_at": now.isoformat(),
+            "anomalies": [serialize_anomaly(anomaly) for anomaly in anomalies],
+        }
+        with self._lock:
+            self._changes.setdefault(key, {})[database] = entry
+
+    def save(self):
+        """
+        Junta as alterações ao ficheiro da instância, relido com o lock do ficheiro obtido (partilhado com
+        os outros processos, ex.: main.py e os *_app.py), e grava-o num ficheiro temporário do processo.
+        As entradas não reavaliadas há mais de CHECK_STATE_RETENTION_DAYS dias são removidas,
+        o que também obriga a uma reavaliação completa periódica.
+        """
+        with self._lock:
+            changes, self._changes = self._changes, {}
+        if not changes:
+            return
+        oldest = (datetime.now() - timedelta(days=CHECK_STATE_RETENTION_DAYS)).isoformat()
+        if not os.path.exists(CHECK_STATE_FOLDER):
+            os.makedirs(CHECK_STATE_FOLDER, exist_ok=True)
+        path = get_check_state_file(self.instance)
+        with file_lock(path):
+            entries = _load_entries(self.instance)
+            for key, databases in changes.items():
+                entries.setdefault(key, {}).update(databases)
+            for key in list(entries):
+                entries[key] = {db: entry for db, entry in entries[key].items()
+                                if entry.get("checked_at", "") >= oldest}
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"version": CHECK_STATE_VERSION, "instance": self.instance, "checks": entries},
+                          f, ensure_ascii=False, default=str)
+            os.replace(tmp_path, path)
+            self._entries = entries
@@ -1,90 +1,67 @@
 from datetime import datetime, timedelta
 import pyodbc
-from user_whitelist import load_whitelist
-from config import TLOG_HOURS_THRESHOLD
+from user_whitelist import get_whitelist_matcher
+from config import TLOG_HOURS_THRESHOLD, BACKUP_DATE_THRESHOLD_WEEKS
+from db_utils import iter_rows, get_databases_snapshot, BackupType
 
-def get_recovery_model(cursor, database):
+# O histórico de backups cobre as últimas BACKUP_DATE_THRESHOLD_WEEKS semanas: se TLOG_HOURS_THRESHOLD couber
+# nessa janela, os TLOGs recentes são obtidos do histórico já lido; caso contrário, é feita uma única query
+# para a instância inteira (get_last_tlog_dates)
+HISTORY_COVERS_TLOG_WINDOW = timedelta(hours=TLOG_HOURS_THRESHOLD) <= timedelta(weeks=BACKUP_DATE_THRESHOLD_WEEKS)
+
+def get_recovery_model(cursor, database, databases_snapshot=None):
+    # Lê o recovery model do snapshot de sys.databases partilhado com check_db_status
     try:
-        cursor.execute("SELECT recovery_model_desc FROM sys.databases WHERE name = ?", database)
-        row = cursor.fetchone()
-        return row[0] if row else None
+        if databases_snapshot is None:
+            databases_snapshot = get_databases_snapshot(cursor)
+        row = databases_snapshot.get(database)
+        return row.recovery_model_desc if row else None
     except Exception:
         return None
 
-# Função auxiliar para buscar TLOGs das últimas 24 horas via SQL
-def get_tlogs_after_nhours(cursor, database, hours=TLOG_HOURS_THRESHOLD):
+def get_last_tlog_dates(cursor, hours=TLOG_HOURS_THRESHOLD):
+    """
+    Uma única query para todas as bases da instância: devolve {database_name: data do último TLOG}
+    com os TLOGs (não copy_only) das últimas 'hours' horas. Só é usada quando o histórico de backups
+    não cobre essa janela (ver HISTORY_COVERS_TLOG_WINDOW).
+    """
     lower_bound = datetime.now() - timedelta(hours=hours)
     query = """
-    SELECT
-        bs.database_name,
-        bs.backup_start_date,
-        bs.backup_finish_date,
-        bs.is_copy_only,
-        CASE bs.type
-            WHEN 'L' THEN 'TLog'
-            ELSE bs.type
-        END as backup_type,
-        bs.user_name,
-        bmf.physical_device_name,
-        @@SERVERNAME AS instance_name
+    SELECT bs.database_name, MAX(bs.backup_finish_date) AS last_tlog
     FROM msdb.dbo.backupset bs
-    INNER JOIN msdb.dbo.backupmediafamily bmf ON bs.media_set_id = bmf.media_set_id
-    WHERE bs.database_name = ?
-      AND bs.type = 'L'
+    WHERE bs.type = 'L'
       AND bs.is_copy_only = 0
       AND bs.backup_finish_date >= ?
-    ORDER BY bs.backup_finish_date DESC
+    GROUP BY bs.database_name
     """
-    cursor.execute(query, database, lower_bound)
-    return cursor.fetchall()
+    cursor.execute(query, lower_bound)
+    return {row[0]: row[1] for row in iter_rows(cursor)}
 
-# Função auxiliar para buscar TLOGs feitos após um determinado momento
-def get_tlogs_after(cursor, database, after_time):
-    query = """
-    SELECT
-        bs.database_name,
-        bs.backup_start_date,
-        bs.backup_finish_date,
-        bs.is_copy_only,
-        CASE bs.type
-            WHEN 'L' THEN 'TLog'
-            ELSE bs.type
-        END as backup_type,
-        bs.user_name,
-        bmf.physical_device_name,
-        @@SERVERNAME AS instance_name
-    FROM msdb.dbo.backupset bs
-    INNER JOIN msdb.dbo.backupmediafamily bmf ON bs.media_set_id = bmf.media_set_id
-    WHERE bs.database_name = ?
-      AND bs.type = 'L'
-      AND bs.is_copy_only = 0
-      AND bs.backup_finish_date > ?
-    ORDER BY bs.backup_finish_date ASC
-    """
-    cursor.execute(query, database, after_time)
-    return cursor.fetchall()
-
-def check_tlog_after_full_diff(database, backups, cursor):
+def check_tlog_after_full_diff(database, backups, cursor=None, last_tlog_dates=None, databases_snapshot=None):
     """
     Funcionalidade 3:
-    - Verifica, via SQL, se há backup TLOG nas últimas 24 horas.
+    - Verifica se há backup TLOG nas últimas TLOG_HOURS_THRESHOLD horas.
     - Obtém o último backup full ou differential (não copy_only).
     - Se o último backup full/differential tiver sido realizado por um utilizador não autorizado (conforme whitelist),
       gera uma anomalia.
     - Se houver TLOG após esse backup, indica que o TLOG necessita de um backup autorizado.
     - Se o backup full/differential for autorizado, verifica se existe pelo menos um TLOG posterior.
     - Apenas realiza a verificação se a base estiver em modo FULL.
+    Os TLOGs são obtidos do histórico 'backups' (sem queries por base). Só se a janela do histórico
+    for mais curta do que TLOG_HOURS_THRESHOLD é usado 'last_tlog_dates' (get_last_tlog_dates,
+    lido uma vez por instância; se não for indicado, é feita a query aqui).
+    O recovery model vem de 'databases_snapshot' ou do snapshot de sys.databases da conexão.
     """
     anomalies = []
     now = datetime.now()
-    allowed_prefixes = load_whitelist()
+    is_authorized = get_whitelist_matcher()
 
     # Usa o instance_name presente nos backups ou "Desconhecido"
     current_instance = (backups[0].instance_name 
                         if backups and hasattr(backups[0], 'instance_name') and backups[0].instance_name 
                         else "Desconhecido")
 
-    recovery_model = get_recovery_model(cursor, database)
+    recovery_model = get_recovery_model(cursor, database, databases_snapshot)
     if recovery_model is None or recovery_model.upper() != 'FULL':
         anomalies.append({
             'database': database,
@@ -93,13 +70,23 @@ def check_tlog_after_full_diff(database, backups, cursor):
             'user': '',
             'instance': current_instance,
             'issues': [f"A base está em modo {recovery_model or 'desconhecido'}. Tem que ser FULL"],
-            'timestamp': now
+            'timestamp': now,
+            'reference': None
         })
         return anomalies
 
-    # Utiliza SQL para obter TLOGs das últimas TLOG_HOURS_THRESHOLD horas
-    tlogs_last_n = get_tlogs_after_nhours(cursor, database, hours=TLOG_HOURS_THRESHOLD)
-    if not tlogs_last_n:
+    # TLOGs (não copy_only) do histórico já lido
+    tlogs = [b for b in backups if not b.is_copy_only and b.type_code == BackupType.TLOG]
+
+    # TLOGs das últimas TLOG_HOURS_THRESHOLD horas
+    if HISTORY_COVERS_TLOG_WINDOW:
+        lower_bound = now - timedelta(hours=TLOG_HOURS_THRESHOLD)
+        has_recent_tlog = any(b.backup_finish_date >= lower_bound for b in tlogs)
+    else:
+        if last_tlog_dates is None:
+            last_tlog_dates = get_last_tlog_dates(cursor)
+        has_recent_tlog = database in last_tlog_dates
+    if not has_recent_tlog:
         anomalies.append({
             'database': database,
             'device': '',
@@ -107,7 +94,9 @@ def check_tlog_after_full_diff(database, backups, cursor):
             'user': '',
             'instance': current_instance,
             'issues': [f"Nenhum TLOG feito nas últimas {TLOG_HOURS_THRESHOLD} horas"],
-            'timestamp': now
+            'timestamp': now,
+            # Data do último TLOG do histórico: a anomalia só muda quando é feito um TLOG novo
+            'reference': max((b.backup_finish_date for b in tlogs), default=None)
         })
 
     # Filtra backups (não copy_only) referentes a full/differential
@@ -118,8 +107,12 @@ def check_tlog_after_full_diff(database, backups, cursor):
 
     latest_full_diff = max(full_diff, key=lambda b: b.backup_finish_date)
 
+    # Primeiro TLOG feito após o último backup full/differential (está sempre dentro da janela do histórico)
+    first_tlog_after = min((b for b in tlogs if b.backup_finish_date > latest_full_diff.backup_finish_date),
+                           key=lambda b: b.backup_finish_date, default=None)
+
     # Se o último backup full/differential foi feito por um utilizador não autorizado, cria anomalia
-    if not any(latest_full_diff.user_name.lower().startswith(prefix.lower()) for prefix in allowed_prefixes):
+    if not is_authorized(latest_full_diff.user_name):
         anomalies.append({
             'database': database,
             'device': latest_full_diff.physical_device_name,
@@ -129,10 +122,7 @@ def check_tlog_after_full_diff(database, backups, cursor):
             'issues': ["Último backup full/differential feito por utilizador não autorizado"],
             'timestamp': latest_full_diff.backup_finish_date
         })
-        # Usa SQL para obter TLOGs feitos após o último backup full/differential
-        tlogs_after = get_tlogs_after(cursor, database, latest_full_diff.backup_finish_date)
-        if tlogs_after:
-            first_tlog_after = tlogs_after[0]
+        if first_tlog_after is not None:
             anomalies.append({
                 'database': database,
                 'device': first_tlog_after.physical_device_name,
@@ -143,9 +133,8 @@ def check_tlog_after_full_diff(database, backups, cursor):
                 'timestamp': first_tlog_after.backup_finish_date
             })
     else:
-        # Se o backup full/differential for autorizado, mas não houver TLOG depois, utiliza SQL para confirmar
-        tlogs_after = get_tlogs_after(cursor, database, latest_full_diff.backup_finish_date)
-        if not tlogs_after:
+        # Se o backup full/differential for autorizado, mas não houver TLOG depois, cria anomalia
+        if first_tlog_after is None:
             anomalies.append({
                 'database': database,
                 'device': latest_full_diff.physical_device_name,
@@ -1,6 +1,7 @@
 import datetime
-from db_utils import connect_to_db_server, get_user_databases, get_backups
-from check_tlog_after_full_diff import check_tlog_after_full_diff
+from db_utils import connect_to_db_server, get_user_databases, get_backup_history
+from check_tlog_after_full_diff import check_tlog_after_full_diff, get_last_tlog_dates, HISTORY_COVERS_TLOG_WINDOW
+from check_state import CheckState
 from server_manager import read_server_list
 from user_whitelist import create_whitelist_file_if_not_exists
 from anomaly_log import log_anomalies, log_critical_anomalies
@@ -39,17 +40,24 @@ def process_server(srv):
             with PRINT_LOCK:
                 print(f"Servidor {instance}: {len(databases)} bases de dados encontradas. A executar funcionalidades...")
             # Para cada base, verifica as anomalias de TLOG
+            # Histórico de backups de toda a instância (cache local sincronizada incrementalmente)
+            backups_by_db = get_backup_history(cursor, instance)
+            # Só se o histórico não cobrir TLOG_HOURS_THRESHOLD: uma query para todas as bases
+            last_tlog_dates = None if HISTORY_COVERS_TLOG_WINDOW else get_last_tlog_dates(cursor)
+            # O estado acompanha os incidentes (ex.: recovery model que volta a não ser FULL)
+            state = CheckState(instance)
             for db in databases:
-                backups = get_backups(cursor, db)
+                backups = backups_by_db.get(db)
                 if not backups:
                     continue
-                anomalies = check_tlog_after_full_diff(db, backups, cursor)
+                anomalies = state.track('3', db, check_tlog_after_full_diff(db, backups, cursor, last_tlog_dates))
                 if anomalies:
                     # Atualiza o campo 'instance' caso não esteja definido, usando o nome obtido
                     for anomaly in anomalies:
                         if not anomaly.get("instance"):
                             anomaly["instance"] = instance.upper()
                     local_anomalias.extend(anomalies)
+            state.save()
         conn.close()
     except Exception as e:
         with PRINT_LOCK:
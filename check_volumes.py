@@ -1,16 +1,16 @@
 import os
 import datetime
-from db_utils import connect_to_db_server
+from db_utils import pooled_connection, iter_rows
 from server_manager import read_server_list
 from anomaly_log import log_anomalies
 from concurrent.futures import ThreadPoolExecutor
 
-def get_all_file_records(master_cursor):
+def iter_all_file_records(master_cursor):
     """
-    Devolve uma lista de registos de ficheiros a partir de todas as bases de dados.
+    Versão em streaming de get_all_file_records: devolve os registos de ficheiros à medida que
+    são lidos do servidor (em lotes fetchmany), sem materializar o sys.master_files inteiro.
     Cada registo é uma tupla: (dbname, physical_name, type_desc)
     """
-    file_records = []
     try:
         query = """
         SELECT d.name AS database_name, mf.physical_name, mf.type_desc
@@ -19,17 +19,23 @@ def get_all_file_records(master_cursor):
         WHERE d.database_id > 4
         """
         master_cursor.execute(query)
-        rows = master_cursor.fetchall()
-        for row in rows:
-            file_records.append((row[0], row[1], row[2]))
+        for row in iter_rows(master_cursor):
+            yield (row[0], row[1], row[2])
     except Exception as e:
         print(f"Erro ao obter registos de ficheiros: {e}")
-    return file_records
+
+def get_all_file_records(master_cursor):
+    """
+    Devolve uma lista de registos de ficheiros a partir de todas as bases de dados.
+    Cada registo é uma tupla: (dbname, physical_name, type_desc)
+    """
+    return list(iter_all_file_records(master_cursor))
 
 def classify_volumes(file_records):
     """
     Classifica os ficheiros com base no type_desc e devolve um dicionário.
     Os ficheiros de dados (ROWS) e de log (LOG) serão separados.
+    Aceita qualquer iterável (ex.: iter_all_file_records), consumido numa só passagem.
     """
     volume_class = {"data": [], "log": []}
     for dbname, path, type_desc in file_records:
@@ -66,6 +72,27 @@ def check_file_volume_anomalies(volume_class):
             })
     return anomalies
 
+def transform_volume_anomalies(anomalies, instance):
+    """
+    Converte as anomalias de volume (check_file_volume_anomalies) para o esquema comum das anomalias
+    (database, type, device, user, instance, timestamp, issues).
+    """
+    transformed_anomalias = []
+    for anomaly in anomalies:
+        original_issue = anomaly.get("issue", "")
+        transformed_issue = original_issue.replace("base de dados", "instância")
+        transformed_anomalias.append({
+            "database": anomaly.get("database", "N/A"),
+            "type": "Verificação de Volume",
+            "device": anomaly.get("file_path", ""),
+            "user": "",
+            "instance": instance,
+            "timestamp": datetime.datetime.now(),
+            "reference": None,
+            "issues": [transformed_issue]
+        })
+    return transformed_anomalias
+
 def check_volume_integrity():
     """
     Verifica se existem ficheiros fora do local esperado em todas as instâncias (para todos os databases).
@@ -88,39 +115,25 @@ def check_volume_integrity():
         server_anomalias = []
         print(f"\n=== Servidor: {server} ===")
         try:
-            conn = connect_to_db_server(server, username, password)
-            cursor = conn.cursor()
-            
-            # Obter o nome real da instância
-            instance = server
-            try:
-                cursor.execute("SELECT @@SERVERNAME")
-                result = cursor.fetchone()
-                if result and result[0]:
-                    instance = result[0]
-            except Exception as e:
-                print(f"Não foi possível obter o nome da instância no servidor {server}: {e}")
-            
-            # Chamada à função get_all_file_records logo após criar o cursor
-            file_records = get_all_file_records(cursor)
-            
-            volume_class = classify_volumes(file_records)
+            with pooled_connection(server, username, password) as conn:
+                cursor = conn.cursor()
+
+                # Obter o nome real da instância
+                instance = server
+                try:
+                    cursor.execute("SELECT @@SERVERNAME")
+                    result = cursor.fetchone()
+                    if result and result[0]:
+                        instance = result[0]
+                except Exception as e:
+                    print(f"Não foi possível obter o nome da instância no servidor {server}: {e}")
+
+                # Classifica os ficheiros à medida que são lidos (streaming) logo após criar o cursor
+                volume_class = classify_volumes(iter_all_file_records(cursor))
+
             anomalies = check_file_volume_anomalies(volume_class)
-            conn.close()
             
-            for anomaly in anomalies:
-                original_issue = anomaly.get("issue", "")
-                transformed_issue = original_issue.replace("base de dados", "instância")
-                transformed = {
-                    "database": anomaly.get("database", "N/A"),
-                    "type": "Verificação de Volume",
-                    "device": anomaly.get("file_path", ""),
-                    "user": "",
-                    "instance": instance,
-                    "timestamp": datetime.datetime.now(),
-                    "issues": [transformed_issue]
-                }
-                server_anomalias.append(transformed)
+            server_anomalias.extend(transform_volume_anomalies(anomalies, instance))
 
             if server_anomalias:
                 print(f"\nAnomalias encontradas na instância {instance}:")
@@ -1,6 +1,7 @@
 import datetime
 from db_utils import connect_to_db_server, get_user_databases
-from check_volumes import get_all_file_records, classify_volumes, check_file_volume_anomalies
+from check_volumes import iter_all_file_records, classify_volumes, check_file_volume_anomalies
+from check_state import CheckState, INSTANCE_ENTRY
 from server_manager import read_server_list
 from user_whitelist import create_whitelist_file_if_not_exists
 from anomaly_log import log_anomalies
@@ -30,16 +31,16 @@ def process_server(srv):
             with PRINT_LOCK:
                 print(f"Não foi possível obter o nome da instância no servidor {server}: {e}")
         
-        # Utiliza get_all_file_records em vez de get_all_file_paths
-        file_records = get_all_file_records(cursor)
+        # Classifica os ficheiros à medida que são lidos (streaming com fetchmany)
+        volume_class = classify_volumes(iter_all_file_records(cursor))
         conn.close()
 
-        if not file_records:
+        file_count = len(volume_class["data"]) + len(volume_class["log"])
+        if not file_count:
             with PRINT_LOCK:
                 print(f"Nenhum ficheiro encontrado no servidor {server}.")
             return local_anomalias
 
-        volume_class = classify_volumes(file_records)
         anomalies = check_file_volume_anomalies(volume_class)
 
         # Transforma as anomalias para o esquema padrão
@@ -52,12 +53,17 @@ def process_server(srv):
                 "user": "",
                 "instance": instance.upper(),
                 "timestamp": datetime.datetime.now(),
+                "reference": None,
                 "issues": [anomaly.get("issue", "")]
             }
             transformed_anomalias.append(transformed)
+        # O estado acompanha os incidentes (um ficheiro que volta a estar no volume errado é registado de novo)
+        state = CheckState(instance)
+        state.track('6', INSTANCE_ENTRY, transformed_anomalias)
+        state.save()
 
         with PRINT_LOCK:
-            print(f"Servidor {instance}: {len(file_records)} ficheiros encontrados. A executar funcionalidades...")
+            print(f"Servidor {instance}: {file_count} ficheiros encontrados. A executar funcionalidades...")
             if transformed_anomalias:
                 print("\n" + "=" * 40)
                 print(f"Relatório de Anomalias - Instância: {instance.upper()}")
@@ -29,11 +29,101 @@ BACKUP_LAST_HOURS = 24                   # Tempo para verificação de backups r
 BACKUP_INTERVAL_HOURS = 48                # Intervalo máximo entre backups consecutivos
 TLOG_HOURS_THRESHOLD = 24         # Tempo máximo sem TLog para considerar anomalia
 
+# Se True, a verificação de frequência de backups (opção 2) é calculada no servidor (LAG/MAX em T-SQL)
+# e só as violações são transferidas, em vez de todo o histórico de backups
+BACKUP_FREQUENCY_PUSHDOWN = False
+
+# Se True e o NumPy estiver instalado, as verificações 2 e 4 são calculadas em arrays (backup_analysis)
+# para todas as bases da instância de uma só vez; sem NumPy, são feitas base a base
+USE_VECTORIZED_ANALYSIS = True
+
+# Cache local do histórico de backups (uma ficheiro por instância, sincronizado incrementalmente
+# a partir do último backup_set_id conhecido). Se False, o histórico é sempre lido do servidor.
+USE_BACKUP_HISTORY_CACHE = True
+BACKUP_CACHE_FOLDER = "backup history cache"
+
+# O resultado de cada verificação por base é guardado (um ficheiro por instância), para acompanhar os incidentes.
+# Reavaliação incremental: com USE_INCREMENTAL_CHECKS, esse resultado é reutilizado enquanto os dados de entrada
+# não mudarem e nenhuma regra dependente do tempo puder mudar; é sempre reavaliado ao fim de metade de
+# CHECK_STATE_RETENTION_DAYS, e as entradas não reavaliadas há mais de CHECK_STATE_RETENTION_DAYS dias são descartadas.
+USE_INCREMENTAL_CHECKS = True
+CHECK_STATE_FOLDER = "check state"
+CHECK_STATE_RETENTION_DAYS = 7
+
 # Pasta onde os logs críticos vão ser arquivados
 CRITICAL_ARCHIVE_FOLDER = "critical anomaly history log"
 
+# Rotação do log crítico (além da rotação diária): tamanho máximo do log antes de ser arquivado.
+# Os arquivos são comprimidos (gzip); os que tiverem mais de CRITICAL_ARCHIVE_RETENTION_DAYS dias são apagados,
+# tal como os mais antigos quando o total da pasta ultrapassa CRITICAL_ARCHIVE_MAX_BYTES.
+CRITICAL_ROTATE_MAX_BYTES = 10 * 1024 * 1024
+CRITICAL_ARCHIVE_RETENTION_DAYS = 365
+CRITICAL_ARCHIVE_MAX_BYTES = 1024 * 1024 * 1024
+
+# Tempo máximo (segundos) de espera pelo lock dos logs de anomalias, partilhado com os outros processos
+FILE_LOCK_TIMEOUT_SECONDS = 60
+
+# Escrita dos logs numa thread dedicada (log_writer.py): as verificações só colocam as anomalias numa fila
+# com LOG_WRITER_QUEUE_SIZE lotes; a thread grava quando junta LOG_WRITER_BATCH_SIZE anomalias ou
+# passam LOG_WRITER_FLUSH_SECONDS segundos. Se False, cada instância grava os logs no fim da sua verificação.
+USE_LOG_WRITER_THREAD = True
+LOG_WRITER_QUEUE_SIZE = 1000
+LOG_WRITER_BATCH_SIZE = 5000
+LOG_WRITER_FLUSH_SECONDS = 2
+
+# Histórico de anomalias em SQLite (anomaly_store.py), além dos logs JSON Lines: sem limite de entradas,
+# indexado para consultas por instância, base de dados, tipo, nível e data
+USE_ANOMALY_STORE = True
+ANOMALY_DB_FILE = "anomaly_history.db"
+ANOMALY_DB_TIMEOUT_SECONDS = 30
+
 # Configurações de conexão
 TIMEOUT_SECONDS = 30
 
+# Número de linhas lidas de cada vez (fetchmany) nas queries consumidas em streaming
+FETCH_BATCH_SIZE = 1000
+
+# Execução assíncrona (async_runner.py) das verificações em todos os servidores:
+# número máximo de servidores em simultâneo, limite de tempo por servidor e threads para as chamadas pyodbc
+USE_ASYNC_RUNNER = False
+ASYNC_MAX_CONCURRENT_SERVERS = 200
+ASYNC_SERVER_DEADLINE_SECONDS = 120
+ASYNC_EXECUTOR_WORKERS = 256
+
+# Tempo (segundos) durante o qual o snapshot de sys.databases de uma conexão é reutilizado
+DATABASE_SNAPSHOT_TTL_SECONDS = 60
+
+# Revogação do role 'sysadmin' (opção 8): o plano de todos os servidores é calculado em paralelo.
+# "python revoke_backup_permissions.py --plan" grava o plano em REVOKE_PLAN_FILE para aprovação e
+# "python revoke_backup_permissions.py --apply revoke_plan.json" executa-o sem confirmação interativa,
+# desde que tenha menos de REVOKE_PLAN_MAX_AGE_HOURS horas; cada login é revalidado antes da revogação
+REVOKE_PLAN_FILE = "revoke_plan.json"
+REVOKE_PLAN_MAX_AGE_HOURS = 24
+REVOKE_MAX_WORKERS = 32
+
+# Pre-flight TCP do teste de ligações (server_connection_test.py): timeout (segundos) da ligação TCP
+# e número de servidores testados em paralelo
+PREFLIGHT_TIMEOUT_SECONDS = 0.8
+PREFLIGHT_MAX_WORKERS = 64
+
+# Circuit breaker por servidor (server_health.py): após CIRCUIT_FAILURE_THRESHOLD falhas seguidas o servidor
+# é ignorado durante um backoff exponencial (CIRCUIT_BASE_BACKOFF_SECONDS, até CIRCUIT_MAX_BACKOFF_SECONDS);
+# depois é testado com uma ligação curta (CIRCUIT_PROBE_TIMEOUT_SECONDS)
+SERVER_HEALTH_FILE = "server_health.json"
+CIRCUIT_FAILURE_THRESHOLD = 2
+CIRCUIT_BASE_BACKOFF_SECONDS = 300
+CIRCUIT_MAX_BACKOFF_SECONDS = 6 * 3600
+CIRCUIT_PROBE_TIMEOUT_SECONDS = 3
+
+# Pool de conexões (db_utils): máximo de conexões abertas por servidor/utilizador,
+# tempo (segundos) após o qual uma conexão parada é fechada e tempo máximo de espera por uma conexão livre
+POOL_MAX_CONNECTIONS_PER_SERVER = 4
+POOL_IDLE_SECONDS = 300
+POOL_ACQUIRE_TIMEOUT_SECONDS = 60
+
+# Número de conexões por instância usadas para verificar as bases em paralelo (1 = sequencial).
+# Nunca ultrapassa POOL_MAX_CONNECTIONS_PER_SERVER, para limitar a carga em produção.
+INSTANCE_PARALLEL_CONNECTIONS = 1
+
 
 
@@ -1,38 +1,390 @@
 import pyodbc
+import os
+import re
+import json
 import datetime
-from config import SYSTEM_DATABASES, BACKUP_DATE_THRESHOLD_WEEKS, TIMEOUT_SECONDS
+import time
+import sys
+import atexit
+import threading
+import weakref
+from enum import IntEnum
+from collections import namedtuple
+from itertools import groupby
+from contextlib import contextmanager
+from config import (SYSTEM_DATABASES, BACKUP_DATE_THRESHOLD_WEEKS, TIMEOUT_SECONDS,
+                    POOL_MAX_CONNECTIONS_PER_SERVER, POOL_IDLE_SECONDS, POOL_ACQUIRE_TIMEOUT_SECONDS,
+                    USE_BACKUP_HISTORY_CACHE, BACKUP_CACHE_FOLDER, FETCH_BATCH_SIZE,
+                    DATABASE_SNAPSHOT_TTL_SECONDS)
+from server_health import check_server_available, record_connection_failure, record_connection_success
+from file_lock import file_lock
 
 # Função descontinuada: usar connect_to_db_server em vez desta.
 # def connect_to_db():
 #     return pyodbc.connect(CONN_STR, autocommit=True)
 
-def connect_to_db_server(server, username, password):
+def connect_to_db_server(server, username, password, check_circuit=True):
     """
     Conecta a um servidor específico com base nos parâmetros fornecidos.
     Se 'username' estiver vazio, utiliza Trusted_Connection.
     Utiliza TIMEOUT_SECONDS definido em config.py.
+    Servidores marcados como indisponíveis (server_health) são ignorados de imediato
+    (ServerUnavailableError) ou testados com um timeout curto quando chega a hora de nova tentativa.
+    Com 'check_circuit' False (ex.: teste de ligações) a ligação é sempre tentada; o resultado
+    continua a ser registado no server_health.
     """
-    timeout = f"Connection Timeout={TIMEOUT_SECONDS};"
+    probe_timeout = check_server_available(server) if check_circuit else None
+    timeout = f"Connection Timeout={probe_timeout or TIMEOUT_SECONDS};"
     if username:
         conn_str = f"DRIVER={{SQL Server}};SERVER={server};DATABASE=master;UID={username};PWD={password};{timeout}"
     else:
         conn_str = f"DRIVER={{SQL Server}};SERVER={server};DATABASE=master;Trusted_Connection=yes;{timeout}"
-    return pyodbc.connect(conn_str, autocommit=True)
+    try:
+        conn = pyodbc.connect(conn_str, autocommit=True)
+    except Exception as e:
+        record_connection_failure(server, e)
+        raise
+    record_connection_success(server)
+    return conn
 
-def get_user_databases(cursor):
-    # dá fetch a todas as DBs, exceto as system databases definidas
+def is_connection_alive(conn):
+    """
+    Verifica (com uma query trivial) se uma conexão continua utilizável.
+    """
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT 1")
+        cursor.fetchone()
+        cursor.close()
+        return True
+    except Exception:
+        return False
+
+class ConnectionPool:
+    """
+    Pool de conexões reutilizáveis, agrupadas por (servidor, utilizador).
+    - Entrega conexões já abertas (validadas com is_connection_alive) sempre que possível.
+    - Limita o número de conexões abertas por servidor a 'max_per_server'; quando o limite é
+      atingido, espera até 'acquire_timeout' segundos por uma conexão livre.
+    - Fecha as conexões que estejam paradas há mais de 'idle_seconds'.
+    """
+
+    def __init__(self, max_per_server=POOL_MAX_CONNECTIONS_PER_SERVER, idle_seconds=POOL_IDLE_SECONDS,
+                 acquire_timeout=POOL_ACQUIRE_TIMEOUT_SECONDS):
+        self.max_per_server = max_per_server
+        self.idle_seconds = idle_seconds
+        self.acquire_timeout = acquire_timeout
+        self._condition = threading.Condition()
+        self._idle = {}        # chave -> lista de (conexão, instante da última utilização)
+        self._open_count = {}  # chave -> número de conexões abertas (livres + em uso)
+        self._owners = {}      # id(conexão) -> chave
+
+    @staticmethod
+    def _key(server, username):
+        return (server.strip().lower(), (username or "").strip().lower())
+
+    def _pop_expired(self, now):
+        # Retira (com o lock obtido) as conexões paradas há mais de idle_seconds
+        expired = []
+        for key, entries in self._idle.items():
+            keep = []
+            for conn, last_used in entries:
+                if now - last_used > self.idle_seconds:
+                    expired.append(conn)
+                    self._forget(conn, key)
+                else:
+                    keep.append((conn, last_used))
+            self._idle[key] = keep
+        return expired
+
+    def _forget(self, conn, key):
+        self._owners.pop(id(conn), None)
+        self._open_count[key] = max(self._open_count.get(key, 1) - 1, 0)
+        self._condition.notify()
+
+    @staticmethod
+    def _close_quietly(conns):
+        for conn in conns:
+            invalidate_databases_snapshot(conn)
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+    def acquire(self, server, username, password):
+        """
+        Devolve uma conexão para o servidor indicado: reutiliza uma conexão livre (validada)
+        ou abre uma nova, respeitando o limite por servidor.
+        """
+        key = self._key(server, username)
+        deadline = time.monotonic() + self.acquire_timeout
+        while True:
+            with self._condition:
+                expired = self._pop_expired(time.monotonic())
+                candidate = None
+                while True:
+                    idle = self._idle.get(key)
+                    if idle:
+                        candidate = idle.pop()[0]
+                        break
+                    if self._open_count.get(key, 0) < self.max_per_server:
+                        # Reserva a vaga antes de abrir a conexão fora do lock
+                        self._open_count[key] = self._open_count.get(key, 0) + 1
+                        break
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._close_quietly(expired)
+                        raise TimeoutError(f"Sem conexões livres para o servidor {server} "
+                                           f"(limite de {self.max_per_server} por servidor).")
+                    self._condition.wait(remaining)
+            self._close_quietly(expired)
+
+            if candidate is None:
+                try:
+                    conn = connect_to_db_server(server, username, password)
+                except Exception:
+                    with self._condition:
+                        self._open_count[key] = max(self._open_count.get(key, 1) - 1, 0)
+                        self._condition.notify()
+                    raise
+                with self._condition:
+                    self._owners[id(conn)] = key
+                return conn
+
+            if is_connection_alive(candidate):
+                return candidate
+            # Conexão morta: descarta-a e tenta novamente
+            with self._condition:
+                self._forget(candidate, key)
+            self._close_quietly([candidate])
+
+    def release(self, conn, discard=False):
+        """
+        Devolve a conexão ao pool (ou fecha-a, se 'discard' for True ou se não pertencer ao pool).
+        """
+        if conn is None:
+            return
+        with self._condition:
+            key = self._owners.get(id(conn))
+            if key is not None and not discard:
+                self._idle.setdefault(key, []).append((conn, time.monotonic()))
+                self._condition.notify()
+                return
+            if key is not None:
+                self._forget(conn, key)
+        self._close_quietly([conn])
+
+    def close_idle(self):
+        """Fecha as conexões paradas há mais de idle_seconds."""
+        with self._condition:
+            expired = self._pop_expired(time.monotonic())
+        self._close_quietly(expired)
+
+    def close_all(self):
+        """Fecha todas as conexões livres do pool."""
+        with self._condition:
+            conns = []
+            for key, entries in self._idle.items():
+                for conn, _ in entries:
+                    conns.append(conn)
+                    self._forget(conn, key)
+            self._idle.clear()
+        self._close_quietly(conns)
+
+CONNECTION_POOL = ConnectionPool()
+atexit.register(CONNECTION_POOL.close_all)
+
+def acquire_connection(server, username, password):
+    """
+    Obtém uma conexão do pool global (reutilizada se possível).
+    Deve ser devolvida com release_connection.
+    """
+    return CONNECTION_POOL.acquire(server, username, password)
+
+def release_connection(conn, discard=False):
+    """Devolve uma conexão obtida com acquire_connection ao pool global."""
+    CONNECTION_POOL.release(conn, discard)
+
+@contextmanager
+def pooled_connection(server, username, password):
+    """
+    Context manager sobre acquire_connection/release_connection.
+    Se ocorrer um erro de ligação (pyodbc.Error) a conexão é descartada em vez de reutilizada.
+    """
+    conn = acquire_connection(server, username, password)
+    discard = False
+    try:
+        yield conn
+    except pyodbc.Error:
+        discard = True
+        raise
+    finally:
+        release_connection(conn, discard)
+
+def iter_rows(cursor, batch_size=FETCH_BATCH_SIZE):
+    """
+    Percorre o resultado da última query do cursor em lotes de 'batch_size' linhas (fetchmany),
+    sem materializar o resultado inteiro em memória.
+    O cursor não pode ser usado para outra query enquanto o gerador não for consumido.
+    """
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            break
+        yield from rows
+
+def iter_user_databases(cursor, batch_size=FETCH_BATCH_SIZE):
+    # versão em streaming de get_user_databases
     cursor.execute("""
         SELECT name FROM sys.databases
         WHERE name NOT IN (?, ?, ?, ?)
     """, SYSTEM_DATABASES)
-    return [row.name for row in cursor.fetchall()]
+    for row in iter_rows(cursor, batch_size):
+        yield row.name
 
-def get_backups(cursor, database):
+def get_user_databases(cursor):
+    # dá fetch a todas as DBs, exceto as system databases definidas
+    return list(iter_user_databases(cursor))
+
+# Metadados de uma base de dados (linha de sys.databases) guardados no snapshot da instância
+DatabaseInfo = namedtuple("DatabaseInfo", [
+    "database_id", "name", "state_desc", "recovery_model_desc", "user_access_desc",
+    "is_read_only", "create_date",
+])
+
+# Snapshots por conexão: (instante da leitura, {nome: DatabaseInfo}).
+# As conexões que aceitam referências fracas são chaves de um WeakKeyDictionary (a entrada desaparece com
+# a conexão). As outras (ex.: pyodbc.Connection) ficam em _DATABASE_SNAPSHOTS, por id(conexão), com uma
+# referência à própria conexão para o id não poder ser reutilizado por outra; essas entradas são removidas
+# ao fechar a conexão no pool ou, para conexões fechadas por quem as abriu, quando o snapshot expira.
+_WEAK_DATABASE_SNAPSHOTS = weakref.WeakKeyDictionary()
+_DATABASE_SNAPSHOTS = {}   # id(conexão) -> (conexão, instante da leitura, snapshot)
+_DATABASE_SNAPSHOTS_LOCK = threading.Lock()
+
+def _get_snapshot_entry(conn):
+    try:
+        return _WEAK_DATABASE_SNAPSHOTS.get(conn)
+    except TypeError:
+        entry = _DATABASE_SNAPSHOTS.get(id(conn))
+        return entry[1:] if entry is not None and entry[0] is conn else None
+
+def _store_snapshot_entry(conn, now, snapshot):
+    # Descarta os snapshots expirados (e as referências às conexões que já ninguém usa)
+    for key, entry in list(_DATABASE_SNAPSHOTS.items()):
+        if now - entry[1] > DATABASE_SNAPSHOT_TTL_SECONDS:
+            del _DATABASE_SNAPSHOTS[key]
+    try:
+        _WEAK_DATABASE_SNAPSHOTS[conn] = (now, snapshot)
+    except TypeError:
+        _DATABASE_SNAPSHOTS[id(conn)] = (conn, now, snapshot)
+
+def get_databases_snapshot(cursor, max_age=DATABASE_SNAPSHOT_TTL_SECONDS):
+    """
+    Devolve um snapshot de sys.databases ({nome: DatabaseInfo}) lido uma única vez por conexão.
+    O snapshot é reutilizado durante 'max_age' segundos; depois disso é lido novamente,
+    para que um processo de longa duração veja as alterações de estado das bases.
+    """
+    conn = getattr(cursor, "connection", cursor)
+    now = time.monotonic()
+    with _DATABASE_SNAPSHOTS_LOCK:
+        entry = _get_snapshot_entry(conn)
+    if entry is not None and now - entry[0] <= max_age:
+        return entry[1]
+
+    cursor.execute("""
+        SELECT database_id, name, state_desc, recovery_model_desc, user_access_desc,
+               is_read_only, create_date
+        FROM sys.databases
+    """)
+    snapshot = {
+        row.name: DatabaseInfo(row.database_id, row.name, row.state_desc, row.recovery_model_desc,
+                               row.user_access_desc, bool(row.is_read_only), row.create_date)
+        for row in cursor.fetchall()
+    }
+    with _DATABASE_SNAPSHOTS_LOCK:
+        _store_snapshot_entry(conn, now, snapshot)
+    return snapshot
+
+def invalidate_databases_snapshot(conn):
+    """Descarta o snapshot de sys.databases associado à conexão (ex.: quando é fechada)."""
+    with _DATABASE_SNAPSHOTS_LOCK:
+        try:
+            _WEAK_DATABASE_SNAPSHOTS.pop(conn, None)
+        except TypeError:
+            entry = _DATABASE_SNAPSHOTS.get(id(conn))
+            if entry is not None and entry[0] is conn:
+                del _DATABASE_SNAPSHOTS[id(conn)]
+
+class BackupType(IntEnum):
+    """Tipo de backup (bs.type) guardado como um inteiro pequeno em vez da descrição."""
+    OTHER = 0
+    FULL = 1
+    DIFFERENTIAL = 2
+    TLOG = 3
+
+# Descrições usadas pelas verificações (as mesmas do CASE bs.type das queries)
+BACKUP_TYPE_LABELS = {
+    BackupType.OTHER: None,
+    BackupType.FULL: 'Full backup',
+    BackupType.DIFFERENTIAL: 'Differential',
+    BackupType.TLOG: 'TLog',
+}
+BACKUP_TYPES_BY_LABEL = {label: backup_type for backup_type, label in BACKUP_TYPE_LABELS.items()}
+
+def _intern(value):
+    return sys.intern(value) if isinstance(value, str) else value
+
+class Backup:
+    """
+    Registo compacto de um backup (substitui as linhas pyodbc.Row devolvidas pelas queries).
+    Usa __slots__, guarda o tipo como BackupType e partilha (sys.intern) as strings repetidas
+    em todas as linhas (nome da base, instância e utilizador).
+    Expõe os mesmos atributos que as verificações usam: backup_type, user_name, is_copy_only,
+    backup_finish_date, backup_size, physical_device_name, database_name e instance_name.
+    """
+    __slots__ = ("backup_set_id", "database_name", "type_code", "backup_start_date", "backup_finish_date",
+                 "is_copy_only", "physical_device_name", "user_name", "backup_size", "instance_name")
+
+    def __init__(self, backup_set_id, database_name, backup_type, backup_start_date, backup_finish_date,
+                 is_copy_only, physical_device_name, user_name, backup_size, instance_name):
+        self.backup_set_id = backup_set_id
+        self.database_name = _intern(database_name)
+        self.type_code = (backup_type if isinstance(backup_type, BackupType)
+                          else BACKUP_TYPES_BY_LABEL.get(backup_type, BackupType.OTHER))
+        self.backup_start_date = backup_start_date
+        self.backup_finish_date = backup_finish_date
+        self.is_copy_only = bool(is_copy_only)
+        self.physical_device_name = physical_device_name
+        self.user_name = _intern(user_name)
+        self.backup_size = int(backup_size) if backup_size is not None else None
+        self.instance_name = _intern(instance_name)
+
+    @property
+    def backup_type(self):
+        return BACKUP_TYPE_LABELS[self.type_code]
+
+    @classmethod
+    def from_row(cls, row, instance_name=None):
+        """Cria um Backup a partir de uma linha das queries de backups (pyodbc.Row)."""
+        return cls(
+            getattr(row, "backup_set_id", None), row.database_name, row.backup_type,
+            row.backup_start_date, row.backup_finish_date, row.is_copy_only,
+            row.physical_device_name, row.user_name, row.backup_size,
+            instance_name if instance_name is not None else getattr(row, "instance_name", None),
+        )
+
+    def __repr__(self):
+        return (f"Backup({self.database_name!r}, {self.backup_type!r}, "
+                f"{self.backup_finish_date!r}, {self.user_name!r})")
+
+def iter_backups(cursor, database, batch_size=FETCH_BATCH_SIZE):
+    """Versão em streaming de get_backups: devolve os Backup da base à medida que são lidos."""
     # Calcula a data mínima a ser considerada com base na configuração
     min_date = datetime.datetime.now() - datetime.timedelta(weeks=BACKUP_DATE_THRESHOLD_WEEKS)
     # Recupera os backups para a base de dados especificada, realizando a filtração pela data mínima
     cursor.execute("""
         SELECT
+            bs.backup_set_id,
             bs.database_name,
             CASE bs.type
                 WHEN 'D' THEN 'Full backup'
@@ -53,4 +405,239 @@ def get_backups(cursor, database):
           AND bs.backup_finish_date >= ?
         ORDER BY bs.backup_finish_date DESC
     """, (database, min_date))
-    return cursor.fetchall()
+    for row in iter_rows(cursor, batch_size):
+        yield Backup.from_row(row)
+
+def get_backups(cursor, database):
+    return list(iter_backups(cursor, database))
+
+# Número máximo de parâmetros por query no SQL Server e de nomes de bases por query
+MAX_QUERY_PARAMETERS = 2100
+MAX_DATABASES_PER_QUERY = 2000
+
+def build_database_filters(databases=None, column="bs.database_name", chunk_size=MAX_DATABASES_PER_QUERY):
+    """
+    Constrói os filtros WHERE (e respetivos parâmetros) para restringir uma query às bases indicadas.
+    Sem lista explícita, exclui apenas as system databases (uma única query para a instância);
+    com lista, divide-a em lotes de 'chunk_size' nomes (a query que usa outros parâmetros deve
+    descontá-los de MAX_QUERY_PARAMETERS).
+    Devolve uma lista de tuplas (filtro_sql, parametros).
+    """
+    if databases is None:
+        placeholders = ", ".join("?" for _ in SYSTEM_DATABASES)
+        return [(f"{column} NOT IN ({placeholders})", list(SYSTEM_DATABASES))]
+    databases = list(databases)
+    filters = []
+    for i in range(0, len(databases), chunk_size):
+        chunk = databases[i:i + chunk_size]
+        placeholders = ", ".join("?" for _ in chunk)
+        filters.append((f"{column} IN ({placeholders})", chunk))
+    return filters
+
+# Histórico de backups de várias bases (usado por get_all_backups e iter_all_backups)
+ALL_BACKUPS_QUERY = """
+        SELECT
+            bs.backup_set_id,
+            bs.database_name,
+            CASE bs.type
+                WHEN 'D' THEN 'Full backup'
+                WHEN 'I' THEN 'Differential'
+                WHEN 'L' THEN 'TLog'
+            END AS backup_type,
+            bs.backup_start_date,
+            bs.backup_finish_date,
+            bs.is_copy_only,
+            bmf.physical_device_name,
+            bs.user_name,
+            bs.backup_size,
+            @@SERVERNAME AS instance_name
+        FROM msdb.dbo.backupset bs
+        INNER JOIN msdb.dbo.backupmediafamily bmf
+            ON bs.media_set_id = bmf.media_set_id
+        WHERE {database_filter}
+          AND bs.backup_finish_date >= ?
+        ORDER BY bs.database_name, bs.backup_finish_date DESC
+    """
+
+def iter_all_backups(cursor, databases=None, batch_size=FETCH_BATCH_SIZE):
+    """
+    Versão em streaming de get_all_backups: devolve os Backup de todas as bases (ou das indicadas),
+    ordenados por database_name e backup_finish_date descendente, à medida que são lidos.
+    """
+    min_date = datetime.datetime.now() - datetime.timedelta(weeks=BACKUP_DATE_THRESHOLD_WEEKS)
+    for database_filter, params in build_database_filters(databases):
+        cursor.execute(ALL_BACKUPS_QUERY.format(database_filter=database_filter), (*params, min_date))
+        for row in iter_rows(cursor, batch_size):
+            yield Backup.from_row(row)
+
+def iter_backups_by_database(cursor, databases=None, batch_size=FETCH_BATCH_SIZE):
+    """
+    Agrupa em streaming o resultado de iter_all_backups: devolve pares (database_name, iterador de Backup).
+    Cada iterador tem de ser consumido (numa só passagem) antes de avançar para a base seguinte.
+    """
+    for database, backups in groupby(iter_all_backups(cursor, databases, batch_size),
+                                     key=lambda b: b.database_name):
+        yield database, backups
+
+def get_all_backups(cursor, databases=None):
+    """
+    Obtém numa única query o histórico de backups de todas as user databases da instância
+    (ou apenas das bases indicadas em 'databases') e agrupa-o em memória por database_name.
+    Devolve um dicionário {database_name: [Backup]} em que cada lista tem a mesma ordem
+    (backup_finish_date descendente) que get_backups.
+    """
+    backups_by_db = {}
+    for backup in iter_all_backups(cursor, databases):
+        backups_by_db.setdefault(backup.database_name, []).append(backup)
+    return backups_by_db
+
+# Os IDENTITY do backupset podem ficar visíveis fora de ordem (commits concorrentes),
+# por isso cada sincronização volta a ler uma pequena margem abaixo da marca
+BACKUP_CACHE_OVERLAP_IDS = 50
+
+_BACKUP_CACHE_LOCK = threading.Lock()
+
+# Versão do formato do ficheiro de cache; caches com outra versão são descartadas e refeitas
+BACKUP_CACHE_VERSION = 2
+
+def get_backup_cache_file(instance):
+    """Devolve o caminho do ficheiro de cache do histórico de backups da instância."""
+    safe_name = re.sub(r"[^A-Za-z0-9_.-]", "_", instance)
+    return os.path.join(BACKUP_CACHE_FOLDER, f"{safe_name}.json")
+
+def load_backup_cache(instance):
+    """
+    Lê a cache local da instância. Devolve (watermark, {backup_set_id: [Backup]}).
+    Se a cache não existir ou estiver corrompida, devolve uma cache vazia.
+    """
+    try:
+        with open(get_backup_cache_file(instance), "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except Exception:
+        return 0, {}
+    if data.get("version") != BACKUP_CACHE_VERSION:
+        return 0, {}
+    records = {}
+    instance = sys.intern(instance)
+    for row in data.get("backups", []):
+        (backup_set_id, database_name, type_code, start, finish,
+         is_copy_only, device, user_name, backup_size) = row
+        record = Backup(
+            backup_set_id, database_name, BackupType(type_code),
+            datetime.datetime.fromisoformat(start) if start else None,
+            datetime.datetime.fromisoformat(finish),
+            is_copy_only, device, user_name, backup_size, instance,
+        )
+        records.setdefault(backup_set_id, []).append(record)
+    return data.get("watermark", 0), records
+
+def save_backup_cache(instance, watermark, records):
+    """
+    Grava a cache local da instância (escreve num ficheiro temporário próprio do processo e substitui
+    o anterior). Deve ser chamada com o file_lock do ficheiro de cache obtido.
+    """
+    if not os.path.exists(BACKUP_CACHE_FOLDER):
+        os.makedirs(BACKUP_CACHE_FOLDER, exist_ok=True)
+    rows = []
+    for entries in records.values():
+        for r in entries:
+            rows.append([
+                r.backup_set_id, r.database_name, int(r.type_code),
+                r.backup_start_date.isoformat() if r.backup_start_date else None,
+                r.backup_finish_date.isoformat(),
+                r.is_copy_only, r.physical_device_name, r.user_name, r.backup_size,
+            ])
+    path = get_backup_cache_file(instance)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({"version": BACKUP_CACHE_VERSION, "instance": instance, "watermark": watermark, "backups": rows}, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+def sync_backup_history(cursor, instance=None):
+    """
+    Sincroniza incrementalmente a cache local do histórico de backups da instância:
+    - Lê apenas as linhas do backupset com backup_set_id acima da marca (watermark) guardada.
+    - Remove da cache os backups fora da janela de BACKUP_DATE_THRESHOLD_WEEKS semanas.
+    - Se o msdb tiver sido limpo/restaurado (MAX(backup_set_id) abaixo da marca), refaz a cache.
+    Devolve um dicionário {database_name: [Backup]} no mesmo formato que get_all_backups.
+    """
+    if instance is None:
+        cursor.execute("SELECT @@SERVERNAME")
+        instance = cursor.fetchone()[0]
+    min_date = datetime.datetime.now() - datetime.timedelta(weeks=BACKUP_DATE_THRESHOLD_WEEKS)
+
+    with _BACKUP_CACHE_LOCK:
+        watermark, records = load_backup_cache(instance)
+
+    cursor.execute("SELECT MAX(backup_set_id) FROM msdb.dbo.backupset")
+    row = cursor.fetchone()
+    server_max = row[0] if row and row[0] is not None else 0
+    if server_max < watermark:
+        watermark, records = 0, {}
+
+    placeholders = ", ".join("?" for _ in SYSTEM_DATABASES)
+    cursor.execute(f"""
+        SELECT
+            bs.backup_set_id,
+            bs.database_name,
+            CASE bs.type
+                WHEN 'D' THEN 'Full backup'
+                WHEN 'I' THEN 'Differential'
+                WHEN 'L' THEN 'TLog'
+            END AS backup_type,
+            bs.backup_start_date,
+            bs.backup_finish_date,
+            bs.is_copy_only,
+            bmf.physical_device_name,
+            bs.user_name,
+            bs.backup_size
+        FROM msdb.dbo.backupset bs
+        INNER JOIN msdb.dbo.backupmediafamily bmf
+            ON bs.media_set_id = bmf.media_set_id
+        WHERE bs.backup_set_id > ?
+          AND bs.database_name NOT IN ({placeholders})
+          AND bs.backup_finish_date >= ?
+    """, (max(watermark - BACKUP_CACHE_OVERLAP_IDS, 0), *SYSTEM_DATABASES, min_date))
+    fetched = {}
+    for row in iter_rows(cursor):
+        fetched.setdefault(row.backup_set_id, []).append(Backup.from_row(row, instance))
+    # Substitui (por backup_set_id) as linhas relidas na margem e acrescenta as novas
+    records.update(fetched)
+    watermark = max([watermark, server_max, *fetched.keys()])
+
+    # O main.py e os *_app.py podem sincronizar a mesma instância ao mesmo tempo: com o lock do ficheiro
+    # (partilhado entre processos), a cache é relida e as linhas gravadas entretanto por outro processo
+    # são juntadas às nossas antes de gravar (exceto se forem de um msdb já limpo/restaurado)
+    if not os.path.exists(BACKUP_CACHE_FOLDER):
+        os.makedirs(BACKUP_CACHE_FOLDER, exist_ok=True)
+    with file_lock(get_backup_cache_file(instance)):
+        disk_watermark, disk_records = load_backup_cache(instance)
+        if disk_watermark <= server_max:
+            disk_records.update(records)
+            records = disk_records
+            watermark = max(watermark, disk_watermark)
+
+        # Expira os backups fora da janela configurada
+        records = {
+            backup_set_id: entries for backup_set_id, entries in records.items()
+            if entries[0].backup_finish_date >= min_date
+        }
+        save_backup_cache(instance, watermark, records)
+
+    backups_by_db = {}
+    for entries in records.values():
+        for record in entries:
+            backups_by_db.setdefault(record.database_name, []).append(record)
+    for backups in backups_by_db.values():
+        backups.sort(key=lambda b: b.backup_finish_date, reverse=True)
+    return backups_by_db
+
+def get_backup_history(cursor, instance=None):
+    """
+    Devolve o histórico de backups da instância agrupado por base ({database_name: [backups]}).
+    Usa a cache local sincronizada incrementalmente (sync_backup_history) se USE_BACKUP_HISTORY_CACHE
+    estiver ativo; caso contrário lê todo o histórico do servidor (get_all_backups).
+    """
+    if USE_BACKUP_HISTORY_CACHE:
+        return sync_backup_history(cursor, instance)
+    return get_all_backups(cursor)
@@ -0,0 +1,71 @@
+import os
+import time
+import threading
+from contextlib import contextmanager
+from config import FILE_LOCK_TIMEOUT_SECONDS
+
+# Lock exclusivo sobre um ficheiro, partilhado entre threads e entre processos
+# (ex.: main.py e os executáveis *_app.py a correr na mesma pasta).
+# Em Windows usa msvcrt.locking; nos outros sistemas usa fcntl.flock.
+try:
+    import msvcrt
+except ImportError:
+    msvcrt = None
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+_THREAD_LOCKS = {}
+_THREAD_LOCKS_GUARD = threading.Lock()
+_RETRY_SECONDS = 0.05
+
+def _thread_lock(path):
+    # O lock de ficheiro é do processo: as threads do mesmo processo são serializadas antes dele
+    key = os.path.abspath(path)
+    with _THREAD_LOCKS_GUARD:
+        return _THREAD_LOCKS.setdefault(key, threading.RLock())
+
+def _lock_fd(fd):
+    if msvcrt is not None:
+        msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+    elif fcntl is not None:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+def _unlock_fd(fd):
+    if msvcrt is not None:
+        os.lseek(fd, 0, os.SEEK_SET)
+        msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+    elif fcntl is not None:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+
+@contextmanager
+def file_lock(path, timeout=FILE_LOCK_TIMEOUT_SECONDS):
+    """
+    Obtém o lock exclusivo associado a 'path' (ficheiro auxiliar 'path.lock').
+    Lança TimeoutError se não o conseguir obter em 'timeout' segundos.
+    """
+    thread_lock = _thread_lock(path)
+    if not thread_lock.acquire(timeout=timeout):
+        raise TimeoutError(f"Não foi possível obter o lock de {path} em {timeout}s")
+    try:
+        fd = os.open(path + ".lock", os.O_RDWR | os.O_CREAT, 0o666)
+        try:
+            deadline = time.monotonic() + timeout
+            while True:
+                try:
+                    os.lseek(fd, 0, os.SEEK_SET)
+                    _lock_fd(fd)
+                    break
+                except OSError:
+                    if time.monotonic() >= deadline:
+                        raise TimeoutError(f"Não foi possível obter o lock de {path} em {timeout}s")
+                    time.sleep(_RETRY_SECONDS)
+            try:
+                yield
+            finally:
+                _unlock_fd(fd)
+        finally:
+            os.close(fd)
+    finally:
+        thread_lock.release()
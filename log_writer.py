@@ -0,0 +1,99 @@
+import time
+import queue
+import atexit
+import threading
+from anomaly_log import log_anomalies, log_critical_anomalies
+from config import LOG_WRITER_QUEUE_SIZE, LOG_WRITER_BATCH_SIZE, LOG_WRITER_FLUSH_SECONDS
+
+# Escrita dos logs de anomalias numa thread dedicada: as threads que verificam os servidores
+# só colocam as anomalias numa fila limitada (enqueue_anomalies) e continuam o trabalho.
+# A thread de escrita junta as anomalias de todos os servidores e grava-as num único lote quando
+# o lote atinge LOG_WRITER_BATCH_SIZE anomalias ou passam LOG_WRITER_FLUSH_SECONDS segundos.
+# Se a fila estiver cheia (disco lento), enqueue_anomalies espera por espaço.
+
+_STOP = object()
+
+class LogWriter:
+    """Thread de escrita dos logs geral e crítico, alimentada por uma fila limitada."""
+
+    def __init__(self, queue_size=LOG_WRITER_QUEUE_SIZE, batch_size=LOG_WRITER_BATCH_SIZE,
+                 flush_seconds=LOG_WRITER_FLUSH_SECONDS):
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._thread = threading.Thread(target=self._run, name="anomaly-log-writer", daemon=True)
+        self._thread.start()
+
+    def is_alive(self):
+        return self._thread.is_alive()
+
+    def enqueue(self, anomalies):
+        """Coloca uma lista de anomalias na fila (bloqueia enquanto a fila estiver cheia)."""
+        if anomalies:
+            self._queue.put(list(anomalies))
+
+    def close(self):
+        """Pede à thread que grave tudo o que está na fila e espera que termine."""
+        if self._thread.is_alive():
+            self._queue.put(_STOP)
+            self._thread.join()
+
+    def _run(self):
+        batch = []
+        deadline = None
+        while True:
+            timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+            if item is _STOP:
+                self._flush(batch)
+                return
+            if item:
+                if not batch:
+                    deadline = time.monotonic() + self.flush_seconds
+                batch.extend(item)
+            if batch and (len(batch) >= self.batch_size or time.monotonic() >= deadline):
+                self._flush(batch)
+                batch = []
+                deadline = None
+
+    def _flush(self, batch):
+        if not batch:
+            return
+        # Um erro de escrita não pode parar a thread (as anomalias seguintes continuam a ser gravadas),
+        # nem impedir a escrita no outro log: o log crítico é o que origina os alertas por email
+        try:
+            log_anomalies(batch)
+        except Exception as e:
+            print(f"Erro ao gravar {len(batch)} anomalias no log geral: {type(e).__name__} - {e}")
+        try:
+            log_critical_anomalies(batch)
+        except Exception as e:
+            print(f"Erro ao gravar as anomalias críticas no log crítico: {type(e).__name__} - {e}")
+
+_WRITER = None
+_WRITER_LOCK = threading.Lock()
+
+def get_log_writer():
+    """Devolve a thread de escrita do processo (criada na primeira utilização)."""
+    global _WRITER
+    with _WRITER_LOCK:
+        if _WRITER is None or not _WRITER.is_alive():
+            _WRITER = LogWriter()
+        return _WRITER
+
+def enqueue_anomalies(anomalies):
+    """Entrega as anomalias à thread de escrita (o log crítico recebe as de level 0)."""
+    get_log_writer().enqueue(anomalies)
+
+def shutdown_log_writer():
+    """Grava as anomalias pendentes e termina a thread de escrita (também chamada à saída do processo)."""
+    global _WRITER
+    with _WRITER_LOCK:
+        writer, _WRITER = _WRITER, None
+    if writer is not None:
+        writer.close()
+
+atexit.register(shutdown_log_writer)
@@ -1,18 +1,19 @@
 import time
 from collections import defaultdict
-from db_utils import connect_to_db_server, get_user_databases, get_backups
-from check_authorized_users import check_authorized_users
-from check_backup_frequency import check_backup_frequency
-from check_tlog_after_full_diff import check_tlog_after_full_diff
-from check_file_size import check_file_size
-from check_db_status import check_db_status  
+from db_utils import acquire_connection, release_connection, pooled_connection, get_user_databases
+from check_registry import (CHECK_REGISTRY, SCOPE_DATABASE, DATASET_BACKUPS, run_checks, resolve_checks,
+                            plan_datasets, load_backups)
 from user_whitelist import create_whitelist_file_if_not_exists
 from anomaly_log import log_anomalies, archive_critical_log, log_critical_anomalies
+from log_writer import enqueue_anomalies, shutdown_log_writer
 from notification import send_alert_email     
 import os
 import datetime
 import threading
 from check_volumes import check_volume_integrity  # Adiciona esta importação
+from concurrent.futures import ThreadPoolExecutor
+from config import (USE_BACKUP_HISTORY_CACHE, USE_ASYNC_RUNNER, INSTANCE_PARALLEL_CONNECTIONS,
+                    POOL_MAX_CONNECTIONS_PER_SERVER, USE_LOG_WRITER_THREAD)
 
 # Ver se o ficheiro whitelist.txt existe (se não, cria-o)
 create_whitelist_file_if_not_exists()
@@ -62,11 +63,11 @@ def run_multiserver_functionality(opcao):
         conn = None
         instance = server  # valor padrão caso a query falhe
         try:
-            conn = connect_to_db_server(server, username, password)
+            conn = acquire_connection(server, username, password)
             if conn is None:
                 with PRINT_LOCK:
                     print(f"Falha ao conectar ao servidor {server}. A conexão retornou None.")
-                return
+                return []
             cursor = conn.cursor()
             # Obter o nome da instância via query SQL
             try:
@@ -84,49 +85,100 @@ def run_multiserver_functionality(opcao):
             else:
                 with PRINT_LOCK:
                     print(f"Instância {instance}: {len(databases)} bases de dados encontradas. A executar funcionalidades...")
-                run_functionality(opcao, cursor, databases, instance)
+                # Na opção de todas as verificações, os logs são escritos uma única vez no fim
+                return run_functionality(opcao, cursor, databases, instance, srv,
+                                         write_logs=opcao != OPCAO_TODAS_VERIFICACOES)
         except Exception as e:
             with PRINT_LOCK:
                 print(f"Erro ao ligar ao servidor {server}: {type(e).__name__} - {e}")
         finally:
             if conn:
                 try:
-                    conn.close()
+                    # Devolve a conexão ao pool para ser reutilizada pelas próximas verificações
+                    release_connection(conn)
                 except Exception as e:
                     with PRINT_LOCK:
                         print(f"Erro ao fechar a conexão no servidor {server}: {e}")
+        return []
 
     with ThreadPoolExecutor() as executor:
-        executor.map(process_server, servers)
-
-
-def run_functionality(opcao, cursor, databases, instance):
-    all_anomalias = []
-    for db in databases:
-        backups = get_backups(cursor, db)
-        if not backups:
-            continue
-
-        if opcao == '1':
-            anomalias = check_authorized_users(db, backups)
-        elif opcao == '2':
-            anomalias = check_backup_frequency(db, backups)
-        elif opcao == '3':
-            anomalias = check_tlog_after_full_diff(db, backups, cursor)
-        elif opcao == '4':
-            anomalias = check_file_size(db, backups)
-        elif opcao == '5':
-            anomalias = check_db_status(db, cursor, instance)
-        else:
-            with PRINT_LOCK:
-                print("Opção inválida!")
-            return
+        results = list(executor.map(process_server, servers))
+    # Espera que a thread de escrita grave as anomalias de todos os servidores
+    shutdown_log_writer()
+
+    if opcao == OPCAO_TODAS_VERIFICACOES:
+        all_anomalias = [anomalia for anomalias in results for anomalia in anomalias]
+        print(f"\nTotal geral de anomalias: {len(all_anomalias)}")
+        log_anomalies(all_anomalias)
+        critical_anomalias = [anomalia for anomalia in all_anomalias if int(anomalia.get("level", 1)) == 0]
+        log_critical_anomalies(critical_anomalias)
+
+
+# Opções do menu verificadas base a base (registadas em check_registry)
+OPCOES_POR_BASE = tuple(key for key, spec in CHECK_REGISTRY.items() if spec.scope == SCOPE_DATABASE)
+OPCAO_TODAS_VERIFICACOES = '9'
+
+def collect_anomalies(opcao, cursor, databases, instance, backups_by_db=None, query_databases=None):
+    """
+    Executa a verificação escolhida para as bases indicadas e devolve a lista de anomalias.
+    - 'backups_by_db': histórico já carregado (ex.: sincronizado uma única vez no modo paralelo).
+    - 'query_databases': se indicado, as queries de histórico são restringidas a estas bases.
+    Os dados de que a verificação precisa são lidos pelo planeador de check_registry.
+    """
+    preloaded = {DATASET_BACKUPS: backups_by_db} if backups_by_db is not None else None
+    return run_checks([opcao], cursor, databases, instance, query_databases, preloaded)
+
+def collect_all_anomalies(cursor, databases, instance):
+    """
+    Executa todas as verificações registadas (opções 1-6) numa só passagem pela instância: o histórico
+    de backups, o snapshot de sys.databases e os ficheiros de sys.master_files são lidos uma única vez
+    e partilhados por todas as verificações. Devolve a lista de anomalias da instância.
+    """
+    return run_checks(list(CHECK_REGISTRY), cursor, databases, instance)
+
+def collect_anomalies_parallel(opcao, cursor, srv, databases, instance):
+    """
+    Distribui as bases da instância por K conexões (INSTANCE_PARALLEL_CONNECTIONS, limitado por
+    POOL_MAX_CONNECTIONS_PER_SERVER) e executa a leitura do histórico e a verificação em paralelo.
+    A conexão já aberta processa o primeiro lote; as restantes vêm do pool.
+    """
+    k = min(INSTANCE_PARALLEL_CONNECTIONS, POOL_MAX_CONNECTIONS_PER_SERVER, len(databases))
+    chunks = [databases[i::k] for i in range(k)]
+
+    # Com a cache local, o histórico é sincronizado uma única vez e partilhado pelos lotes
+    backups_by_db = None
+    if USE_BACKUP_HISTORY_CACHE and DATASET_BACKUPS in plan_datasets(resolve_checks([opcao])):
+        backups_by_db = load_backups(cursor, instance, None, None)
 
-        # Atualiza o campo 'instance' para ser o nome da instância obtido via query
-        for anomalia in anomalias:
-            anomalia["instance"] = instance
+    def process_chunk(chunk):
+        with pooled_connection(srv["server"], srv["username"], srv["password"]) as conn:
+            return collect_anomalies(opcao, conn.cursor(), chunk, instance, backups_by_db, chunk)
+
+    with ThreadPoolExecutor(max_workers=k - 1) as executor:
+        futures = [executor.submit(process_chunk, chunk) for chunk in chunks[1:]]
+        all_anomalias = collect_anomalies(opcao, cursor, chunks[0], instance, backups_by_db, chunks[0])
+        for future in futures:
+            all_anomalias.extend(future.result())
+    return all_anomalias
+
+def run_functionality(opcao, cursor, databases, instance, srv=None, write_logs=True):
+    """
+    Executa a opção escolhida numa instância, mostra o relatório e (se 'write_logs') regista as anomalias.
+    Com USE_LOG_WRITER_THREAD, as anomalias só são colocadas na fila da thread de escrita (log_writer).
+    Devolve a lista de anomalias encontradas.
+    """
+    if opcao not in OPCOES_POR_BASE and opcao != OPCAO_TODAS_VERIFICACOES:
+        with PRINT_LOCK:
+            print("Opção inválida!")
+        return []
 
-        all_anomalias.extend(anomalias)
+    if opcao == OPCAO_TODAS_VERIFICACOES:
+        all_anomalias = collect_all_anomalies(cursor, databases, instance)
+    # Com 'srv' e INSTANCE_PARALLEL_CONNECTIONS > 1, as bases são verificadas em várias conexões
+    elif srv is not None and min(INSTANCE_PARALLEL_CONNECTIONS, POOL_MAX_CONNECTIONS_PER_SERVER) > 1 and len(databases) > 1:
+        all_anomalias = collect_anomalies_parallel(opcao, cursor, srv, databases, instance)
+    else:
+        all_anomalias = collect_anomalies(opcao, cursor, databases, instance)
 
     with PRINT_LOCK:
         if all_anomalias:
@@ -145,6 +197,13 @@ def run_functionality(opcao, cursor, databases, instance):
         else:
             print(f"\nNenhuma anomalia encontrada na instância {instance}.")
 
+    if not write_logs:
+        return all_anomalias
+
+    if USE_LOG_WRITER_THREAD:
+        enqueue_anomalies(all_anomalias)
+        return all_anomalias
+
     # Registra os logs
     log_anomalies(all_anomalias)
 
@@ -155,6 +214,7 @@ def run_functionality(opcao, cursor, databases, instance):
 
     critical_anomalias = [anomalia for anomalia in all_anomalias if int(anomalia.get("level", 1)) == 0]
     log_critical_anomalies(critical_anomalias)
+    return all_anomalias
 
 
 def main():
@@ -169,8 +229,9 @@ def main():
     print("6 - Verificar integridade dos volumes (Ficheiros de Dados vs TLOGs)")
     print("7 - Enviar por email as anomalias críticas")
     print("8 - Revogar permissões de backup para utilizadores não autorizados")
+    print("9 - Executar todas as verificações (1-6) numa só passagem")
     print("0 - Sair do programa")
-    opcao = input("Escolhe (0-8): ").strip()
+    opcao = input("Escolhe (0-9): ").strip()
 
     if opcao == "0":
         print("Terminado...")
@@ -188,6 +249,11 @@ def main():
         for action in actions:
             print(f"  • {action}\n")
         print("======================================")
+    elif opcao == OPCAO_TODAS_VERIFICACOES:
+        run_multiserver_functionality(opcao)
+    elif USE_ASYNC_RUNNER:
+        from async_runner import run_multiserver_functionality_async
+        run_multiserver_functionality_async(opcao)
     else:
         run_multiserver_functionality(opcao)
 
@@ -3,7 +3,7 @@ import smtplib
 from email.message import EmailMessage
 from config import SMTP_SERVER, SMTP_PORT, SMTP_USER, SMTP_PASSWORD, ALERT_RECIPIENT
 import json
-from anomaly_log import CRITICAL_LOG_FILE
+from anomaly_log import CRITICAL_LOG_FILE, read_log
 
 def send_alert_email(anomaly):
     """
@@ -28,18 +28,15 @@ def send_alert_email(anomaly):
 
 def send_critical_anomalies_email():
     """
-    Lê o ficheiro JSON atual das anomalias críticas e envia-o por e-mail em anexo.
-    Se o ficheiro não contiver anomalias, imprime "Nenhuma anomalia crítica encontrada!" e não envia o e-mail.
+    Lê as anomalias críticas do log atual (JSON Lines) e envia-as por e-mail num anexo JSON.
+    Se o log não contiver anomalias, imprime "Nenhuma anomalia crítica encontrada!" e não envia o e-mail.
     """
     if not os.path.exists(CRITICAL_LOG_FILE):
         print("Nenhum ficheiro de anomalias críticas encontrado.")
         return
 
     try:
-        with open(CRITICAL_LOG_FILE, "r", encoding="utf-8") as f:
-            data = json.load(f)
-        # Verifica se o objeto contém a chave "critical_anomalies" e se ela possui elementos
-        critical_anomalies = data.get("critical_anomalies", [])
+        critical_anomalies = read_log(CRITICAL_LOG_FILE)
     except Exception as e:
         print("Erro ao ler o ficheiro de anomalias críticas:", e)
         return
@@ -48,8 +45,8 @@ def send_critical_anomalies_email():
         print("Nenhuma anomalia crítica encontrada!")
         return
 
-    with open(CRITICAL_LOG_FILE, "r", encoding="utf-8") as f:
-        critical_data = f.read()
+    # O anexo mantém o formato anterior (um objeto JSON com a lista "critical_anomalies")
+    critical_data = json.dumps({"critical_anomalies": critical_anomalies}, indent=4, ensure_ascii=False)
 
     msg = EmailMessage()
     msg['Subject'] = "Histórico de Anomalias Críticas"
@@ -1,31 +1,26 @@
+import os
+import json
 import pyodbc
-from user_whitelist import load_whitelist
-from db_utils import connect_to_db_server
-
-SYSADMIN_WHITELIST_FILE = "sysadminwhitelist.txt"
-SYSADMIN_GROUP_WHITELIST_FILE = "sysadmingroupwhitelist.txt"
+import argparse
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from user_whitelist import (SYSADMIN_WHITELIST_FILE, SYSADMIN_WHITELIST, SYSADMIN_GROUP_WHITELIST,
+                            get_whitelist_matcher, get_sysadmin_whitelist_matcher,
+                            get_sysadmin_group_whitelist_matcher)
+from db_utils import acquire_connection, release_connection
+from config import REVOKE_PLAN_FILE, REVOKE_PLAN_MAX_AGE_HOURS, REVOKE_MAX_WORKERS
 
 def load_sysadmin_whitelist():
     """
-    Carrega a lista de logins da sysadminwhitelist.
+    Carrega a lista de logins da sysadminwhitelist (em cache até o ficheiro ser alterado).
     """
-    try:
-        with open(SYSADMIN_WHITELIST_FILE, "r") as f:
-            lines = f.read().splitlines()
-            return [line.strip() for line in lines if line.strip()]
-    except FileNotFoundError:
-        return []
+    return SYSADMIN_WHITELIST.entries()
 
 def load_sysadmin_group_whitelist():
     """
-    Carrega a lista de grupos da sysadmingroupwhitelist.
+    Carrega a lista de grupos da sysadmingroupwhitelist (em cache até o ficheiro ser alterado).
     """
-    try:
-        with open(SYSADMIN_GROUP_WHITELIST_FILE, "r") as f:
-            lines = f.read().splitlines()
-            return [line.strip() for line in lines if line.strip()]
-    except FileNotFoundError:
-        return []
+    return SYSADMIN_GROUP_WHITELIST.entries()
 
 def remove_from_sysadmin_whitelist(login):
     """
@@ -37,145 +32,301 @@ def remove_from_sysadmin_whitelist(login):
         with open(SYSADMIN_WHITELIST_FILE, "w") as f:
             for item in whitelist:
                 f.write(item + "\n")
+        SYSADMIN_WHITELIST.invalidate()
         print(f"Login '{login}' removido da sysadminwhitelist.")
 
-def is_login_in_authorized_group(cursor, login, group_whitelist):
+def get_server_role_memberships(cursor):
     """
-    Verifica se o login pertence a algum grupo da group whitelist.
+    Lê numa única query todas as pertenças a server roles da instância.
+    Devolve {login: {nomes dos roles}}.
     """
     query = """
-        SELECT rp.name
+        SELECT sp.name, rp.name
         FROM sys.server_role_members srm
         INNER JOIN sys.server_principals sp ON srm.member_principal_id = sp.principal_id
         INNER JOIN sys.server_principals rp ON srm.role_principal_id = rp.principal_id
-        WHERE sp.name = ?
     """
-    cursor.execute(query, login)
-    groups = [row[0] for row in cursor.fetchall()]
-    return any(g.lower() in (gw.lower() for gw in group_whitelist) for g in groups)
+    cursor.execute(query)
+    memberships = {}
+    for login, role in cursor.fetchall():
+        memberships.setdefault(login, set()).add(role)
+    return memberships
 
-def get_nonwhitelisted_sysadmin_logins(cursor, whitelist, sysadmin_whitelist, sysadmin_group_whitelist):
+def is_login_in_authorized_group(memberships, login, is_group_whitelisted):
+    """
+    Verifica se o login pertence a algum grupo da group whitelist.
+    'memberships' é o mapa de get_server_role_memberships e 'is_group_whitelisted'
+    a função de get_sysadmin_group_whitelist_matcher().
+    """
+    return any(is_group_whitelisted(g) for g in memberships.get(login, ()))
+
+def get_nonwhitelisted_sysadmin_logins(cursor, is_whitelisted, is_sysadmin_whitelisted, is_group_whitelisted):
     """
     Retorna uma lista de logins que possuem o role "sysadmin" e que NÃO estão na whitelist,
     nem na sysadminwhitelist, nem pertencem a um grupo da sysadmingroupwhitelist.
+    As whitelists são passadas como funções de comparação (ver user_whitelist.CachedWhitelist)
+    e as pertenças a roles são lidas numa única query (get_server_role_memberships).
     """
-    sysadmin_query = """
-        SELECT sp.name
-        FROM sys.server_principals sp
-        INNER JOIN sys.server_role_members srm ON sp.principal_id = srm.member_principal_id
-        INNER JOIN sys.server_principals rp ON rp.principal_id = srm.role_principal_id
-        WHERE rp.name = 'sysadmin'
-    """
-    cursor.execute(sysadmin_query)
-    rows = cursor.fetchall()
+    memberships = get_server_role_memberships(cursor)
     logins = []
-    for row in rows:
-        user_name = row[0]
+    for user_name, roles in memberships.items():
+        if "sysadmin" not in roles:
+            continue
         # Se o login estiver na sysadmin_whitelist, ele deve ser mantido:
-        if user_name.lower() in (user.lower() for user in sysadmin_whitelist):
+        if is_sysadmin_whitelisted(user_name):
             continue
         # Se o login pertence a um grupo autorizado, também deve ser mantido:
-        elif is_login_in_authorized_group(cursor, user_name, sysadmin_group_whitelist):
+        elif is_login_in_authorized_group(memberships, user_name, is_group_whitelisted):
             continue
         # Se o login não atender à condição da whitelist principal, ele será considerado para remoção.
-        elif not any(user_name.lower().startswith(prefix.lower()) for prefix in whitelist):
+        elif not is_whitelisted(user_name):
             logins.append(user_name)
     return logins
 
-def revoke_sysadmin_permissions(cursor, instance, whitelist, actions):
-    """
-    Remove o role 'sysadmin' dos logins (não autorizados) que foram confirmados pelo usuário.
-    A mensagem utiliza o nome da instância obtido (em vez do IP) quando disponível.
-    """
-    sysadmin_whitelist = load_sysadmin_whitelist()
-    sysadmin_group_whitelist = load_sysadmin_group_whitelist()
-    logins_to_remove = get_nonwhitelisted_sysadmin_logins(cursor, whitelist, sysadmin_whitelist, sysadmin_group_whitelist)
-    
-    if not logins_to_remove:
-        actions.append(f"[{instance}][master] Nenhum login para remover de 'sysadmin'.")
-        return
-    
-    print(f"\nNo servidor {instance} os seguintes logins possuem o role 'sysadmin' e não estão na whitelist:")
-    for login in logins_to_remove:
-        print(f" - {login}")
-    
-    confirm = input("Tem certeza que deseja remover o role 'sysadmin' destes logins? (s/n): ").strip().lower()
-    if confirm != 's':
-        actions.append(f"[{instance}][master] Remoção cancelada pelo usuário.")
-        return
-    
-    drop_srv_query = """
-        IF EXISTS(
-            SELECT 1 FROM sys.server_role_members srm 
-            INNER JOIN sys.server_principals sp ON srm.member_principal_id = sp.principal_id
-            WHERE sp.name = ?
-        )
-        BEGIN
-            EXEC sp_dropsrvrolemember ?, 'sysadmin'
-        END
-    """
-    for login in logins_to_remove:
+def get_instance_name(cursor, server):
+    """Tenta obter o nome da instância via query; se não for possível, mantém o nome/IP do servidor."""
+    try:
+        cursor.execute("SELECT @@SERVERNAME")
+        result = cursor.fetchone()
+        if result and result[0]:
+            return result[0]
+    except Exception as e:
+        print(f"Não foi possível obter o nome da instância no servidor {server}: {e}")
+    return server
+
+def plan_revoke_server(srv):
+    """
+    Fase 1 (sem alterações no servidor): calcula os logins com o role 'sysadmin' que não estão
+    em nenhuma whitelist. Devolve {"server", "instance", "logins", "error"}.
+    """
+    server = srv["server"]
+    entry = {"server": server, "instance": server.upper(), "logins": [], "error": None}
+    conn = None
+    try:
+        conn = acquire_connection(server, srv["username"], srv["password"])
+        cursor = conn.cursor()
+        cursor.execute("USE [master]")
+        entry["instance"] = get_instance_name(cursor, server).upper()
+        entry["logins"] = get_nonwhitelisted_sysadmin_logins(cursor, get_whitelist_matcher(),
+                                                             get_sysadmin_whitelist_matcher(),
+                                                             get_sysadmin_group_whitelist_matcher())
+    except Exception as e:
+        entry["error"] = f"Erro ao conectar: {e}"
+    finally:
         try:
-            cursor.execute(drop_srv_query, login, login)
-            actions.append(f"[{instance}][master] Utilizador '{login}': Removido do role 'sysadmin'.")
-        except Exception as e_sysadmin:
-            actions.append(f"[{instance}][master] Utilizador '{login}': Erro ao remover de 'sysadmin' (erro ignorado): {e_sysadmin}")
+            release_connection(conn)
+        except Exception:
+            pass
+    return entry
 
-def revoke_backup_permissions_server(server, username, password):
+def plan_revocations(servers):
+    """Calcula em paralelo o plano de revogação de todos os servidores (pela ordem de 'servers')."""
+    with ThreadPoolExecutor(max_workers=min(len(servers), REVOKE_MAX_WORKERS) or 1) as executor:
+        return list(executor.map(plan_revoke_server, servers))
+
+def save_revoke_plan(plan, path=REVOKE_PLAN_FILE):
+    """Grava o plano (sem credenciais) num ficheiro JSON, para revisão ou aprovação posterior."""
+    data = {"created_at": datetime.now().isoformat(timespec="seconds"), "servers": plan}
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+
+def load_revoke_plan(path=REVOKE_PLAN_FILE, max_age_hours=REVOKE_PLAN_MAX_AGE_HOURS):
     """
-    Para o servidor especificado, remove o role 'sysadmin' dos logins que não estão na whitelist
-    (após confirmação do usuário). Opera na base master e devolve uma lista com as ações efetuadas.
-    Tenta obter o nome da instância via query; se obtido, utiliza-o nas mensagens.
+    Lê um plano gravado com save_revoke_plan. Devolve a lista de entradas por servidor.
+    Lança ValueError se o plano não tiver data de criação válida ou tiver mais de 'max_age_hours' horas.
     """
-    whitelist = load_whitelist()
+    with open(path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    try:
+        created_at = datetime.fromisoformat(data["created_at"])
+    except (KeyError, TypeError, ValueError):
+        raise ValueError(f"O plano '{path}' não tem uma data de criação válida.")
+    if datetime.now() - created_at > timedelta(hours=max_age_hours):
+        raise ValueError(f"O plano '{path}' foi criado em {created_at:%Y-%m-%d %H:%M:%S}, há mais de "
+                         f"{max_age_hours} horas: calcule um plano novo com --plan.")
+    return data.get("servers", [])
+
+def print_revoke_plan(plan):
+    """Mostra o plano consolidado de todos os servidores."""
+    print("\nPlano de revogação do role 'sysadmin' (logins que não estão na whitelist):")
+    for entry in plan:
+        if entry.get("error"):
+            print(f"\n[{entry['instance']}] {entry['error']}")
+        elif entry["logins"]:
+            print(f"\n[{entry['instance']}]")
+            for login in entry["logins"]:
+                print(f" - {login}")
+    total = sum(len(entry["logins"]) for entry in plan)
+    servers_count = sum(1 for entry in plan if entry["logins"])
+    print(f"\nTotal: {total} login(s) em {servers_count} servidor(es).")
+    return total
+
+# Um batch por cada REVOKE_BATCH_SIZE logins (o SQL Server aceita no máximo 1000 linhas num INSERT ... VALUES):
+# cada login é revalidado (continua no role) e o resultado de cada um é devolvido
+REVOKE_BATCH_SIZE = 1000
+REVOKE_BATCH_QUERY = """
+    SET NOCOUNT ON;
+    DECLARE @logins TABLE (id int IDENTITY(1, 1), login sysname);
+    DECLARE @results TABLE (login sysname, status varchar(20), error nvarchar(4000));
+    INSERT INTO @logins (login) VALUES {values};
+    DECLARE @id int = 1, @max int = (SELECT MAX(id) FROM @logins), @login sysname;
+    WHILE @id <= @max
+    BEGIN
+        SELECT @login = login FROM @logins WHERE id = @id;
+        BEGIN TRY
+            IF EXISTS(
+                SELECT 1 FROM sys.server_role_members srm
+                INNER JOIN sys.server_principals sp ON srm.member_principal_id = sp.principal_id
+                INNER JOIN sys.server_principals rp ON srm.role_principal_id = rp.principal_id
+                WHERE sp.name = @login AND rp.name = 'sysadmin'
+            )
+            BEGIN
+                EXEC sp_dropsrvrolemember @login, 'sysadmin';
+                INSERT INTO @results VALUES (@login, 'removed', NULL);
+            END
+            ELSE
+                INSERT INTO @results VALUES (@login, 'not_member', NULL);
+        END TRY
+        BEGIN CATCH
+            INSERT INTO @results VALUES (@login, 'error', ERROR_MESSAGE());
+        END CATCH
+        SET @id += 1;
+    END
+    SELECT login, status, error FROM @results;
+"""
+
+def execute_revoke_server(srv, entry):
+    """
+    Fase 2: remove o role 'sysadmin' dos logins do plano do servidor, com um batch T-SQL por cada
+    REVOKE_BATCH_SIZE logins (um batch que falhe não impede os seguintes).
+    Só são revogados os logins do plano que continuam a ser devolvidos por get_nonwhitelisted_sysadmin_logins
+    (as whitelists e os roles são relidos): um login entretanto colocado numa whitelist é mantido.
+    """
+    instance = entry["instance"]
     actions = []
+    conn = None
     try:
-        conn = connect_to_db_server(server, username, password)
+        conn = acquire_connection(srv["server"], srv["username"], srv["password"])
         cursor = conn.cursor()
         cursor.execute("USE [master]")
-        # Tenta obter o nome da instância – se disponível, utiliza-o; caso contrário, mantém o IP
-        instance = server
-        try:
-            cursor.execute("SELECT @@SERVERNAME")
-            result = cursor.fetchone()
-            if result and result[0]:
-                instance = result[0]
-        except Exception as e:
-            print(f"Não foi possível obter o nome da instância no servidor {server}: {e}")
-        revoke_sysadmin_permissions(cursor, instance.upper(), whitelist, actions)
-        conn.commit()
+        current = {login.lower() for login in get_nonwhitelisted_sysadmin_logins(
+            cursor, get_whitelist_matcher(), get_sysadmin_whitelist_matcher(), get_sysadmin_group_whitelist_matcher())}
+        logins = [login for login in entry["logins"] if login.lower() in current]
+        for login in entry["logins"]:
+            if login.lower() not in current:
+                actions.append(f"[{instance}][master] Utilizador '{login}': Mantido (está numa whitelist "
+                               f"ou já não pertence ao role 'sysadmin').")
+        if not logins:
+            return actions
+        for i in range(0, len(logins), REVOKE_BATCH_SIZE):
+            batch = logins[i:i + REVOKE_BATCH_SIZE]
+            try:
+                cursor.execute(REVOKE_BATCH_QUERY.format(values=", ".join("(?)" for _ in batch)), batch)
+                results = cursor.fetchall()
+                conn.commit()
+            except Exception as e:
+                actions.append(f"[{instance}] Erro ao remover {len(batch)} login(s) de 'sysadmin' "
+                               f"({batch[0]} ... {batch[-1]}): {e}")
+                continue
+            for login, status, error in results:
+                if status == "removed":
+                    actions.append(f"[{instance}][master] Utilizador '{login}': Removido do role 'sysadmin'.")
+                elif status == "not_member":
+                    actions.append(f"[{instance}][master] Utilizador '{login}': Já não pertence ao role 'sysadmin'.")
+                else:
+                    actions.append(f"[{instance}][master] Utilizador '{login}': Erro ao remover de 'sysadmin' (erro ignorado): {error}")
     except Exception as e:
-        actions.append(f"[{server}] Erro ao conectar: {e}")
+        actions.append(f"[{instance}] Erro ao remover os logins de 'sysadmin': {e}")
     finally:
         try:
-            conn.close()
+            release_connection(conn)
         except Exception:
             pass
     return actions
 
-def revoke_backup_permissions_all_servers():
+def execute_revoke_plan(servers, plan):
     """
-    Aplica a funcionalidade a todos os servidores listados no ficheiro servers.txt.
-    Remove o role "sysadmin" dos logins que não estão na whitelist (ou foram removidos da sysadminwhitelist),
-    após confirmação do usuário.
-    Devolve uma lista com todas as ações efetuadas.
+    Executa o plano aprovado em paralelo (ver execute_revoke_server). Os servidores do plano são
+    associados às credenciais de 'servers' pelo nome. Devolve a lista de ações por servidor.
     """
-    from server_manager import read_server_list
-    servers = read_server_list()
+    credentials = {srv["server"]: srv for srv in servers}
     all_actions = []
-    if not servers:
-        all_actions.append("Nenhum servidor definido no ficheiro 'servers.txt'.")
-        return all_actions
-    for srv in servers:
-        server = srv["server"]
-        username = srv["username"]
-        password = srv["password"]
-        actions = revoke_backup_permissions_server(server, username, password)
-        all_actions.append(f"Servidor: {server}")
-        all_actions.extend(actions)
+    jobs = []
+    for entry in plan:
+        srv = credentials.get(entry["server"])
+        if entry.get("error"):
+            jobs.append((entry, [f"[{entry['server']}] {entry['error']}"]))
+        elif not entry["logins"]:
+            jobs.append((entry, [f"[{entry['instance']}][master] Nenhum login para remover de 'sysadmin'."]))
+        elif srv is None:
+            jobs.append((entry, [f"[{entry['server']}] Servidor não definido no ficheiro 'servers.txt'."]))
+        else:
+            jobs.append((entry, None))
+    with ThreadPoolExecutor(max_workers=REVOKE_MAX_WORKERS) as executor:
+        futures = {id(entry): executor.submit(execute_revoke_server, credentials[entry["server"]], entry)
+                   for entry, actions in jobs if actions is None}
+        for entry, actions in jobs:
+            all_actions.append(f"Servidor: {entry['server']}")
+            all_actions.extend(actions if actions is not None else futures[id(entry)].result())
     return all_actions
 
+def revoke_backup_permissions_all_servers(servers=None, plan_file=None, save_plan_to=None):
+    """
+    Remove o role "sysadmin" dos logins que não estão na whitelist (ou foram removidos da sysadminwhitelist)
+    em todos os servidores do ficheiro servers.txt, em duas fases:
+    1. o plano é calculado em paralelo para todos os servidores e mostrado de uma só vez,
+       com uma única confirmação;
+    2. a revogação é executada em paralelo, com batches T-SQL de até REVOKE_BATCH_SIZE logins.
+    Se 'plan_file' for indicado, o plano aprovado é lido desse ficheiro (e recusado se tiver mais de
+    REVOKE_PLAN_MAX_AGE_HOURS horas) e executado sem confirmação.
+    Se 'save_plan_to' for indicado, o plano é só calculado e gravado nesse ficheiro, para aprovação.
+    Devolve uma lista com todas as ações efetuadas.
+    """
+    if servers is None:
+        from server_manager import read_server_list
+        servers = read_server_list()
+    if not servers:
+        return ["Nenhum servidor definido no ficheiro 'servers.txt'."]
+
+    if plan_file:
+        try:
+            plan = load_revoke_plan(plan_file)
+        except (OSError, ValueError) as e:
+            return [f"Plano não executado: {e}"]
+        print(f"Plano aprovado lido de '{plan_file}'.")
+        print_revoke_plan(plan)
+    else:
+        print(f"A calcular o plano de revogação em {len(servers)} servidor(es)...")
+        plan = plan_revocations(servers)
+        if save_plan_to:
+            save_revoke_plan(plan, save_plan_to)
+            print_revoke_plan(plan)
+            return [f"Plano gravado em '{save_plan_to}'. Para o executar: "
+                    f"python revoke_backup_permissions.py --apply {save_plan_to}"]
+        if print_revoke_plan(plan):
+            confirm = input("Tem certeza que deseja remover o role 'sysadmin' destes logins? (s/n): ").strip().lower()
+            if confirm != 's':
+                return ["Remoção cancelada pelo usuário."]
+    return execute_revoke_plan(servers, plan)
+
+def revoke_backup_permissions_server(server, username, password):
+    """Aplica a revogação (plano, confirmação e execução) a um único servidor."""
+    return revoke_backup_permissions_all_servers([{"server": server, "username": username, "password": password}])
+
+def parse_args(argv=None):
+    """Opções da linha de comandos (partilhadas com revoke_backup_permissions_app.py)."""
+    parser = argparse.ArgumentParser(description="Revogação do role 'sysadmin' dos logins fora das whitelists")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument("--plan", nargs="?", const=REVOKE_PLAN_FILE, metavar="FICHEIRO",
+                      help=f"calcula o plano e grava-o para aprovação, sem executar (por omissão, {REVOKE_PLAN_FILE})")
+    mode.add_argument("--apply", metavar="FICHEIRO",
+                      help="executa um plano aprovado sem pedir confirmação")
+    return parser.parse_args(argv)
+
 if __name__ == "__main__":
-    actions = revoke_backup_permissions_all_servers()
+    args = parse_args()
+    actions = revoke_backup_permissions_all_servers(plan_file=args.apply, save_plan_to=args.plan)
     for action in actions:
         print(action)
@@ -1,15 +1,19 @@
-from revoke_backup_permissions import revoke_backup_permissions_all_servers
+from revoke_backup_permissions import revoke_backup_permissions_all_servers, parse_args
 
 def main():
+    # "--plan [ficheiro]" grava o plano para aprovação; "--apply <ficheiro>" executa um plano aprovado
+    args = parse_args()
     print("\n=== Revogação de Permissões de Backup ===")
-    actions = revoke_backup_permissions_all_servers()
+    actions = revoke_backup_permissions_all_servers(plan_file=args.apply, save_plan_to=args.plan)
     print("\n======================================")
     print("       Revogação de Permissões        ")
     print("======================================")
     for action in actions:
         print(f"  • {action}\n")
     print("======================================")
-    input("Carregue Enter para fechar o terminal...")
+    # Execução não interativa (plano aprovado): não espera pelo Enter
+    if not args.apply:
+        input("Carregue Enter para fechar o terminal...")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
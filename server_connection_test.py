@@ -1,37 +1,141 @@
 import csv
+import time
+import socket
+from concurrent.futures import ThreadPoolExecutor
 from db_utils import connect_to_db_server
+from server_health import get_server_state
 from server_manager import read_server_list
+from config import PREFLIGHT_TIMEOUT_SECONDS, PREFLIGHT_MAX_WORKERS
+
+DEFAULT_SQL_PORT = 1433
+SQL_BROWSER_PORT = 1434
+
+def get_named_instance_port(host, instance, timeout=PREFLIGHT_TIMEOUT_SECONDS):
+    """
+    Pergunta ao SQL Server Browser (UDP 1434) qual a porta TCP de uma instância nomeada.
+    Devolve a porta (int) ou lança uma exceção se não houver resposta/porta TCP.
+    """
+    request = b"\x04" + instance.encode("ascii", errors="ignore") + b"\x00"
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.settimeout(timeout)
+        sock.sendto(request, (host, SQL_BROWSER_PORT))
+        data, _ = sock.recvfrom(4096)
+    # Resposta: 0x05, tamanho (2 bytes) e "ServerName;X;InstanceName;Y;...;tcp;PORTA;..."
+    parts = data[3:].decode("ascii", errors="ignore").split(";")
+    for i, part in enumerate(parts[:-1]):
+        if part.lower() == "tcp" and parts[i + 1].isdigit():
+            return int(parts[i + 1])
+    raise ConnectionError(f"O SQL Browser não indicou uma porta TCP para a instância {instance}")
+
+def resolve_server_address(server, timeout=PREFLIGHT_TIMEOUT_SECONDS):
+    """
+    Converte o nome do servidor de servers.txt em (host, porta):
+    "host", "host,porta", "tcp:host,porta" ou "host\\instância" (porta obtida via SQL Browser).
+    """
+    address = server.strip()
+    if address.lower().startswith("tcp:"):
+        address = address[4:]
+    port = None
+    if "," in address:
+        address, port_str = address.split(",", 1)
+        port = int(port_str.strip())
+    host, _, instance = address.partition("\\")
+    if host in (".", "(local)", "localhost"):
+        host = "127.0.0.1"
+    if port is None:
+        port = get_named_instance_port(host, instance, timeout) if instance else DEFAULT_SQL_PORT
+    return host, port
+
+def timed_tcp_connect(host, port, timeout=PREFLIGHT_TIMEOUT_SECONDS):
+    """
+    Resolve o host (getaddrinfo) e liga-se ao primeiro endereço que aceitar a ligação.
+    Devolve a latência (ms) só da ligação TCP, sem o tempo da resolução de nomes.
+    """
+    last_error = None
+    for family, socktype, proto, _, address in socket.getaddrinfo(host, port, type=socket.SOCK_STREAM):
+        with socket.socket(family, socktype, proto) as sock:
+            sock.settimeout(timeout)
+            start = time.perf_counter()
+            try:
+                sock.connect(address)
+            except OSError as e:
+                last_error = e
+                continue
+            return round((time.perf_counter() - start) * 1000, 1)
+    raise last_error or OSError(f"Nenhum endereço encontrado para {host}")
+
+def tcp_preflight(server, timeout=PREFLIGHT_TIMEOUT_SECONDS):
+    """
+    Resolve o endereço do servidor e faz uma ligação TCP simples (sem login) com um timeout curto.
+    Devolve um dicionário com host, porta, latência da ligação (ms), o estado do circuit breaker
+    e o erro, se houver.
+    """
+    record = {"server": server, "host": "", "port": "", "tcp_latency_ms": "", "status": "", "error": "",
+              "circuit": get_server_state(server).get("state", "closed")}
+    try:
+        host, port = resolve_server_address(server, timeout)
+        record["host"], record["port"] = host, port
+        record["tcp_latency_ms"] = timed_tcp_connect(host, port, timeout)
+    except Exception as e:
+        record["status"] = "Sem resposta TCP"
+        record["error"] = f"{type(e).__name__}: {e}"
+    return record
+
+def test_odbc_login(srv, record):
+    """
+    Faz o login ODBC completo num servidor que respondeu ao pre-flight TCP.
+    O circuit breaker não é consultado (o teste tenta sempre a ligação), mas o resultado é registado:
+    um login bem sucedido fecha o circuito de um servidor marcado como indisponível.
+    """
+    try:
+        conn = connect_to_db_server(srv.get("server"), srv.get("username"), srv.get("password"),
+                                    check_circuit=False)
+        conn.close()
+        record["status"] = "OK"
+    except Exception as e:
+        record["status"] = "Falha no login"
+        record["error"] = str(e)
+    return record
 
 def test_server_connections():
     servers = read_server_list()
-    error_records = []
-    
+
     if not servers:
         print("Nenhum servidor definido no ficheiro 'servers.txt'.")
         return
-    
-    for srv in servers:
-        server = srv.get("server")
-        username = srv.get("username")
-        password = srv.get("password")
-        print(f"Testando conexão com o servidor: {server} ...")
-        try:
-            conn = connect_to_db_server(server, username, password)
-            conn.close()
-        except Exception as e:
-            print(f"Falha na conexão com o servidor {server}: {e}")
-            error_records.append({"server": server, "error": str(e)})
-    
-    if error_records:
-        with open("server_connection_report.csv", "w", newline="", encoding="utf-8") as csvfile:
-            fieldnames = ["server", "error"]
-            writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-            writer.writeheader()
-            for record in error_records:
-                writer.writerow(record)
-        print("Relatório de erros gravado em 'server_connection_report.csv'")
+
+    # 1) Pre-flight TCP em paralelo para todos os servidores (timeout curto)
+    print(f"A testar a ligação TCP a {len(servers)} servidores (timeout {PREFLIGHT_TIMEOUT_SECONDS}s)...")
+    with ThreadPoolExecutor(max_workers=PREFLIGHT_MAX_WORKERS) as executor:
+        records = list(executor.map(lambda srv: tcp_preflight(srv.get("server")), servers))
+
+    # 2) Login ODBC completo apenas nos servidores que responderam
+    reachable = [(srv, record) for srv, record in zip(servers, records) if not record["status"]]
+    for srv, record in zip(servers, records):
+        if record["status"]:
+            print(f"Falha na conexão com o servidor {record['server']}: {record['error']}")
+    print(f"{len(reachable)} servidores responderam. A testar o login ODBC...")
+    with ThreadPoolExecutor(max_workers=PREFLIGHT_MAX_WORKERS) as executor:
+        for record in executor.map(lambda item: test_odbc_login(*item), reachable):
+            if record["status"] != "OK":
+                print(f"Falha na conexão com o servidor {record['server']}: {record['error']}")
+            if record["circuit"] != "closed":
+                # O servidor estava a ser ignorado pelas verificações (circuit breaker)
+                print(f"Servidor {record['server']}: circuito '{record['circuit']}' antes do teste "
+                      f"(login {'OK' if record['status'] == 'OK' else 'falhou'}).")
+
+    with open("server_connection_report.csv", "w", newline="", encoding="utf-8") as csvfile:
+        fieldnames = ["server", "host", "port", "tcp_latency_ms", "circuit", "status", "error"]
+        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
+        writer.writeheader()
+        for record in records:
+            writer.writerow(record)
+
+    error_count = sum(1 for record in records if record["status"] != "OK")
+    if error_count:
+        print(f"{error_count} servidor(es) com erros. Relatório gravado em 'server_connection_report.csv'")
     else:
-        print("Todas as conexões foram bem sucedidas.")
+        print("Todas as conexões foram bem sucedidas. Relatório gravado em 'server_connection_report.csv'")
 
 if __name__ == "__main__":
     test_server_connections()
\ No newline at end of file
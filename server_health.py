@@ -0,0 +1,182 @@
+import os
+import json
+import socket
+from datetime import datetime, timedelta
+from file_lock import file_lock
+from config import (SERVER_HEALTH_FILE, CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_BASE_BACKOFF_SECONDS,
+                    CIRCUIT_MAX_BACKOFF_SECONDS, CIRCUIT_PROBE_TIMEOUT_SECONDS)
+
+# Estado persistente (por servidor) do "circuit breaker" das ligações:
+# - closed: o servidor responde; as ligações usam o timeout normal.
+# - open: falhou CIRCUIT_FAILURE_THRESHOLD vezes seguidas; é ignorado até 'next_retry'
+#   (backoff exponencial a partir de CIRCUIT_BASE_BACKOFF_SECONDS, até CIRCUIT_MAX_BACKOFF_SECONDS).
+# - half-open: passou o 'next_retry'; uma única ligação de teste (com CIRCUIT_PROBE_TIMEOUT_SECONDS)
+#   é feita, e as outras continuam a ignorar o servidor até ao seu resultado.
+# Só contam como falhas os erros de rede/timeout: um login recusado ou um erro do driver num servidor
+# que respondeu não abrem o circuito.
+# O ficheiro é partilhado pelo main.py e pelos *_app.py: cada alteração é feita com o file_lock obtido,
+# relendo o ficheiro e alterando só a entrada do servidor em causa.
+
+# SQLSTATE (pyodbc.Error.args[0]) dos erros de rede e de timeout
+NETWORK_SQLSTATES = {"08001", "08S01", "HYT00", "HYT01"}
+
+# Tempo após o qual uma ligação de teste sem resultado (ex.: processo terminado) deixa de bloquear outra
+PROBE_CLAIM_SECONDS = 60
+
+_cache = (None, {})   # (mtime do ficheiro, estado lido), para as leituras sem alterações
+
+class ServerUnavailableError(Exception):
+    """O servidor está marcado como indisponível e foi ignorado sem tentar a ligação."""
+
+def _key(server):
+    return server.strip().lower()
+
+def is_network_error(error):
+    """Indica se o erro de ligação é de rede/timeout (servidor inacessível) e não de login ou do driver."""
+    if isinstance(error, (socket.timeout, TimeoutError, ConnectionError)):
+        return True
+    sqlstate = error.args[0] if getattr(error, "args", None) else None
+    return isinstance(sqlstate, str) and sqlstate.upper() in NETWORK_SQLSTATES
+
+def _read():
+    try:
+        with open(SERVER_HEALTH_FILE, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except Exception:
+        return {}
+
+def _load_cached():
+    # Leitura sem lock (o ficheiro é sempre substituído de forma atómica), reaproveitada enquanto não mudar
+    global _cache
+    try:
+        mtime = os.stat(SERVER_HEALTH_FILE).st_mtime_ns
+    except OSError:
+        return {}
+    if _cache[0] != mtime:
+        _cache = (mtime, _read())
+    return _cache[1]
+
+def _update(server, change):
+    """
+    Relê o ficheiro com o lock obtido, aplica change(estado do servidor) e grava-o (ficheiro temporário
+    do processo + substituição). 'change' devolve o novo estado, ou None para remover a entrada.
+    Devolve (estado anterior, estado novo).
+    """
+    with file_lock(SERVER_HEALTH_FILE):
+        health = _read()
+        previous = health.get(_key(server))
+        state = change(dict(previous or {}))
+        if state == previous:
+            return previous, state
+        if state is None:
+            health.pop(_key(server), None)
+        else:
+            health[_key(server)] = state
+        tmp_file = f"{SERVER_HEALTH_FILE}.{os.getpid()}.tmp"
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            json.dump(health, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_file, SERVER_HEALTH_FILE)
+        return previous, state
+
+def get_server_state(server):
+    """Devolve uma cópia do estado guardado para o servidor (dicionário vazio se não houver falhas)."""
+    return dict(_load_cached().get(_key(server), {}))
+
+def _unavailable(server, state):
+    if state.get("state") == "half-open":
+        return ServerUnavailableError(
+            f"Servidor {server} marcado como indisponível: ligação de teste em curso desde "
+            f"{datetime.fromisoformat(state['probe_started']):%Y-%m-%d %H:%M:%S}."
+        )
+    return ServerUnavailableError(
+        f"Servidor {server} marcado como indisponível após {state.get('failures', 0)} falhas seguidas "
+        f"(última: {state.get('last_error', 'N/A')}); nova tentativa a partir de "
+        f"{datetime.fromisoformat(state['next_retry']):%Y-%m-%d %H:%M:%S}."
+    )
+
+def check_server_available(server):
+    """
+    Decide como ligar ao servidor antes de abrir a conexão:
+    - devolve None se o circuito estiver fechado (usa o timeout normal);
+    - devolve CIRCUIT_PROBE_TIMEOUT_SECONDS a quem fica com a ligação de teste (half-open);
+    - lança ServerUnavailableError se o circuito estiver aberto e ainda não for altura de voltar a tentar,
+      ou se outra ligação de teste estiver em curso.
+    """
+    state = get_server_state(server)
+    if state.get("state") not in ("open", "half-open"):
+        return None
+    now = datetime.now()
+    if state.get("state") == "open" and now < datetime.fromisoformat(state["next_retry"]):
+        raise _unavailable(server, state)
+
+    # Reserva a ligação de teste (só uma, entre threads e processos)
+    claimed = []
+
+    def claim(state):
+        if state.get("state") == "open" and now >= datetime.fromisoformat(state["next_retry"]):
+            state["state"] = "half-open"
+        elif not (state.get("state") == "half-open" and now - datetime.fromisoformat(state["probe_started"])
+                  > timedelta(seconds=PROBE_CLAIM_SECONDS)):
+            return state
+        state["probe_started"] = now.isoformat()
+        claimed.append(True)
+        return state
+
+    _, state = _update(server, claim)
+    if claimed:
+        return CIRCUIT_PROBE_TIMEOUT_SECONDS
+    if not state or state.get("state") not in ("open", "half-open"):
+        return None
+    raise _unavailable(server, state)
+
+def record_connection_failure(server, error):
+    """
+    Regista uma falha de ligação e abre o circuito (com backoff exponencial) ao atingir o limite.
+    Os erros que não são de rede/timeout mostram que o servidor respondeu: não contam como falha.
+    """
+    if not is_network_error(error):
+        record_connection_success(server)
+        return
+    now = datetime.now()
+
+    def fail(state):
+        failures = state.get("failures", 0) + 1
+        state["failures"] = failures
+        state["last_error"] = str(error)[:500]
+        state["last_failure"] = now.isoformat()
+        state.pop("probe_started", None)
+        if failures >= CIRCUIT_FAILURE_THRESHOLD:
+            backoff = min(CIRCUIT_BASE_BACKOFF_SECONDS * 2 ** (failures - CIRCUIT_FAILURE_THRESHOLD),
+                          CIRCUIT_MAX_BACKOFF_SECONDS)
+            if state.get("state") not in ("open", "half-open"):
+                state["opened_at"] = now.isoformat()
+            state["state"] = "open"
+            state["next_retry"] = (now + timedelta(seconds=backoff)).isoformat()
+        else:
+            state["state"] = "closed"
+        return state
+
+    _update(server, fail)
+
+def record_connection_success(server):
+    """
+    Regista que o servidor respondeu. Se tinha falhas registadas, fecha o circuito
+    e informa a recuperação.
+    """
+    if not get_server_state(server):
+        return
+    previous, _ = _update(server, lambda state: None)
+    if previous and previous.get("state") in ("open", "half-open"):
+        print(f"Servidor {server} recuperado: ligação restabelecida após {previous.get('failures', 0)} falhas seguidas "
+              f"(indisponível desde {previous.get('opened_at', 'N/A')}).")
+
+def reset_server_health(server=None):
+    """Limpa o estado guardado de um servidor (ou de todos, se 'server' for None)."""
+    if server is not None:
+        _update(server, lambda state: None)
+        return
+    with file_lock(SERVER_HEALTH_FILE):
+        tmp_file = f"{SERVER_HEALTH_FILE}.{os.getpid()}.tmp"
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            json.dump({}, f)
+        os.replace(tmp_file, SERVER_HEALTH_FILE)
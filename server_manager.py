@@ -1,6 +1,6 @@
 import os
 from encryption_utils import decrypt_password
-from db_utils import connect_to_db_server, get_user_databases
+from db_utils import pooled_connection, get_user_databases
 from config import SYSTEM_DATABASES
 
 SERVERS_FILE = "servers.txt"
@@ -70,11 +70,10 @@ def get_remote_databases():
         password = srv.get("password", "")
         print(f"\nA conectar ao servidor {server}...")
         try:
-            conn = connect_to_db_server(server, username, password)
-            cursor = conn.cursor()
-            dbs = get_user_databases(cursor)
+            with pooled_connection(server, username, password) as conn:
+                cursor = conn.cursor()
+                dbs = get_user_databases(cursor)
             databases_by_server[server] = dbs
-            conn.close()
             print(f"Servidor {server}: {len(dbs)} bases de dados encontradas.")
         except Exception as e:
             print(f"Erro ao conectar no servidor {server}: {e}")
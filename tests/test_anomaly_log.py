@@ -0,0 +1,69 @@
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import anomaly_log
+from anomaly_log import (LOG_FILE, CRITICAL_LOG_FILE, INDEX_FILES, LEGACY_LOG_FILES, log_anomalies,
+                         log_critical_anomalies, load_anomaly_index, read_log, list_critical_archives)
+
+def anomaly(issue):
+    return {
+        'database': 'Vendas',
+        'device': 'C:\\Backups\\Vendas.bak',
+        'user': 'DOMINIO\\backup',
+        'type': 'Full backup',
+        'instance': 'SRV01',
+        'issues': [issue],
+        'timestamp': '2026-01-05T10:00:00',
+    }
+
+class AnomalyLogTestCase(unittest.TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.folder = tempfile.mkdtemp()
+        os.chdir(self.folder)
+        anomaly_log._line_counts.clear()
+        anomaly_log._index_cache.clear()
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+class IndexTest(AnomalyLogTestCase):
+    """O índice de fingerprints só é regravado quando muda."""
+
+    def test_duplicates_do_not_rewrite_index(self):
+        self.assertEqual(log_anomalies([anomaly("Tamanho do ficheiro é 0")]), 1)
+        before = os.stat(INDEX_FILES[LOG_FILE]).st_mtime_ns
+        self.assertEqual(log_anomalies([anomaly("Tamanho do ficheiro é 0")]), 0)
+        self.assertEqual(os.stat(INDEX_FILES[LOG_FILE]).st_mtime_ns, before)
+
+    def test_new_fingerprint_is_saved(self):
+        log_anomalies([anomaly("Tamanho do ficheiro é 0")])
+        log_anomalies([anomaly("Intervalo demasiado longo: 3 days, 0:00:00")])
+        anomaly_log._index_cache.clear()
+        self.assertEqual(len(load_anomaly_index(LOG_FILE)), 2)
+
+class LegacyRotationTest(AnomalyLogTestCase):
+    """As entradas migradas do log crítico antigo (sem first_seen) não impedem a rotação diária."""
+
+    def test_migrated_entries_rotate_on_next_day(self):
+        yesterday = (datetime.now() - timedelta(days=1)).strftime("%Y-%m-%d %H:%M:%S")
+        legacy_file, key = LEGACY_LOG_FILES[CRITICAL_LOG_FILE]
+        old = dict(anomaly("Último backup full/differential feito por utilizador não autorizado"),
+                   timestamp=yesterday, level=0)
+        with open(legacy_file, "w", encoding="utf-8") as f:
+            json.dump({key: [old]}, f)
+
+        self.assertEqual(log_critical_anomalies([dict(anomaly("Tamanho do ficheiro é 0"), level=0)]), 1)
+        self.assertEqual(len(list_critical_archives()), 1)
+        self.assertEqual([entry["issues"] for entry in read_log(CRITICAL_LOG_FILE)], [["Tamanho do ficheiro é 0"]])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,63 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import anomaly_log
+from anomaly_log import CRITICAL_LOG_FILE, CRITICAL_MAX_ENTRIES, record_anomalies
+from check_state import CheckState
+
+def offline_anomaly(now):
+    # Anomalia de estado, como as de check_db_status: 'reference' None até ser atribuída pelo CheckState
+    return {
+        'database': 'Vendas',
+        'device': '',
+        'user': '',
+        'type': 'DB Status',
+        'instance': 'SRV01',
+        'issues': ["A base está em estado: 'OFFLINE'", "Recovery model: 'FULL'"],
+        'timestamp': now,
+        'reference': None,
+        'level': 0,
+    }
+
+class IncidentTest(unittest.TestCase):
+    """Uma anomalia de estado que desaparece e volta é um incidente novo e é registada de novo."""
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.folder = tempfile.mkdtemp()
+        os.chdir(self.folder)
+        anomaly_log._line_counts.clear()
+        self.now = datetime.now().replace(microsecond=0)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def sweep(self, offline, minutes):
+        """Uma verificação da base (opção 5), com o estado relido do disco como num processo novo."""
+        now = self.now + timedelta(minutes=minutes)
+        state = CheckState('SRV01')
+        anomalies = state.track('5', 'Vendas', [offline_anomaly(now)] if offline else [], now)
+        state.save()
+        return record_anomalies(CRITICAL_LOG_FILE, anomalies, CRITICAL_MAX_ENTRIES, rotate=True)
+
+    def test_continuous_incident_is_logged_once(self):
+        self.assertEqual(self.sweep(True, 0), 1)
+        self.assertEqual(self.sweep(True, 10), 0)
+        self.assertEqual(self.sweep(True, 20), 0)
+
+    def test_incident_recurs_after_clearing(self):
+        self.assertEqual(self.sweep(True, 0), 1)
+        self.assertEqual(self.sweep(True, 10), 0)
+        self.assertEqual(self.sweep(False, 20), 0)
+        self.assertEqual(self.sweep(True, 30), 1)
+        self.assertEqual(self.sweep(True, 40), 0)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,4 +1,6 @@
 import os
+import re
+import threading
 
 WHITELIST_FILE = "whitelist.txt"
 DEFAULT_PREFIX = "VanSora-Hybrid\\"
@@ -17,16 +19,115 @@ def create_whitelist_file_if_not_exists():
         with open(WHITELIST_FILE, "w") as f:
             f.write(DEFAULT_PREFIX + "\n")
 
+class CachedWhitelist:
+    """
+    Whitelist mantida em memória: o ficheiro só é relido quando o seu mtime (ou tamanho) muda.
+    - prefix=True: um nome é autorizado se começar por uma das entradas (uma única regex compilada);
+      caso contrário, tem de ser igual a uma das entradas.
+    - As comparações são case insensitive e o resultado de cada nome é memorizado até à próxima releitura.
+    """
+
+    def __init__(self, path, loader, prefix=False):
+        self.path = path
+        self.loader = loader
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self._signature = None
+        self._state = None   # (entradas, função de comparação, memo)
+
+    def _file_signature(self):
+        try:
+            st = os.stat(self.path)
+            return (st.st_mtime_ns, st.st_size)
+        except OSError:
+            return None
+
+    def _compile(self, entries):
+        lowered = sorted({entry.lower() for entry in entries}, key=len, reverse=True)
+        if self.prefix:
+            pattern = re.compile("|".join(re.escape(entry) for entry in lowered)) if lowered else None
+            return (lambda name: pattern.match(name) is not None) if pattern else (lambda name: False)
+        return frozenset(lowered).__contains__
+
+    def _current(self):
+        signature = self._file_signature()
+        state = self._state
+        if state is not None and signature == self._signature:
+            return state
+        with self._lock:
+            if self._state is None or self._file_signature() != self._signature:
+                entries = self.loader()
+                # O loader pode ter criado o ficheiro: guarda a assinatura depois da leitura
+                self._signature = self._file_signature()
+                self._state = (entries, self._compile(entries), {})
+            return self._state
+
+    def signature(self):
+        """Devolve a assinatura (mtime, tamanho) do ficheiro lido, para detetar alterações à whitelist."""
+        self._current()
+        return self._signature
+
+    def entries(self):
+        """Devolve (uma cópia de) a lista de entradas da whitelist."""
+        return list(self._current()[0])
+
+    def matcher(self):
+        """
+        Devolve uma função nome -> bool com a whitelist atual (o ficheiro é verificado uma única vez,
+        aqui, e não em cada comparação). Deve ser obtida uma vez por verificação e usada para todos os backups.
+        """
+        _, compiled, memo = self._current()
+
+        def matches(name):
+            result = memo.get(name)
+            if result is None:
+                result = memo[name] = compiled((name or "").lower())
+            return result
+        return matches
+
+    def invalidate(self):
+        """Força a releitura do ficheiro no próximo acesso (ex.: depois de o alterar)."""
+        with self._lock:
+            self._state = None
+
+def read_whitelist_entries(path):
+    """Lê as entradas (uma por linha, sem linhas vazias) de um ficheiro de whitelist; [] se não existir."""
+    try:
+        with open(path, "r") as f:
+            return [line.strip() for line in f if line.strip()]
+    except FileNotFoundError:
+        return []
+
+def _read_whitelist():
+    if not os.path.exists(WHITELIST_FILE):
+        create_whitelist_file_if_not_exists()
+    return read_whitelist_entries(WHITELIST_FILE)
+
+WHITELIST = CachedWhitelist(WHITELIST_FILE, _read_whitelist, prefix=True)
+SYSADMIN_WHITELIST = CachedWhitelist(SYSADMIN_WHITELIST_FILE,
+                                     lambda: read_whitelist_entries(SYSADMIN_WHITELIST_FILE))
+SYSADMIN_GROUP_WHITELIST = CachedWhitelist(SYSADMIN_GROUP_WHITELIST_FILE,
+                                           lambda: read_whitelist_entries(SYSADMIN_GROUP_WHITELIST_FILE))
+
 def load_whitelist():
     """
     Lê o ficheiro whitelist.txt e dá return a uma lista de prefixos autorizados.
     Caso o ficheiro não exista, ele é criado com o prefixo padrão.
+    O conteúdo fica em cache e só é relido quando o ficheiro é alterado.
     """
-    if not os.path.exists(WHITELIST_FILE):
-        create_whitelist_file_if_not_exists()
-    with open(WHITELIST_FILE, "r") as f:
-        prefixes = [line.strip() for line in f if line.strip()]
-    return prefixes
+    return WHITELIST.entries()
+
+def get_whitelist_matcher():
+    """Devolve uma função user_name -> bool: True se o utilizador começar por um prefixo de whitelist.txt."""
+    return WHITELIST.matcher()
+
+def get_sysadmin_whitelist_matcher():
+    """Devolve uma função login -> bool: True se o login estiver na sysadminwhitelist."""
+    return SYSADMIN_WHITELIST.matcher()
+
+def get_sysadmin_group_whitelist_matcher():
+    """Devolve uma função grupo -> bool: True se o grupo estiver na sysadmingroupwhitelist."""
+    return SYSADMIN_GROUP_WHITELIST.matcher()
 
 def create_sysadmin_whitelist_file_if_not_exists():
     """